@@ -0,0 +1,212 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import openai
+from gpt3contextual import ContextualChat, ContextualChatGPT, ContextManager
+from gpt3contextual.models import Context, clear_prepared_tables
+from benchmarks.stub_server import StubOpenAIServer
+
+
+"""
+End-to-end benchmark of chat() / chat_sync() against the local stub of OpenAI API.
+
+$ python -m benchmarks.bench_chat --requests 500 --concurrency 20 --history-depth 10 --output bench_result.json
+"""
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    # Nearest-rank method
+    index = min(len(values) - 1, max(0, math.ceil(p * len(values) / 100) - 1))
+    return values[index]
+
+
+def summarize(latencies: list[float], errors: list[str], duration: float) -> dict:
+    return {
+        "requests": len(latencies) + len(errors),
+        "errors": len(errors),
+        "error_types": {e: errors.count(e) for e in set(errors)},
+        "duration": duration,
+        "throughput_rps": len(latencies) / duration if duration else 0.0,
+        "latency_ms": {
+            "mean": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+            "p50": percentile(latencies, 50) * 1000,
+            "p95": percentile(latencies, 95) * 1000,
+            "p99": percentile(latencies, 99) * 1000,
+            "max": max(latencies) * 1000 if latencies else 0.0
+        }
+    }
+
+
+def make_connection_str(backend: str, workdir: str) -> str:
+    if backend == "memory":
+        # SQLite on tmpfs instead of ":memory:" that can't be shared by the connections in threads safely
+        memory_dir = "/dev/shm" if os.path.isdir("/dev/shm") else workdir
+        return f"sqlite:///{os.path.join(memory_dir, f'gpt3contextual_bench_{os.getpid()}.db')}"
+    return f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+
+
+def remove_database(connection_str: str):
+    path = connection_str[len("sqlite:///"):]
+    for suffix in ["", "-journal", "-wal", "-shm"]:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def prepare_contexts(contextual_chat, context_manager: ContextManager, keys: list[str], history_depth: int):
+    with contextual_chat.get_session() as session:
+        for key in keys:
+            if isinstance(contextual_chat, ContextualChatGPT):
+                histories = [f"history {i}" for i in range(history_depth)]
+            else:
+                histories = [f"{context_manager.username if i % 2 == 0 else context_manager.agentname}:history {i}" for i in range(history_depth)]
+            context_manager.set(session, Context(
+                key=key,
+                username=context_manager.username,
+                agentname=context_manager.agentname,
+                chat_description=context_manager.chat_description,
+                history_count=history_depth,
+                histories=json.dumps(histories)
+            ))
+
+
+async def run_chat(contextual_chat, keys: list[str], requests: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = []
+
+    async def run_one(i: int):
+        async with semaphore:
+            start_time = time.perf_counter()
+            try:
+                await contextual_chat.chat(keys[i % len(keys)], f"request {i}")
+                latencies.append(time.perf_counter() - start_time)
+            except Exception as ex:
+                errors.append(type(ex).__name__)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[run_one(i) for i in range(requests)])
+    return summarize(latencies, errors, time.perf_counter() - start_time)
+
+
+def run_chat_sync(contextual_chat, keys: list[str], requests: int, concurrency: int) -> dict:
+    latencies = []
+    errors = []
+
+    def run_one(i: int):
+        start_time = time.perf_counter()
+        try:
+            contextual_chat.chat_sync(keys[i % len(keys)], f"request {i}")
+            latencies.append(time.perf_counter() - start_time)
+        except Exception as ex:
+            errors.append(type(ex).__name__)
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run_one, range(requests)))
+    return summarize(latencies, errors, time.perf_counter() - start_time)
+
+
+def run_benchmark(
+    *,
+    api: str = "chat",
+    modes: list[str] = ("chat", "chat_sync"),
+    backends: list[str] = ("file", "memory"),
+    requests: int = 200,
+    concurrency: int = 10,
+    users: int = None,
+    history_depth: int = 10,
+    latency: float = 0.05,
+    response_size: int = 200
+) -> dict:
+
+    server = StubOpenAIServer(latency=latency, response_size=response_size).start()
+    original_api_base = openai.api_base
+    openai.api_base = server.api_base
+
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            for backend in backends:
+                for mode in modes:
+                    connection_str = make_connection_str(backend, workdir)
+                    context_manager = ContextManager(history_count=history_depth)
+                    chat_class = ContextualChatGPT if api == "chat" else ContextualChat
+                    contextual_chat = chat_class("sk-stub", connection_str, context_manager)
+
+                    keys = [f"bench-{mode}-{i}" for i in range(users or concurrency)]
+                    prepare_contexts(contextual_chat, context_manager, keys, history_depth)
+
+                    if mode == "chat":
+                        result = asyncio.run(run_chat(contextual_chat, keys, requests, concurrency))
+                    else:
+                        result = run_chat_sync(contextual_chat, keys, requests, concurrency)
+
+                    contextual_chat.engine.dispose()
+                    remove_database(connection_str)
+                    # Tables are created again for the next database on the same path
+                    clear_prepared_tables()
+                    results.append({"backend": backend, "mode": mode, **result})
+
+    finally:
+        openai.api_base = original_api_base
+        server.stop()
+
+    return {
+        "config": {
+            "api": api,
+            "requests": requests,
+            "concurrency": concurrency,
+            "users": users or concurrency,
+            "history_depth": history_depth,
+            "stub_latency": latency,
+            "response_size": response_size
+        },
+        "results": results
+    }
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description="Benchmark gpt3contextual with local stub of OpenAI API")
+    parser.add_argument("--api", choices=["chat", "completion"], default="chat", help="ChatCompletion (ContextualChatGPT) or Completion (ContextualChat)")
+    parser.add_argument("--mode", choices=["chat", "chat_sync", "both"], default="both")
+    parser.add_argument("--backend", choices=["file", "memory", "both"], default="both", help="SQLite on disk or on memory (tmpfs)")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--users", type=int, default=None, help="Count of context keys. Default is concurrency")
+    parser.add_argument("--history-depth", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.05, help="Latency of stub server (sec)")
+    parser.add_argument("--response-size", type=int, default=200, help="Characters of response text")
+    parser.add_argument("--output", default=None, help="Path to write result JSON. Default is stdout")
+    args = parser.parse_args(argv)
+
+    result = run_benchmark(
+        api=args.api,
+        modes=["chat", "chat_sync"] if args.mode == "both" else [args.mode],
+        backends=["file", "memory"] if args.backend == "both" else [args.backend],
+        requests=args.requests,
+        concurrency=args.concurrency,
+        users=args.users,
+        history_depth=args.history_depth,
+        latency=args.latency,
+        response_size=args.response_size
+    )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+
+"""
+Benchmark of import and construction time in fresh interpreters (cold start of CLI tools and serverless functions).
+
+$ python -m benchmarks.bench_import --runs 5
+"""
+
+
+# Modules that should not be imported by `import gpt3contextual`
+HEAVY_MODULES = ["openai", "aiohttp", "sqlalchemy", "sqlalchemy.ext.asyncio"]
+
+SCRIPT = """
+import json
+import sys
+import time
+
+start_time = time.perf_counter()
+import gpt3contextual
+import_package = time.perf_counter() - start_time
+loaded_modules = [m for m in {heavy_modules!r} if m in sys.modules]
+
+start_time = time.perf_counter()
+from gpt3contextual import ContextualChatGPT
+import_chat = time.perf_counter() - start_time
+
+start_time = time.perf_counter()
+ContextualChatGPT("sk-bench", {connection_str!r})
+first_instance = time.perf_counter() - start_time
+
+start_time = time.perf_counter()
+ContextualChatGPT("sk-bench", {connection_str!r})
+second_instance = time.perf_counter() - start_time
+
+print(json.dumps({{
+    "import_package_ms": import_package * 1000,
+    "import_chat_ms": import_chat * 1000,
+    "first_instance_ms": first_instance * 1000,
+    "second_instance_ms": second_instance * 1000,
+    "loaded_modules": loaded_modules
+}}))
+"""
+
+
+def run_once(connection_str: str) -> dict:
+    env = dict(os.environ)
+    # Import gpt3contextual in this repository
+    env["PYTHONPATH"] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env.get("PYTHONPATH", "")])
+    output = subprocess.run(
+        [sys.executable, "-c", SCRIPT.format(heavy_modules=HEAVY_MODULES, connection_str=connection_str)],
+        env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run_benchmark(*, runs: int = 5) -> dict:
+    samples = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for i in range(runs):
+            samples.append(run_once(f"sqlite:///{workdir}/bench_import_{i}.db"))
+
+    result = {}
+    for k in ["import_package_ms", "import_chat_ms", "first_instance_ms", "second_instance_ms"]:
+        values = sorted(s[k] for s in samples)
+        result[k] = values[len(values) // 2]
+    result["loaded_modules"] = sorted({m for s in samples for m in s["loaded_modules"]})
+
+    return {
+        "config": {
+            "runs": runs
+        },
+        # Median of runs
+        "result": result
+    }
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description="Benchmark import and construction time of gpt3contextual")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", default=None, help="Path to write result JSON. Default is stdout")
+    args = parser.parse_args(argv)
+
+    result = run_benchmark(runs=args.runs)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import argparse
+import json
+import sys
+import tempfile
+import time
+from copy import deepcopy
+from gpt3contextual import ContextualChat, ContextualChatGPT
+from gpt3contextual.models import Context
+
+
+"""
+Microbenchmark of building request params: per-call deepcopy and rebuild (legacy) vs compiled templates.
+
+$ python -m benchmarks.bench_params --iterations 100000 --history-depth 10
+"""
+
+
+def legacy_make_params(contextual_chat, context: Context, *, prompt: str = None, messages: list[dict] = None, completion_params: dict = None) -> dict:
+    # make_params() before the compiled templates
+    params = deepcopy(contextual_chat.completion_params) if contextual_chat.completion_params else {}
+
+    params["api_key"] = contextual_chat.api_key
+    params["model"] = contextual_chat.model
+    params["temperature"] = contextual_chat.temperature
+    params["max_tokens"] = contextual_chat.max_tokens
+    if prompt:
+        params["stop"] = [f"{context.username}:", f"{context.agentname}:"]
+        params["prompt"] = prompt
+    else:
+        params["messages"] = messages
+
+    if completion_params:
+        for k, v in completion_params.items():
+            params[k] = v
+
+    return params
+
+
+def legacy_make_request_params(contextual_chat, context: Context, text: str) -> dict:
+    if isinstance(contextual_chat, ContextualChatGPT):
+        messages = [{
+            "role": "system",
+            "content": f"[Roles]\nuser: {context.username}\nassistant: {context.agentname}\n\n[Conditions]\n{context.chat_description}"
+        }]
+        histories = context.get_histories_as_list()
+        turn_user = len(histories) % 2 == 0
+        for i in range(len(histories)):
+            messages.append({"role": "user" if turn_user else "assistant", "content": histories[i]})
+            turn_user = not turn_user
+        messages.append({"role": "user", "content": text})
+        return legacy_make_params(contextual_chat, context, messages=messages)
+
+    return legacy_make_params(contextual_chat, context, prompt=contextual_chat.make_prompt(context, text))
+
+
+def measure(func, iterations: int) -> float:
+    start_time = time.perf_counter()
+    for i in range(iterations):
+        func(i)
+    return (time.perf_counter() - start_time) / iterations
+
+
+def run_benchmark(*, iterations: int = 100000, history_depth: int = 10, logit_bias_size: int = 100) -> dict:
+    results = []
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for chat_class in [ContextualChatGPT, ContextualChat]:
+            # Completion params with nested values that deepcopy walks in each call
+            contextual_chat = chat_class(
+                "sk-bench",
+                f"sqlite:///{workdir}/bench_params.db",
+                logit_bias={str(i): -1 for i in range(logit_bias_size)},
+                presence_penalty=0.5
+            )
+            context = Context(
+                key="bench",
+                username="Human",
+                agentname="AI",
+                chat_description="You are a helpful assistant. " * 10,
+                history_count=history_depth,
+                histories=json.dumps([f"history {i}" for i in range(history_depth)])
+            )
+
+            legacy = measure(lambda i: legacy_make_request_params(contextual_chat, context, f"request {i}"), iterations)
+            compiled = measure(lambda i: contextual_chat.make_request_params(context, f"request {i}", None), iterations)
+            contextual_chat.engine.dispose()
+
+            results.append({
+                "api": "chat" if chat_class is ContextualChatGPT else "completion",
+                "legacy_us": legacy * 1000000,
+                "compiled_us": compiled * 1000000,
+                "speedup": legacy / compiled if compiled else 0.0
+            })
+
+    return {
+        "config": {
+            "iterations": iterations,
+            "history_depth": history_depth,
+            "logit_bias_size": logit_bias_size
+        },
+        "results": results
+    }
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(description="Benchmark building request params of gpt3contextual")
+    parser.add_argument("--iterations", type=int, default=100000)
+    parser.add_argument("--history-depth", type=int, default=10)
+    parser.add_argument("--logit-bias-size", type=int, default=100, help="Entries of logit_bias in completion_params")
+    parser.add_argument("--output", default=None, help="Path to write result JSON. Default is stdout")
+    args = parser.parse_args(argv)
+
+    result = run_benchmark(
+        iterations=args.iterations,
+        history_depth=args.history_depth,
+        logit_bias_size=args.logit_bias_size
+    )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
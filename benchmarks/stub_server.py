@@ -0,0 +1,124 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubOpenAIHandler(BaseHTTPRequestHandler):
+    # Keep-alive is available with Content-Length
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connection_count += 1
+
+    def do_GET(self):
+        if self.path.endswith("/models"):
+            self.send_json(200, {"object": "list", "data": [{"id": "gpt-3.5-turbo", "object": "model"}]})
+        else:
+            self.send_json(404, {"error": {"message": f"Not found: {self.path}", "type": "invalid_request_error"}})
+
+    def make_text(self) -> str:
+        size = self.server.response_size
+        return ("lorem ipsum " * (size // 12 + 1))[:size]
+
+    def send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, chunks: list[dict]):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for c in chunks:
+            self.wfile.write(f"data: {json.dumps(c)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        time.sleep(self.server.latency)
+        self.server.request_count += 1
+
+        text = self.make_text()
+        usage = {"prompt_tokens": 10, "completion_tokens": len(text) // 4, "total_tokens": 10 + len(text) // 4}
+
+        if self.path.endswith("/chat/completions"):
+            if body.get("stream"):
+                self.send_stream([
+                    {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": body.get("model"),
+                     "choices": [{"index": 0, "delta": {"content": t}, "finish_reason": None}]}
+                    for t in [text[i:i + 8] for i in range(0, len(text), 8)]
+                ])
+                return
+
+            self.send_json(200, {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage
+            })
+
+        elif self.path.endswith("/completions"):
+            if body.get("stream"):
+                self.send_stream([
+                    {"id": "cmpl-stub", "object": "text_completion", "created": int(time.time()), "model": body.get("model"),
+                     "choices": [{"index": 0, "text": t, "finish_reason": None}]}
+                    for t in [text[i:i + 8] for i in range(0, len(text), 8)]
+                ])
+                return
+
+            self.send_json(200, {
+                "id": "cmpl-stub",
+                "object": "text_completion",
+                "created": int(time.time()),
+                "model": body.get("model"),
+                "choices": [{"index": 0, "text": text, "finish_reason": "stop"}],
+                "usage": usage
+            })
+
+        else:
+            self.send_json(404, {"error": {"message": f"Not found: {self.path}", "type": "invalid_request_error"}})
+
+
+class StubOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, *, latency: float = 0.05, response_size: int = 200) -> None:
+        super().__init__((host, port), StubOpenAIHandler)
+        self.latency = latency
+        self.response_size = response_size
+        self.request_count = 0
+        # Count of TCP connections accepted
+        self.connection_count = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def api_base(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="StubOpenAIServer", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
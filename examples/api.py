@@ -1,16 +1,21 @@
-import aiohttp
+import asyncio
+import json
 import logging
 import traceback
 from fastapi import FastAPI, Request
 from fastapi.openapi.utils import get_openapi
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from gpt3contextual import ContextualChatGPT, ContextManager, CompletionException
+from gpt3contextual import ContextualChatGPT, ContextManager, CompletionException, CompletionTimeoutException, CompletionLogWriter, MetricsAggregator, ConnectionPool
 
 
 # Settings
 openai_apikey = "SET_YOUR_OPENAI_API_KEY"
 config_access_key = "CHANGE_THIS_VALUE_AS_YOU_LIKE"
+# Max seconds for each turn
+chat_timeout = 60
+# Interval to check whether the client is still connected
+disconnect_check_interval = 0.5
 
 
 # Schemas
@@ -59,17 +64,25 @@ logger.addHandler(stream_handler)
 
 
 # Shared objects
-session = aiohttp.ClientSession()
-
 context_manager = ContextManager(
     username="兄",
     agentname="妹",
     chat_description="仲良しなので丁寧語を使わずに話してください。"
 )
 
+log_writer = CompletionLogWriter(overflow="drop")
+
+metrics = MetricsAggregator()
+
 contextual_chat = ContextualChatGPT(
     openai_apikey,
-    context_manager=context_manager
+    context_manager=context_manager,
+    log_writer=log_writer,
+    observers=[metrics],
+    # Keep connections to OpenAI API alive and open some of them at startup
+    connection_pool=ConnectionPool(max_connections=100, connect_timeout=10, read_timeout=120, warmup_connections=4),
+    # Use async driver not to block event loop while accessing database
+    async_connection_str="sqlite+aiosqlite:///gpt3contextual.db"
 )
 
 
@@ -77,12 +90,23 @@ contextual_chat = ContextualChatGPT(
 app = FastAPI()
 
 
+@app.on_event("startup")
+async def app_startup():
+    await contextual_chat.warmup()
+
+
 @app.on_event("shutdown")
 async def app_shutdown():
-    await session.close()
+    await contextual_chat.aclose()
+    log_writer.close()
 
 
 # Exception handlers
+@app.exception_handler(CompletionTimeoutException)
+async def handle_completion_timeout_exception(request: Request, ex: CompletionTimeoutException):
+    return JSONResponse(content={"error": str(ex)}, status_code=504)
+
+
 @app.exception_handler(CompletionException)
 async def handle_completion_exception(request: Request, ex: CompletionException):
     return JSONResponse(content={"error": str(ex), "completion_response": ex.completion_response}, status_code=500)
@@ -93,21 +117,40 @@ async def handle_exception(request: Request, ex: Exception):
     return JSONResponse(content={"error": "Internal Server Error"}, status_code=500)
 
 
+async def run_while_connected(http_request: Request, coro):
+    # Cancel the turn when the client disconnects not to wait for and pay for the completion nobody receives
+    task = asyncio.create_task(coro)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=disconnect_check_interval)
+        if done:
+            return task.result()
+        if await http_request.is_disconnected():
+            task.cancel()
+            await asyncio.wait({task})
+            return None
+
+
 # FastAPI Routers
 @app.post("/chat/{context_key}",
           response_model=ChatResponse,
           summary="Get contextual chat response from OpenAI",
           tags=["Chat"])
-async def chat(request: ChatRequest, context_key: str):
+async def chat(request: ChatRequest, context_key: str, http_request: Request):
     try:
         if not request.text:
             return JSONResponse(content={"error": "text is required"}, status_code=400)
 
-        resp, params, completion = await contextual_chat.chat(
+        result = await run_while_connected(http_request, contextual_chat.chat(
             context_key,
             request.text,
+            timeout=chat_timeout,
             **(request.completion_params or {})
-        )
+        ))
+        if result is None:
+            logger.info(f"Client disconnected: {context_key}")
+            return JSONResponse(content={"error": "client disconnected"}, status_code=499)
+
+        resp, params, completion = result
 
         del params["api_key"]
         return ChatResponse(text=resp, params=params, completion=completion)
@@ -121,6 +164,44 @@ async def chat(request: ChatRequest, context_key: str):
         raise ex
 
 
+@app.post("/chat/{context_key}/stream",
+          summary="Get contextual chat response from OpenAI as Server-Sent Events",
+          tags=["Chat"])
+async def chat_stream(request: ChatRequest, context_key: str):
+    if not request.text:
+        return JSONResponse(content={"error": "text is required"}, status_code=400)
+
+    # StreamingResponse stops this generator when the client disconnects and the stream to OpenAI API is closed
+    async def stream_events():
+        try:
+            async for delta in contextual_chat.chat_stream(
+                context_key,
+                request.text,
+                timeout=chat_timeout,
+                **(request.completion_params or {})
+            ):
+                yield f"data: {json.dumps({'text': delta}, ensure_ascii=False)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        except CompletionException as ex:
+            logger.error(f"Completion error: {ex}\n{traceback.format_exc()}")
+            yield f"event: error\ndata: {json.dumps({'error': str(ex)}, ensure_ascii=False)}\n\n"
+
+        except Exception as ex:
+            logger.error(f"Server error: {ex}\n{traceback.format_exc()}")
+            yield f"event: error\ndata: {json.dumps({'error': 'Internal Server Error'})}\n\n"
+
+    return StreamingResponse(stream_events(), media_type="text/event-stream")
+
+
+@app.get("/metrics",
+         response_class=PlainTextResponse,
+         summary="Get latency of each stage and token usage in Prometheus format",
+         tags=["Monitoring"])
+async def get_metrics():
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
 @app.put("/context/config",
          response_model=ConfigContextResponse,
          summary="Configure context manager",
@@ -140,7 +221,8 @@ async def context_config(request: ConfigContextRequest):
     if request.history_count:
         context_manager.history_count = request.history_count
 
-    context_manager.remove_all(contextual_chat.get_session())
+    async with contextual_chat.get_async_session() as db_session:
+        await context_manager.remove_all_async(db_session)
 
     return ConfigContextResponse()
 
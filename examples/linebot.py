@@ -5,12 +5,16 @@ from fastapi import FastAPI, Request, BackgroundTasks
 from linebot import AsyncLineBotApi, WebhookParser
 from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
 from linebot.models import MessageEvent, TextMessage
-from gpt3contextual import ContextualChatGPT, ContextManager
+from gpt3contextual import ContextualChatGPT, ContextManager, CompletionTimeoutException, EventDispatcher
 
 
 openai_apikey = "SET_YOUR_OPENAI_API_KEY"
 channel_access_token = "<YOUR CHANNEL ACCESS TOKEN>"
 channel_secret = "<YOUR CHANNEL SECRET>"
+# Reply token expires in about 1 minute after the event. Give up the turn a bit before it
+reply_token_ttl = 55
+# Max events handled at the same time across all webhook requests
+concurrency = 20
 
 stream_handler = logging.StreamHandler()
 stream_handler.setLevel(logging.INFO)
@@ -36,27 +40,38 @@ contextual_chat = ContextualChatGPT(
 )
 
 
-async def handle_events(events):
-    for ev in events:
-        if isinstance(ev, MessageEvent):
-            try:
-                resp, _, _ = await contextual_chat.chat(
-                    ev.source.user_id,
-                    ev.message.text
-                )
+async def handle_event(ev: MessageEvent):
+    try:
+        resp, _, _ = await contextual_chat.chat(
+            ev.source.user_id,
+            ev.message.text,
+            deadline=ev.timestamp / 1000 + reply_token_ttl
+        )
 
-            except Exception as ex:
-                logger.error(f"Chat error: {ex}\n{traceback.format_exc()}")
-                resp = "😣"
+    except CompletionTimeoutException:
+        logger.warning(f"Reply token expired: {ev.source.user_id}")
+        return
 
-            try:
-                await line_api.reply_message(
-                    ev.reply_token,
-                    TextMessage(text=resp)
-                )
+    except Exception as ex:
+        logger.error(f"Chat error: {ex}\n{traceback.format_exc()}")
+        resp = "😣"
 
-            except Exception as ex:
-                logger.error(f"LINE error: {ex}\n{traceback.format_exc()}")
+    try:
+        await line_api.reply_message(
+            ev.reply_token,
+            TextMessage(text=resp)
+        )
+
+    except Exception as ex:
+        logger.error(f"LINE error: {ex}\n{traceback.format_exc()}")
+
+
+# Events from different users are handled concurrently and events from the same user in the order
+dispatcher = EventDispatcher(
+    handle_event,
+    lambda ev: ev.source.user_id,
+    concurrency=concurrency
+)
 
 
 app = FastAPI()
@@ -64,6 +79,7 @@ app = FastAPI()
 
 @app.on_event("shutdown")
 async def app_shutdown():
+    await dispatcher.join()
     await session.close()
 
 
@@ -73,5 +89,8 @@ async def handle_request(request: Request, background_tasks: BackgroundTasks):
         (await request.body()).decode("utf-8"),
         request.headers.get("X-Line-Signature", "")
     )
-    background_tasks.add_task(handle_events, events=events)
+    background_tasks.add_task(
+        dispatcher.dispatch,
+        events=[ev for ev in events if isinstance(ev, MessageEvent) and isinstance(ev.message, TextMessage)]
+    )
     return "ok"
@@ -1,9 +1,154 @@
-from .chat import (
-    ContextualChat,
-    ContextualChatGPT,
-    CompletionException,
-    ContextManager
-)
-from .models import (
-    Context
-)
+from importlib import import_module
+from typing import TYPE_CHECKING
+
+# Modules are imported on the first access to their names to make `import gpt3contextual` fast
+_exports = {
+    ".chat": (
+        "ContextualChat",
+        "ContextualChatGPT",
+        "CompletionException",
+        "CompletionTimeoutException",
+        "ContextManager"
+    ),
+    ".models": (
+        "Context",
+    ),
+    ".store": (
+        "ContextStore",
+    ),
+    ".redisstore": (
+        "RedisClient",
+        "RedisContextStore"
+    ),
+    ".cache": (
+        "ContextCache",
+        "ResponseCache",
+        "SQLiteResponseCache"
+    ),
+    ".lock": (
+        "KeyedLock",
+    ),
+    ".logwriter": (
+        "CompletionLogWriter",
+    ),
+    ".ratelimit": (
+        "RateLimiter",
+        "RetryPolicy"
+    ),
+    ".sweeper": (
+        "ContextSweeper",
+    ),
+    ".instrumentation": (
+        "ChatObserver",
+        "MetricsAggregator"
+    ),
+    ".pool": (
+        "ConnectionPool",
+    ),
+    ".summary": (
+        "Summarizer",
+        "CompletionSummarizer"
+    ),
+    ".logpolicy": (
+        "LogPolicy",
+        "decode_log",
+        "decode_payload"
+    ),
+    ".dispatcher": (
+        "EventDispatcher",
+    ),
+    ".router": (
+        "ModelRouter",
+        "ModelRoute",
+        "CircuitBreaker"
+    ),
+    ".memory": (
+        "LongTermMemory",
+        "Embedder",
+        "HashingEmbedder"
+    )
+}
+_modules = {name: module for module, names in _exports.items() for name in names}
+
+__all__ = list(_modules)
+
+
+def __getattr__(name: str):
+    module = _modules.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(module, __name__), name)
+    # Cache to skip __getattr__ from the next access
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
+
+
+if TYPE_CHECKING:
+    from .chat import (
+        ContextualChat,
+        ContextualChatGPT,
+        CompletionException,
+        CompletionTimeoutException,
+        ContextManager
+    )
+    from .models import (
+        Context
+    )
+    from .store import (
+        ContextStore
+    )
+    from .redisstore import (
+        RedisClient,
+        RedisContextStore
+    )
+    from .cache import (
+        ContextCache,
+        ResponseCache,
+        SQLiteResponseCache
+    )
+    from .lock import (
+        KeyedLock
+    )
+    from .logwriter import (
+        CompletionLogWriter
+    )
+    from .ratelimit import (
+        RateLimiter,
+        RetryPolicy
+    )
+    from .sweeper import (
+        ContextSweeper
+    )
+    from .instrumentation import (
+        ChatObserver,
+        MetricsAggregator
+    )
+    from .pool import (
+        ConnectionPool
+    )
+    from .summary import (
+        Summarizer,
+        CompletionSummarizer
+    )
+    from .logpolicy import (
+        LogPolicy,
+        decode_log,
+        decode_payload
+    )
+    from .dispatcher import (
+        EventDispatcher
+    )
+    from .router import (
+        ModelRouter,
+        ModelRoute,
+        CircuitBreaker
+    )
+    from .memory import (
+        LongTermMemory,
+        Embedder,
+        HashingEmbedder
+    )
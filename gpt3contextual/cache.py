@@ -0,0 +1,154 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class ContextCache:
+    def __init__(self, max_size: int = 1000, ttl: float = None) -> None:
+        # ttl=None means that the entries live as long as ContextManager.timeout
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str, ttl: float = None) -> dict:
+        ttl = self.ttl if self.ttl is not None else ttl
+
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+
+            cached_at, data = item
+            if ttl is not None and time.monotonic() - cached_at > ttl:
+                del self.items[key]
+                self.misses += 1
+                return None
+
+            self.items.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def set(self, key: str, data: dict):
+        with self.lock:
+            self.items[key] = (time.monotonic(), data)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def remove(self, key: str):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.items),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+
+class ResponseCache(ContextCache):
+    def __init__(self, max_size: int = 1000, ttl: float = 3600) -> None:
+        super().__init__(max_size, ttl)
+
+    def make_key(self, params: dict) -> str:
+        # api_key doesn't change the response
+        params = {k: v for k, v in params.items() if k != "api_key"}
+        return hashlib.sha256(json.dumps(params, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get_completion(self, params: dict) -> dict:
+        return self.get(self.make_key(params))
+
+    def set_completion(self, params: dict, completion: dict):
+        self.set(self.make_key(params), completion)
+
+
+class SQLiteResponseCache(ResponseCache):
+    def __init__(self, path: str = "gpt3contextual_cache.db", max_size: int = 10000, ttl: float = 3600) -> None:
+        super().__init__(max_size, ttl)
+        self.path = path
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "key TEXT PRIMARY KEY, cached_at REAL NOT NULL, accessed_at REAL NOT NULL, completion TEXT NOT NULL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS ix_response_cache_accessed_at ON response_cache (accessed_at)")
+            self.connection.commit()
+
+    def get(self, key: str, ttl: float = None) -> dict:
+        ttl = self.ttl if self.ttl is not None else ttl
+        now = time.time()
+
+        with self.lock:
+            row = self.connection.execute("SELECT cached_at, completion FROM response_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or (ttl is not None and now - row[0] > ttl):
+                if row is not None:
+                    self.connection.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                    self.connection.commit()
+                self.misses += 1
+                return None
+
+            self.connection.execute("UPDATE response_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+            self.hits += 1
+            return json.loads(row[1])
+
+    def set(self, key: str, data: dict):
+        now = time.time()
+
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO response_cache (key, cached_at, accessed_at, completion) VALUES (?, ?, ?, ?)",
+                (key, now, now, json.dumps(data, ensure_ascii=False))
+            )
+            # Evict least recently used entries
+            cursor = self.connection.execute(
+                "DELETE FROM response_cache WHERE key IN "
+                "(SELECT key FROM response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_size,)
+            )
+            self.evictions += cursor.rowcount
+            self.connection.commit()
+
+    def remove(self, key: str):
+        with self.lock:
+            self.connection.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+            self.connection.commit()
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM response_cache")
+            self.connection.commit()
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            size = self.connection.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+            total = self.hits + self.misses
+            return {
+                "size": size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0
+            }
+
+    def close(self):
+        self.connection.close()
@@ -1,11 +1,33 @@
+from __future__ import annotations
+import asyncio
+from contextlib import asynccontextmanager, contextmanager, AsyncExitStack
 from copy import deepcopy
 import json
+import logging
+import time
 from datetime import datetime
-from openai import Completion, ChatCompletion
-from openai.openai_object import OpenAIObject
-from sqlalchemy import create_engine, select, delete
+from typing import TYPE_CHECKING, AsyncIterator, Callable
+from sqlalchemy import select, insert, update, delete
 from sqlalchemy.orm import sessionmaker, Session
-from .models import Context, CompletionLog, create_tables
+from .cache import ResponseCache
+from .lock import KeyedLock
+from .logwriter import CompletionLogWriter
+from .logpolicy import LogPolicy
+from .tokenizer import TokenCounter, get_context_tokens
+from .ratelimit import RateLimiter, RetryPolicy
+from .instrumentation import ChatObserver
+from .pool import ConnectionPool
+from .summary import Summarizer
+from .memory import LongTermMemory, get_memory_path
+from .models import Context, CompletionLog, get_engine, prepare_tables, prepare_tables_async, is_async_url, is_same_database
+from .store import ContextStore
+
+# openai, asyncio extension of SQLAlchemy and dialects are imported on first use to make importing faster
+if TYPE_CHECKING:
+    from openai.openai_object import OpenAIObject
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = logging.getLogger(__name__)
 
 
 class CompletionException(Exception):
@@ -15,120 +37,456 @@ class CompletionException(Exception):
         self.completion_response = completion_response
 
 
-class ContextManager:
-    def __init__(
-        self,
-        timeout=300,
-        username: str = "Human",
-        agentname: str = "AI",
-        chat_description: str = None,
-        history_count: int = 10
-    ) -> None:
+class CompletionTimeoutException(CompletionException):
+    # Raised when the turn doesn't complete by the deadline. Context and log are not updated
+    def __init__(self, *args: object, completion_response=None) -> None:
+        super().__init__(*args, completion_response=completion_response)
 
-        self.timeout = timeout
-        self.username = username
-        self.agentname = agentname
-        self.chat_description = chat_description or ""
-        self.history_count = history_count
 
-    def get(self, session: Session, key: str) -> Context:
-        stmt = select(Context).where(Context.key == key)
-        context = session.execute(stmt).scalars().one_or_none()
-
-        if not context:
-            context = Context(
-                key=key,
-                username=self.username,
-                agentname=self.agentname,
-                chat_description=self.chat_description,
-                history_count=self.history_count,
-                histories="[]"
-            )
-            session.add(context)
-            session.commit()
+class ChatResult:
+    # Result of each item of chat_many()
+    def __init__(self, index: int, context_key: str, text: str) -> None:
+        self.index = index
+        self.context_key = context_key
+        self.text = text
+        self.response_text = None
+        self.params = None
+        self.completion = None
+        self.error = None
+
+
+class ContextManager(ContextStore):
+    # Store contexts in the database of SQLAlchemy session
+    # Max count of keys in an IN clause of get_many()
+    IN_CLAUSE_SIZE = 500
 
-        elif datetime.utcnow().timestamp() - context.updated_at > self.timeout:
+    def make_select_stmt(self, key: str):
+        # Select columns instead of entity not to bind the context to session.
+        # The context is a plain object and it's written back by upsert in set()
+        return select(Context.__table__).where(Context.key == key)
+
+    def make_context_from_row(self, key: str, row) -> Context:
+        if row is None:
+            return self.make_context(key)
+
+        context = Context(**row)
+        if datetime.utcnow().timestamp() - context.updated_at > self.timeout:
             context.clear_history()
 
         return context
 
-    def set(self, session: Session, context: Context):
+    def make_upsert_stmt(self, dialect_name: str):
+        # Statement without values to execute with a dict or a list of dicts (executemany)
+        columns = [c.name for c in Context.__table__.columns if c.name not in ("id", "key")]
+
+        if dialect_name == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+            stmt = sqlite_insert(Context)
+            return stmt.on_conflict_do_update(
+                index_elements=[Context.key],
+                set_={k: stmt.excluded[k] for k in columns}
+            )
+        elif dialect_name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+            stmt = postgresql_insert(Context)
+            return stmt.on_conflict_do_update(
+                index_elements=[Context.key],
+                set_={k: stmt.excluded[k] for k in columns}
+            )
+        elif dialect_name in ("mysql", "mariadb"):
+            from sqlalchemy.dialects.mysql import insert as mysql_insert
+            stmt = mysql_insert(Context)
+            return stmt.on_duplicate_key_update(
+                **{k: stmt.inserted[k] for k in columns}
+            )
+
+        # Other dialects don't support upsert
+        return None
+
+    def make_values(self, context: Context) -> dict:
         context.updated_at = int(datetime.utcnow().timestamp())
+        values = context.to_dict()
+        del values["id"]
+        return values
+
+    def make_select_many_stmts(self, keys: list[str]) -> list:
+        return [
+            select(Context.__table__).where(Context.key.in_(keys[i:i + self.IN_CLAUSE_SIZE]))
+            for i in range(0, len(keys), self.IN_CLAUSE_SIZE)
+        ]
+
+    def make_contexts_from_rows(self, keys: list[str], contexts: dict, rows) -> dict[str, Context]:
+        rows = {r["key"]: r for r in rows}
+        for key in keys:
+            if key not in contexts:
+                contexts[key] = self.make_context_from_row(key, rows.get(key))
+        return contexts
 
-        stmt = select(Context).where(Context.key == context.key)
-        if not session.execute(stmt).scalars().one_or_none():
-            session.add(context)
+    def get(self, session: Session, key: str) -> Context:
+        context = self.get_cached(key)
+        if context:
+            return self.make_context_from_row(key, context.to_dict())
 
-        session.commit()
+        row = session.execute(self.make_select_stmt(key)).mappings().one_or_none()
+        return self.make_context_from_row(key, row)
 
-    def reset(
-        self,
-        session: Session,
-        key: str,
-        username: str = None,
-        agentname: str = None,
-        chat_description: str = None,
-        history_count: int = None
-    ):
-        context = self.get(session, key)
-
-        if username:
-            context.username = username
-        if agentname:
-            context.agentname = agentname
-        if chat_description:
-            context.chat_description = chat_description
-        if history_count:
-            context.history_count = history_count
-        context.clear_history()
-
-        self.set(session, context)
+    def set(self, session: Session, context: Context, commit: bool = True):
+        # Pass commit=False to write in the transaction of the caller
+        values = self.make_values(context)
+
+        stmt = self.make_upsert_stmt(session.get_bind().dialect.name)
+        if stmt is not None:
+            session.execute(stmt, values)
+        else:
+            if session.execute(select(Context.id).where(Context.key == context.key)).first():
+                session.execute(update(Context).where(Context.key == context.key).values(**values))
+            else:
+                session.execute(insert(Context).values(**values))
+
+        if commit:
+            session.commit()
+        self.put_cache(context)
+
+    def get_many(self, session: Session, keys: list[str]) -> dict[str, Context]:
+        contexts = {}
+        for key in keys:
+            context = self.get_cached(key)
+            if context:
+                contexts[key] = self.make_context_from_row(key, context.to_dict())
+
+        missing_keys = [k for k in keys if k not in contexts]
+        rows = []
+        for stmt in self.make_select_many_stmts(missing_keys):
+            rows.extend(session.execute(stmt).mappings().all())
+
+        return self.make_contexts_from_rows(missing_keys, contexts, rows)
+
+    def set_many(self, session: Session, contexts: list[Context], commit: bool = True):
+        if not contexts:
+            return
+
+        stmt = self.make_upsert_stmt(session.get_bind().dialect.name)
+        if stmt is None:
+            for context in contexts:
+                self.set(session, context, commit=False)
+            if commit:
+                session.commit()
+            return
+
+        session.execute(stmt, [self.make_values(c) for c in contexts])
+        if commit:
+            session.commit()
+        for context in contexts:
+            self.put_cache(context)
 
     def remove(self, session: Session, key: str):
-        context = self.get(session, key)
-        session.delete(context)
+        session.execute(delete(Context).where(Context.key == key))
         session.commit()
+        self.remove_cache(key)
+        self.notify_remove(key)
 
     def remove_all(self, session: Session):
         session.execute(delete(Context))
         session.commit()
+        self.remove_cache()
+        self.notify_remove()
+
+    def compact_histories(self, session: Session, retention: int = None, batch_size: int = 1000) -> int:
+        # Trim histories of the contexts stored before retention is configured
+        retention = retention or self.history_retention
+        if not retention:
+            return 0
+
+        compacted_count = 0
+        last_id = 0
+        while True:
+            stmt = select(Context.id, Context.key, Context.history_count, Context.histories) \
+                .where(Context.id > last_id).order_by(Context.id).limit(batch_size)
+            rows = session.execute(stmt).all()
+            if not rows:
+                break
+
+            for row in rows:
+                last_id = row.id
+                history_list = json.loads(row.histories) if row.histories else []
+                row_retention = max(retention, row.history_count)
+                if len(history_list) <= row_retention:
+                    continue
+
+                session.execute(
+                    update(Context).where(Context.id == row.id)
+                    .values(histories=json.dumps(history_list[-row_retention:], ensure_ascii=False))
+                )
+                if self.cache is not None:
+                    self.cache.remove(row.key)
+                compacted_count += 1
+
+            session.commit()
+
+        return compacted_count
+
+    async def get_async(self, session: AsyncSession, key: str) -> Context:
+        context = self.get_cached(key)
+        if context:
+            return self.make_context_from_row(key, context.to_dict())
+
+        row = (await session.execute(self.make_select_stmt(key))).mappings().one_or_none()
+        return self.make_context_from_row(key, row)
+
+    async def set_async(self, session: AsyncSession, context: Context, commit: bool = True):
+        values = self.make_values(context)
+
+        stmt = self.make_upsert_stmt(session.get_bind().dialect.name)
+        if stmt is not None:
+            await session.execute(stmt, values)
+        else:
+            if (await session.execute(select(Context.id).where(Context.key == context.key))).first():
+                await session.execute(update(Context).where(Context.key == context.key).values(**values))
+            else:
+                await session.execute(insert(Context).values(**values))
+
+        if commit:
+            await session.commit()
+        self.put_cache(context)
+
+    async def get_many_async(self, session: AsyncSession, keys: list[str]) -> dict[str, Context]:
+        contexts = {}
+        for key in keys:
+            context = self.get_cached(key)
+            if context:
+                contexts[key] = self.make_context_from_row(key, context.to_dict())
+
+        missing_keys = [k for k in keys if k not in contexts]
+        rows = []
+        for stmt in self.make_select_many_stmts(missing_keys):
+            rows.extend((await session.execute(stmt)).mappings().all())
+
+        return self.make_contexts_from_rows(missing_keys, contexts, rows)
+
+    async def set_many_async(self, session: AsyncSession, contexts: list[Context], commit: bool = True):
+        if not contexts:
+            return
+
+        stmt = self.make_upsert_stmt(session.get_bind().dialect.name)
+        if stmt is None:
+            for context in contexts:
+                await self.set_async(session, context, commit=False)
+            if commit:
+                await session.commit()
+            return
+
+        await session.execute(stmt, [self.make_values(c) for c in contexts])
+        if commit:
+            await session.commit()
+        for context in contexts:
+            self.put_cache(context)
+
+    async def remove_async(self, session: AsyncSession, key: str):
+        await session.execute(delete(Context).where(Context.key == key))
+        await session.commit()
+        self.remove_cache(key)
+        self.notify_remove(key)
+
+    async def remove_all_async(self, session: AsyncSession):
+        await session.execute(delete(Context))
+        await session.commit()
+        self.remove_cache()
+        self.notify_remove()
 
 
 class ContextualChatBase:
     DEFAULT_MODEL = "text-davinci-003"
+    # Name of API class in openai or the class itself
+    COMPLETION_API = "Completion"
+    TEMPLATE_CACHE_SIZE = 1000
 
     def __init__(
         self,
         api_key: str,
         connection_str: str = "sqlite:///gpt3contextual.db",
-        context_manager: ContextManager = None,
+        context_manager: ContextStore = None,
         *,
+        async_connection_str: str = None,
+        key_lock: KeyedLock = None,
+        log_writer: CompletionLogWriter = None,
+        log_policy: LogPolicy = None,
+        token_budget: bool = False,
+        tokenizer: Callable[[str], int] = None,
+        context_tokens: int = None,
+        response_cache: ResponseCache = None,
+        rate_limiter: RateLimiter = None,
+        retry_policy: RetryPolicy = None,
+        observers: list[ChatObserver] = None,
+        connection_pool: ConnectionPool = None,
+        summarizer: Summarizer = None,
+        summary_threshold: int = None,
+        memory: LongTermMemory = None,
+        check_schema: bool = True,
         model: str = None,
         temperature: float = 0.5,
         max_tokens: int = 2000,
         **completion_params
     ) -> None:
 
+        # Static parts of requests built once for the configuration. See get_base_params()
+        self._base_params = None
+        self.templates = {}
         self.api_key = api_key
         self.connection_str = connection_str
-        self.engine = create_engine(self.connection_str)
-        create_tables(self.engine)
-        self.get_session = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        # connection_str with async driver (e.g. sqlite+aiosqlite://, postgresql+asyncpg://) is used by chat()
+        # without sync engine. async_connection_str is the async driver for the same database as connection_str
+        sync_connection_str = self.connection_str
+        self.async_connection_str = async_connection_str
+        if self.connection_str is not None and is_async_url(self.connection_str):
+            if self.async_connection_str and self.async_connection_str != self.connection_str:
+                raise ValueError("async_connection_str can't be set when connection_str uses async driver")
+            self.async_connection_str = self.connection_str
+            sync_connection_str = None
+        elif self.async_connection_str and (self.connection_str is None or not is_same_database(self.connection_str, self.async_connection_str)):
+            raise ValueError("async_connection_str must be the same database as connection_str. Set the URL of async driver to connection_str to use only async engine")
+        # Engine and its connection pool are shared by the instances for the same connection_str.
+        # Set check_schema=False to skip creating and migrating tables when the schema is managed elsewhere.
+        # connection_str=None makes the instance that only requests completions (e.g. routes of ModelRouter)
+        self.check_schema = check_schema
+        if sync_connection_str is not None:
+            self.engine = get_engine(sync_connection_str)
+            prepare_tables(self.engine, self.check_schema)
+            self.get_session = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        else:
+            self.engine = None
+            self.get_session = None
+        # Async storage used by chat() when configured
+        if self.async_connection_str:
+            from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+            self.async_engine = create_async_engine(self.async_connection_str)
+            self.get_async_session = async_sessionmaker(autoflush=False, expire_on_commit=False, bind=self.async_engine)
+        else:
+            self.async_engine = None
+            self.get_async_session = None
+        # Process turns for the same context key one by one when the lock is set
+        self.key_lock = key_lock
+        # Write logs in background by bulk insert instead of committing each log in the turn
+        self.log_writer = log_writer
+        # Compress, sample and prune completion logs
+        self.log_policy = log_policy
+        if self.log_writer is not None:
+            if self.log_writer.get_session is None and self.get_session is None:
+                raise ValueError("Pass get_session of sync driver to CompletionLogWriter when connection_str uses async driver")
+            if self.log_writer.log_policy is None:
+                self.log_writer.log_policy = self.log_policy
+            self.log_writer.start(self.log_writer.get_session or self.get_session)
+        # Include histories as many as fit in the context window of model instead of history_count
+        self.token_budget = token_budget
+        self.token_counter = TokenCounter(tokenizer)
+        self.context_tokens = context_tokens
+        # Reuse the completion for the same parameters
+        self.response_cache = response_cache
+        # Throttle requests not to exceed the quota and retry on temporary errors
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy
+        # Notified the elapsed time of each stage of turn (e.g. MetricsAggregator)
+        self.observers = observers or []
+        # Reuse HTTP connections to OpenAI API in chat() instead of opening new session for each request
+        self.connection_pool = connection_pool
+        # Fold old histories into the summary of context when they exceed summary_threshold.
+        # Summarizer or function(summary, histories, context) -> str
+        self.summarizer = summarizer if summarizer is None or isinstance(summarizer, Summarizer) else Summarizer(summarizer)
+        self.summary_threshold = summary_threshold
+        # Recall the past turns relevant to the request into prompt, including those out of history_count
+        self.memory = memory
+        if self.memory is not None and self.memory.path is None and self.connection_str is not None:
+            self.memory.path = get_memory_path(self.connection_str)
         self.context_manager = context_manager or ContextManager()
+        if self.memory is not None:
+            # Forget the turns of the removed and reset contexts
+            self.context_manager.add_remove_listener(self.memory.remove)
         self.model = model or self.DEFAULT_MODEL
         self.temperature = temperature
         self.max_tokens = max_tokens
         self.completion_params = completion_params
 
+    # Changing these settings rebuilds the base params in the next request.
+    # Assign new dict to completion_params instead of updating it or call invalidate_templates()
+    @property
+    def api_key(self) -> str:
+        return self._api_key
+
+    @api_key.setter
+    def api_key(self, value: str):
+        self._api_key = value
+        self.invalidate_templates()
+
+    @property
+    def model(self) -> str:
+        return self._model
+
+    @model.setter
+    def model(self, value: str):
+        self._model = value
+        self.invalidate_templates()
+
+    @property
+    def temperature(self) -> float:
+        return self._temperature
+
+    @temperature.setter
+    def temperature(self, value: float):
+        self._temperature = value
+        self.invalidate_templates()
+
+    @property
+    def max_tokens(self) -> int:
+        return self._max_tokens
+
+    @max_tokens.setter
+    def max_tokens(self, value: int):
+        self._max_tokens = value
+        self.invalidate_templates()
+
+    @property
+    def completion_params(self) -> dict:
+        return self._completion_params
+
+    @completion_params.setter
+    def completion_params(self, value: dict):
+        self._completion_params = value
+        self.invalidate_templates()
+
+    def invalidate_templates(self):
+        self._base_params = None
+        self.templates.clear()
+
+    def get_base_params(self) -> dict:
+        if self._base_params is None:
+            params = deepcopy(self.completion_params) if self.completion_params else {}
+            params["api_key"] = self.api_key
+            params["model"] = self.model
+            params["temperature"] = self.temperature
+            params["max_tokens"] = self.max_tokens
+            self._base_params = params
+        return self._base_params
+
+    def get_template(self, key: tuple):
+        return self.templates.get(key)
+
+    def put_template(self, key: tuple, value):
+        # Templates are keyed by persona of context. Drop all when too many personas are used
+        if len(self.templates) >= self.TEMPLATE_CACHE_SIZE:
+            self.templates.clear()
+        self.templates[key] = value
+        return value
+
+    def get_stop(self, context: Context) -> list[str]:
+        key = ("stop", context.username, context.agentname)
+        return self.get_template(key) or \
+            self.put_template(key, [f"{context.username}:", f"{context.agentname}:"])
+
     def make_params(self, context: Context, *, prompt: str = None, messages: list[dict[str, str]] = None, completion_params: dict = None) -> dict:
-        params = deepcopy(self.completion_params) if self.completion_params else {}
+        # Copy nested values (e.g. logit_bias) not to share the cached ones with the returned params
+        params = {k: v.copy() if isinstance(v, (dict, list)) else v for k, v in self.get_base_params().items()}
 
-        params["api_key"] = self.api_key
-        params["model"] = self.model
-        params["temperature"] = self.temperature
-        params["max_tokens"] = self.max_tokens
         if prompt:
-            params["stop"] = [f"{context.username}:", f"{context.agentname}:"]
+            params["stop"] = list(self.get_stop(context))
             params["prompt"] = prompt
         else:
             params["messages"] = messages
@@ -140,39 +498,496 @@ class ContextualChatBase:
 
         return params
 
-    def update_context(self, session: Session, context: Context, request_text: str, response_text: str, completion: dict):
+    def get_histories_within_budget(self, context: Context, fixed_tokens: int, tokens_per_history: int = 0) -> list[str]:
+        # Tokens left for histories after completion and the fixed part of prompt
+        max_tokens = (self.context_tokens or get_context_tokens(self.model)) - self.max_tokens - fixed_tokens
+        if max_tokens <= 0:
+            return []
+        return context.get_histories_within_tokens(max_tokens, self.token_counter.count, tokens_per_history)
+
+    def add_turn_histories(self, context: Context, request_text: str, response_text: str, completion: dict):
+        retention = self.context_manager.get_retention(context)
+        if retention and self.summary_threshold and self.summarizer is not None:
+            # Don't drop histories before they are summarized
+            retention = max(retention, self.summary_threshold + 2)
+        context.add_histories(self.format_turn_histories(context, request_text, response_text, completion), retention)
+
+    def format_turn_histories(self, context: Context, request_text: str, response_text: str, completion: dict) -> list[str]:
+        if completion["object"] == "chat.completion":
+            return [request_text, response_text]
+        else:
+            return [f"{context.username}:{request_text}", f"{context.agentname}:{response_text}"]
+
+    def get_folding_count(self, context: Context) -> int:
+        # Count of the oldest histories to be folded into the summary
+        if self.summarizer is None or not self.summary_threshold:
+            return 0
+
+        history_count = len(context.get_history_list())
+        if history_count <= self.summary_threshold:
+            return 0
+
+        # Keep recent histories used in prompt
+        if 0 < context.history_count < self.summary_threshold:
+            return history_count - context.history_count
+        return history_count - self.summary_threshold // 2
+
+    def summarize_context(self, context: Context):
+        count = self.get_folding_count(context)
+        if not count:
+            return
+
+        try:
+            with self.measure("summarize", context.key):
+                summary = self.summarizer.summarize(context.summary, context.get_history_list()[:count], context)
+        except Exception as ex:
+            # Histories are summarized in the next turn
+            logger.error(f"Failed to summarize histories: {ex}")
+            return
+
+        context.fold_histories(count, summary)
+
+    async def summarize_context_async(self, context: Context):
+        count = self.get_folding_count(context)
+        if not count:
+            return
+
+        try:
+            with self.measure("summarize", context.key):
+                summary = await self.summarizer.summarize_async(context.summary, context.get_history_list()[:count], context)
+        except Exception as ex:
+            logger.error(f"Failed to summarize histories: {ex}")
+            return
+
+        context.fold_histories(count, summary)
+
+    def get_memory_text(self, context: Context, request_text: str, response_text: str) -> str:
+        return f"{context.username}:{request_text}\n{context.agentname}:{response_text}"
+
+    def memorize(self, context: Context, request_text: str, response_text: str, completion: dict):
+        # Call after the turn is committed not to recall the turns rolled back
+        if self.memory is None or not response_text:
+            return
+
+        try:
+            self.memory.add(
+                context.key,
+                self.get_memory_text(context, request_text, response_text),
+                self.format_turn_histories(context, request_text, response_text, completion)
+            )
+        except Exception as ex:
+            # Context is saved without memory
+            logger.error(f"Failed to memorize the turn: {ex}")
+
+    async def memorize_async(self, context: Context, request_text: str, response_text: str, completion: dict):
+        # Embed and write the index in a thread
+        if self.memory is None or not response_text:
+            return
+
+        try:
+            await self.memory.add_async(
+                context.key,
+                self.get_memory_text(context, request_text, response_text),
+                self.format_turn_histories(context, request_text, response_text, completion)
+            )
+        except Exception as ex:
+            logger.error(f"Failed to memorize the turn: {ex}")
+
+    def recall(self, context: Context, text: str):
+        # Set the past turns relevant to text to context.memories. Turns in histories of prompt are excluded
+        if self.memory is None:
+            return
+
+        try:
+            with self.measure("recall", context.key):
+                context.memories = self.memory.search(context.key, text, exclude=context.get_histories_as_list())
+        except Exception as ex:
+            logger.error(f"Failed to recall the past turns: {ex}")
+
+    async def recall_async(self, context: Context, text: str):
+        # Skipped when it takes longer than memory.timeout
+        if self.memory is None:
+            return
+
+        try:
+            with self.measure("recall", context.key):
+                context.memories = await self.memory.search_async(context.key, text, exclude=context.get_histories_as_list())
+        except Exception as ex:
+            logger.error(f"Failed to recall the past turns: {ex}")
+
+    def add_turn(self, context: Context, request_text: str, response_text: str, completion: dict):
+        # Add request and response to context and fold the old histories into the summary
         if response_text:
-            # Add request and response to context
-            if completion["object"] == "chat.completion":
-                context.add_history(request_text)
-                context.add_history(response_text)
-            else:
-                context.add_history(f"{context.username}:{request_text}")
-                context.add_history(f"{context.agentname}:{response_text}")
-            self.context_manager.set(session, context)
+            self.add_turn_histories(context, request_text, response_text, completion)
+            self.summarize_context(context)
+
+    async def add_turn_async(self, context: Context, request_text: str, response_text: str, completion: dict):
+        if response_text:
+            self.add_turn_histories(context, request_text, response_text, completion)
+            await self.summarize_context_async(context)
+
+    def write_context(self, session: Session, context: Context, response_text: str, completion: dict, commit: bool = True):
+        if response_text:
+            self.context_manager.set(session, context, commit=commit)
 
         else:
             # Reset histories to start new context in next turn
-            self.context_manager.reset(session, context.key)
+            self.context_manager.reset(session, context.key, commit=commit, forget=False)
+            raise CompletionException(
+                "Completion returns an error",
+                completion_response=completion
+            )
+
+    async def write_context_async(self, session: AsyncSession, context: Context, response_text: str, completion: dict, commit: bool = True):
+        if response_text:
+            await self.context_manager.set_async(session, context, commit=commit)
+
+        else:
+            await self.context_manager.reset_async(session, context.key, commit=commit, forget=False)
             raise CompletionException(
                 "Completion returns an error",
                 completion_response=completion
             )
 
-    async def execute_completion_async(self, session: Session, context: Context, text: str, **completion_params):
-        raise NotImplementedError("execute_completion_async() in not implemented")
+    def update_context(self, session: Session, context: Context, request_text: str, response_text: str, completion: dict, commit: bool = True):
+        self.add_turn(context, request_text, response_text, completion)
+        self.write_context(session, context, response_text, completion, commit=commit)
+
+    async def update_context_async(self, session: AsyncSession, context: Context, request_text: str, response_text: str, completion: dict, commit: bool = True):
+        await self.add_turn_async(context, request_text, response_text, completion)
+        await self.write_context_async(session, context, response_text, completion, commit=commit)
+
+    def estimate_tokens(self, params: dict) -> int:
+        if self.rate_limiter is None or not self.rate_limiter.tokens_per_minute:
+            return 0
+
+        if "prompt" in params:
+            prompt_tokens = self.token_counter.tokenizer(params["prompt"])
+        else:
+            prompt_tokens = sum(self.token_counter.tokenizer(m["content"]) for m in params["messages"])
+
+        return prompt_tokens + (params.get("max_tokens") or 0)
+
+    def make_request_kwargs(self, params: dict) -> dict:
+        if self.connection_pool is None or "request_timeout" in params:
+            return params
+
+        request_timeout = self.connection_pool.get_request_timeout()
+        if request_timeout is None:
+            return params
+
+        return {**params, "request_timeout": request_timeout}
+
+    def get_completion_api(self):
+        if isinstance(self.COMPLETION_API, str):
+            import openai
+            return getattr(openai, self.COMPLETION_API)
+        return self.COMPLETION_API
+
+    async def request_completion_async(self, params: dict) -> OpenAIObject:
+        tokens = self.estimate_tokens(params)
+        start_time = time.monotonic()
+        attempt = 0
+        kwargs = self.make_request_kwargs(params)
+
+        while True:
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire_async(tokens)
+
+            try:
+                if self.connection_pool is None:
+                    return await self.get_completion_api().acreate(**kwargs)
+
+                # OpenAI library uses the session set to the context var
+                import openai
+                token = openai.aiosession.set(await self.connection_pool.get_session())
+                try:
+                    return await self.get_completion_api().acreate(**kwargs)
+                finally:
+                    openai.aiosession.reset(token)
+
+            except Exception as ex:
+                delay = self.retry_policy.get_delay(ex, attempt, time.monotonic() - start_time) \
+                    if self.retry_policy is not None else None
+                if delay is None:
+                    raise
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def request_completion(self, params: dict) -> OpenAIObject:
+        tokens = self.estimate_tokens(params)
+        start_time = time.monotonic()
+        attempt = 0
+        # Sync requests reuse the connections by the session of OpenAI library for each thread
+        kwargs = self.make_request_kwargs(params)
+
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(tokens)
+
+            try:
+                return self.get_completion_api().create(**kwargs)
+
+            except Exception as ex:
+                delay = self.retry_policy.get_delay(ex, attempt, time.monotonic() - start_time) \
+                    if self.retry_policy is not None else None
+                if delay is None:
+                    raise
+
+            time.sleep(delay)
+            attempt += 1
+
+    async def create_completion_async(self, params: dict) -> OpenAIObject:
+        if self.response_cache is not None:
+            completion = self.response_cache.get_completion(params)
+            if completion is not None:
+                return completion
+
+        completion = await self.request_completion_async(params)
+
+        if self.response_cache is not None and "choices" in completion:
+            self.response_cache.set_completion(params, completion)
+
+        return completion
+
+    def create_completion(self, params: dict) -> OpenAIObject:
+        if self.response_cache is not None:
+            completion = self.response_cache.get_completion(params)
+            if completion is not None:
+                return completion
+
+        completion = self.request_completion(params)
+
+        if self.response_cache is not None and "choices" in completion:
+            self.response_cache.set_completion(params, completion)
+
+        return completion
+
+    @contextmanager
+    def measure(self, stage: str, context_key: str):
+        # Notify the elapsed time of the stage to the observers. Fill the yielded dict to add info
+        info = {}
+        if not self.observers:
+            yield info
+            return
+
+        start_time = time.perf_counter()
+        error = None
+        try:
+            yield info
+        except Exception as ex:
+            error = ex
+            raise
+        finally:
+            self.notify(stage, context_key, time.perf_counter() - start_time, info, error)
+
+    def notify(self, stage: str, context_key: str, elapsed: float, info: dict = None, error: Exception = None):
+        for o in self.observers:
+            try:
+                o.on_stage(stage, context_key, elapsed, info or {}, error)
+            except Exception as ex:
+                logger.error(f"Error in observer at {stage}: {ex}")
+
+    def get_prompt_size(self, params: dict) -> int:
+        if "prompt" in params:
+            return len(params["prompt"])
+        return sum(len(m["content"]) for m in params["messages"])
+
+    def get_completion_info(self, response_text: str, completion: dict) -> dict:
+        info = {"response_size": len(response_text or "")}
+        usage = completion.get("usage") if completion else None
+        if usage:
+            for k in ["prompt_tokens", "completion_tokens", "total_tokens"]:
+                info[k] = usage.get(k, 0)
+        return info
+
+    def get_memories_text(self, context: Context) -> str:
+        return "\n".join(context.memories)
+
+    def make_request_params(self, context: Context, text: str, completion_params: dict) -> dict:
+        raise NotImplementedError("make_request_params() in not implemented")
+
+    def get_response_text(self, context: Context, completion: OpenAIObject) -> str:
+        raise NotImplementedError("get_response_text() in not implemented")
+
+    def prepare_params(self, context: Context, text: str, completion_params: dict, stream: bool = False) -> dict:
+        with self.measure("build_prompt", context.key) as info:
+            params = self.make_request_params(context, text, completion_params)
+            if stream:
+                params["stream"] = True
+            if self.observers:
+                info["prompt_size"] = self.get_prompt_size(params)
+
+        if not params.get("api_key"):
+            raise CompletionException("api_key is missing", completion_response=None)
+
+        return params
+
+    async def execute_completion_async(self, session: Session, context: Context, text: str, **completion_params) -> tuple[str, dict, OpenAIObject]:
+        await self.recall_async(context, text)
+        params = self.prepare_params(context, text, completion_params)
+
+        with self.measure("completion", context.key) as info:
+            try:
+                completion = await self.create_completion_async(params)
+            except Exception as ex:
+                raise CompletionException(str(ex), completion_response=None)
+
+            response_text = self.get_response_text(context, completion)
+            if self.observers:
+                info.update(self.get_completion_info(response_text, completion))
+
+        return response_text, params, completion
+
+    def execute_completion(self, session: Session, context: Context, text: str, **completion_params) -> tuple[str, dict, OpenAIObject]:
+        self.recall(context, text)
+        params = self.prepare_params(context, text, completion_params)
+
+        with self.measure("completion", context.key) as info:
+            try:
+                completion = self.create_completion(params)
+            except Exception as ex:
+                raise CompletionException(str(ex), completion_response=None)
+
+            response_text = self.get_response_text(context, completion)
+            if self.observers:
+                info.update(self.get_completion_info(response_text, completion))
+
+        return response_text, params, completion
+
+    async def execute_completion_stream(self, session: Session, context: Context, text: str, **completion_params) -> tuple[dict, AsyncIterator[OpenAIObject]]:
+        await self.recall_async(context, text)
+        params = self.prepare_params(context, text, completion_params, stream=True)
+
+        try:
+            stream = await self.request_completion_async(params)
+        except Exception as ex:
+            raise CompletionException(str(ex), completion_response=None)
+
+        return params, stream
+
+    def get_stream_delta(self, chunk: OpenAIObject) -> str:
+        raise NotImplementedError("get_stream_delta() in not implemented")
+
+    def make_stream_completion(self, chunk: OpenAIObject, response_text: str) -> dict:
+        raise NotImplementedError("make_stream_completion() in not implemented")
 
-    def execute_completion(self, session: Session, context: Context, text: str, **completion_params):
-        raise NotImplementedError("execute_completion() in not implemented")
+    def get_deadline(self, timeout: float = None, deadline: float = None) -> float:
+        # Deadline of the turn in time.monotonic(). deadline is UNIX time (e.g. expiry of reply token)
+        deadlines = []
+        if timeout is not None:
+            deadlines.append(time.monotonic() + timeout)
+        if deadline is not None:
+            deadlines.append(time.monotonic() + deadline - time.time())
+        return min(deadlines) if deadlines else None
+
+    def get_remaining_time(self, deadline: float) -> float:
+        if deadline is None:
+            return None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise CompletionTimeoutException("Deadline exceeded")
+        return remaining
+
+    async def run_until_deadline(self, aw, deadline: float):
+        # Cancel the awaitable (e.g. in-flight request to OpenAI API) when the deadline exceeded
+        if deadline is None:
+            return await aw
+
+        try:
+            remaining = self.get_remaining_time(deadline)
+        except CompletionTimeoutException:
+            if asyncio.iscoroutine(aw):
+                aw.close()
+            raise
+
+        try:
+            return await asyncio.wait_for(aw, remaining)
+        except asyncio.TimeoutError:
+            raise CompletionTimeoutException("Deadline exceeded")
+
+    @asynccontextmanager
+    async def hold_key_lock(self, context_key: str, deadline: float):
+        start_time = time.perf_counter()
+        async with AsyncExitStack() as stack:
+            # Convert only the timeout of lock wait. The errors in the turn are raised as they are
+            try:
+                await stack.enter_async_context(self.key_lock.acquire(context_key, timeout=self.get_remaining_time(deadline)))
+            except asyncio.TimeoutError:
+                raise CompletionTimeoutException("Deadline exceeded while waiting for the previous turn")
+            if self.observers:
+                self.notify("lock_wait", context_key, time.perf_counter() - start_time)
+            yield
+
+    async def finish_persisting(self, aw):
+        # Finish writing the turn even when the caller is cancelled not to leave half-written context
+        task = asyncio.ensure_future(aw)
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done():
+                await asyncio.wait([task])
+            raise
+
+    async def warmup(self, connections: int = None):
+        # Open connections to OpenAI API before the first requests
+        if self.connection_pool is None:
+            return
+        import openai
+        await self.connection_pool.warmup(
+            f"{openai.api_base}/models",
+            headers={"Authorization": f"Bearer {self.api_key}"},
+            connections=connections
+        )
+
+    async def aclose(self):
+        if self.connection_pool is not None:
+            await self.connection_pool.aclose()
+        if self.async_engine is not None:
+            await self.async_engine.dispose()
+
+    async def __aenter__(self):
+        await self.warmup()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+    async def chat(self, context_key: str, text: str, *, timeout: float = None, deadline: float = None, **completion_params) -> tuple[str, dict, OpenAIObject]:
+        # timeout (sec) or deadline (UNIX time) raises CompletionTimeoutException without updating context
+        deadline = self.get_deadline(timeout, deadline)
+
+        with self.measure("turn", context_key) as info:
+            if self.key_lock is None:
+                result = await self.process_chat(context_key, text, deadline=deadline, **completion_params)
+
+            else:
+                async with self.hold_key_lock(context_key, deadline):
+                    result = await self.process_chat(context_key, text, deadline=deadline, **completion_params)
+
+            if self.observers:
+                info["prompt_size"] = self.get_prompt_size(result[1])
+                info.update(self.get_completion_info(result[0], result[2]))
+
+            return result
+
+    async def process_chat(self, context_key: str, text: str, deadline: float = None, **completion_params) -> tuple[str, dict, OpenAIObject]:
+        if self.async_engine is not None:
+            return await self.chat_with_async_session(context_key, text, deadline=deadline, **completion_params)
 
-    async def chat(self, context_key: str, text: str, **completion_params) -> tuple[str, dict, OpenAIObject]:
         session = self.get_session()
 
         try:
-            context = self.context_manager.get(session, context_key)
-            response_text, params, completion = await self.execute_completion_async(session, context, text, **completion_params)
-            self.save_log(session, response_text, params, completion)
-            self.update_context(session, context, text, response_text, completion)
+            with self.measure("load_context", context_key):
+                context = self.context_manager.get(session, context_key)
+            response_text, params, completion = await self.run_until_deadline(
+                self.execute_completion_async(session, context, text, **completion_params), deadline
+            )
+            # Summarize on the event loop without blocking and write in one transaction
+            await self.run_until_deadline(self.add_turn_async(context, text, response_text, completion), deadline)
+            self.save_turn(session, context, text, response_text, params, completion, add_turn=False)
+            await self.memorize_async(context, text, response_text, completion)
             return response_text, params, completion
 
         except Exception as ex:
@@ -181,89 +996,531 @@ class ContextualChatBase:
         finally:
             session.close()
 
-    def chat_sync(self, context_key: str, text: str, **completion_params) -> tuple[str, dict, OpenAIObject]:
-        session = self.get_session()
+    async def prepare_async_session(self) -> AsyncSession:
+        await prepare_tables_async(self.async_engine, self.check_schema)
+
+        return self.get_async_session()
+
+    async def chat_with_async_session(self, context_key: str, text: str, deadline: float = None, **completion_params) -> tuple[str, dict, OpenAIObject]:
+        session = await self.prepare_async_session()
 
         try:
-            context = self.context_manager.get(session, context_key)
-            response_text, params, completion = self.execute_completion(session, context, text, **completion_params)
-            self.save_log(session, response_text, params, completion)
-            self.update_context(session, context, text, response_text, completion)
+            with self.measure("load_context", context_key):
+                context = await self.run_until_deadline(self.context_manager.get_async(session, context_key), deadline)
+            response_text, params, completion = await self.run_until_deadline(
+                self.execute_completion_async(session, context, text, **completion_params), deadline
+            )
+            # Summarization can be cancelled by the deadline. Only writing is shielded
+            await self.run_until_deadline(self.add_turn_async(context, text, response_text, completion), deadline)
+            await self.finish_persisting(self.save_turn_async(session, context, text, response_text, params, completion, add_turn=False))
+            await self.memorize_async(context, text, response_text, completion)
             return response_text, params, completion
 
         except Exception as ex:
             raise ex
 
         finally:
-            session.close()
+            await session.close()
 
-    def save_log(self, session: Session, response_text: str, params: dict, completion: dict):
-        history = CompletionLog(
-            created_at=int(datetime.utcnow().timestamp()),
-            prompt=params["prompt"] if "prompt" in params else json.dumps(params["messages"], ensure_ascii=False),
-            text=response_text,
-            parameters=json.dumps(params, ensure_ascii=False),
-            completion=json.dumps(completion, ensure_ascii=False)
-        )
-        session.add(history)
-        session.commit()
+    async def chat_stream(self, context_key: str, text: str, *, timeout: float = None, deadline: float = None, **completion_params) -> AsyncIterator[str]:
+        # When the deadline exceeded while streaming, the deltas already yielded are not saved to context
+        deadline = self.get_deadline(timeout, deadline)
 
+        if self.key_lock is None:
+            async for delta in self.process_chat_stream(context_key, text, deadline=deadline, **completion_params):
+                yield delta
+            return
 
-class ContextualChat(ContextualChatBase):
-    DEFAULT_MODEL = "text-davinci-003"
+        async with self.hold_key_lock(context_key, deadline):
+            async for delta in self.process_chat_stream(context_key, text, deadline=deadline, **completion_params):
+                yield delta
 
-    def make_prompt(self, context: Context, text: str) -> str:
-        return f"{context.chat_description}\n" + \
-               f"{context.get_histories()}\n" + \
-               f"{context.username}:{text}\n{context.agentname}:"
+    async def process_chat_stream(self, context_key: str, text: str, deadline: float = None, **completion_params) -> AsyncIterator[str]:
+        use_async_session = self.async_engine is not None
+        turn_start_time = time.perf_counter()
+        turn_info = {}
+        turn_error = None
+        session = await self.prepare_async_session() if use_async_session else self.get_session()
 
-    async def execute_completion_async(self, session: Session, context: Context, text: str, **completion_params) -> tuple[str, dict, OpenAIObject]:
-        prompt = self.make_prompt(context, text)
-        params = self.make_params(context, prompt=prompt, **(completion_params or {}))
+        try:
+            with self.measure("load_context", context_key):
+                if use_async_session:
+                    context = await self.context_manager.get_async(session, context_key)
+                else:
+                    context = self.context_manager.get(session, context_key)
+
+            params, stream = await self.run_until_deadline(
+                self.execute_completion_stream(session, context, text, **completion_params), deadline
+            )
 
-        if not params.get("api_key"):
-            raise CompletionException("api_key is missing", completion_response=None)
+            deltas = []
+            chunk = None
+            with self.measure("completion", context_key) as info:
+                start_time = time.perf_counter()
+                try:
+                    iterator = stream.__aiter__()
+                    while True:
+                        try:
+                            chunk = await self.run_until_deadline(iterator.__anext__(), deadline)
+                        except StopAsyncIteration:
+                            break
+                        delta = self.get_stream_delta(chunk)
+                        if delta:
+                            if not deltas:
+                                info["time_to_first_token"] = time.perf_counter() - start_time
+                            deltas.append(delta)
+                            yield delta
+                except CompletionTimeoutException:
+                    raise
+                except Exception as ex:
+                    raise CompletionException(str(ex), completion_response=None)
+                finally:
+                    # Close the response of OpenAI API when the stream is stopped in the middle
+                    if hasattr(stream, "aclose"):
+                        await stream.aclose()
+
+                # Persist the whole response after the stream ends
+                response_text = "".join(deltas).strip() or None
+                completion = self.make_stream_completion(chunk, response_text)
+                if self.observers:
+                    info.update(self.get_completion_info(response_text, completion))
+
+            await self.run_until_deadline(self.add_turn_async(context, text, response_text, completion), deadline)
+            if use_async_session:
+                await self.finish_persisting(self.save_turn_async(session, context, text, response_text, params, completion, add_turn=False))
+            else:
+                self.save_turn(session, context, text, response_text, params, completion, add_turn=False)
+            await self.memorize_async(context, text, response_text, completion)
+
+            if self.observers:
+                turn_info["prompt_size"] = self.get_prompt_size(params)
+                turn_info.update(self.get_completion_info(response_text, completion))
 
-        try:
-            completion = await Completion.acreate(**params)
         except Exception as ex:
-            raise CompletionException(str(ex), completion_response=None)
+            turn_error = ex
+            raise
 
-        response_text = \
-            completion["choices"][0]["text"].strip() \
-            if "choices" in completion else None
+        finally:
+            if use_async_session:
+                await session.close()
+            else:
+                session.close()
+            if self.observers:
+                self.notify("turn", context_key, time.perf_counter() - turn_start_time, turn_info, turn_error)
+
+    async def chat_many(self, items: list[tuple], concurrency: int = 10, batch_size: int = 100) -> AsyncIterator[ChatResult]:
+        # items: list of (context_key, text) or (context_key, text, completion_params)
+        # Results are yielded in the order of completion after their batch is committed. Turns for the same key run in the order of items
+        items = [(item[0], item[1], (item[2] if len(item) > 2 else None) or {}) for item in items]
+        use_async_session = self.async_engine is not None
+        session = await self.prepare_async_session() if use_async_session else self.get_session()
+        semaphore = asyncio.Semaphore(concurrency)
+        results = asyncio.Queue()
+        updated_contexts = {}
+        log_records = []
+        # Turns to memorize after the batch is committed
+        turns = []
+        tasks = []
+        # Key locks held until the last turn of the key is committed
+        key_locks = {}
+        finished_keys = []
+
+        async def process_key(contexts: dict, key: str, indexed_items: list[tuple]):
+            context = contexts[key]
+            try:
+                for index, (_, text, completion_params) in indexed_items:
+                    result = ChatResult(index, key, text)
+                    try:
+                        async with semaphore:
+                            result.response_text, result.params, result.completion = \
+                                await self.execute_completion_async(session, context, text, **completion_params)
+                        log_record = self.make_log_record(result.response_text, result.params, result.completion)
+                        if log_record is not None:
+                            log_records.append(log_record)
+
+                        if result.response_text:
+                            self.add_turn_histories(context, text, result.response_text, result.completion)
+                            await self.summarize_context_async(context)
+                            turns.append((context, text, result.response_text, result.completion))
+                        else:
+                            # Reset histories to start new context in next turn
+                            context.clear_history()
+                            result.error = CompletionException("Completion returns an error", completion_response=result.completion)
+                        updated_contexts[key] = context
+
+                    except Exception as ex:
+                        result.error = ex
+
+                    await results.put(result)
+            finally:
+                finished_keys.append(key)
+
+        async def release_key_locks(keys: list[str]):
+            for key in keys:
+                stack = key_locks.pop(key, None)
+                if stack is not None:
+                    await stack.aclose()
+
+        async def flush():
+            contexts = list(updated_contexts.values())
+            records = log_records[:]
+            committed_turns = turns[:]
+            # Updates of the finished keys are in this batch
+            done_keys = finished_keys[:]
+            updated_contexts.clear()
+            log_records.clear()
+            turns.clear()
+            finished_keys.clear()
+
+            try:
+                if not records and not contexts:
+                    return
+
+                # Write the logs and the contexts of the batch in one transaction
+                try:
+                    if use_async_session:
+                        written_count = await self.save_logs_async(session, records, commit=False)
+                        await self.context_manager.set_many_async(session, contexts, commit=False)
+                        await session.commit()
+                    else:
+                        written_count = self.save_logs(session, records, commit=False)
+                        self.context_manager.set_many(session, contexts, commit=False)
+                        session.commit()
+
+                except Exception:
+                    if use_async_session:
+                        await session.rollback()
+                    else:
+                        session.rollback()
+                    for context in contexts:
+                        self.context_manager.remove_cache(context.key)
+                    raise
+
+                if use_async_session:
+                    await self.prune_logs_async(session, written_count)
+                else:
+                    self.prune_logs(session, written_count)
+                for turn in committed_turns:
+                    await self.memorize_async(*turn)
+
+            finally:
+                await release_key_locks(done_keys)
+
+        async def flush_results(batch: list[ChatResult]) -> list[ChatResult]:
+            try:
+                await flush()
+            except Exception as ex:
+                # Turns of the batch are not saved
+                logger.error(f"Error in writing the batch of chat_many(): {ex}")
+                for result in batch:
+                    if result.error is None:
+                        result.error = ex
+            return batch
 
-        return response_text, params, completion
+        try:
+            keys = list(dict.fromkeys(item[0] for item in items))
+            if self.key_lock is not None:
+                # Lock the keys before loading not to overwrite the turns by chat() running at the same time.
+                # Sorted not to deadlock with the other chat_many()
+                for key in sorted(keys):
+                    stack = AsyncExitStack()
+                    await stack.enter_async_context(self.key_lock.acquire(key))
+                    key_locks[key] = stack
+
+            # Load all contexts at once
+            if use_async_session:
+                contexts = await self.context_manager.get_many_async(session, keys)
+            else:
+                contexts = self.context_manager.get_many(session, keys)
+
+            items_by_key = {}
+            for index, item in enumerate(items):
+                items_by_key.setdefault(item[0], []).append((index, item))
+            tasks = [asyncio.create_task(process_key(contexts, k, v)) for k, v in items_by_key.items()]
+
+            batch = []
+            for _ in range(len(items)):
+                batch.append(await results.get())
+                if len(batch) == batch_size:
+                    for result in await flush_results(batch):
+                        yield result
+                    batch = []
+            for result in await flush_results(batch):
+                yield result
 
-    def execute_completion(self, session: Session, context: Context, text: str, **completion_params) -> tuple[str, dict, OpenAIObject]:
-        prompt = self.make_prompt(context, text)
-        params = self.make_params(context, prompt=prompt, **(completion_params or {}))
+        finally:
+            for t in tasks:
+                t.cancel()
+            try:
+                # Write the turns finished before the iteration is stopped
+                await flush()
+            finally:
+                await release_key_locks(list(key_locks))
+                if use_async_session:
+                    await session.close()
+                else:
+                    session.close()
 
-        if not params.get("api_key"):
-            raise CompletionException("api_key is missing", completion_response=None)
+    def chat_sync(self, context_key: str, text: str, **completion_params) -> tuple[str, dict, OpenAIObject]:
+        if self.get_session is None:
+            raise ValueError("chat_sync() requires connection_str of sync driver")
+
+        with self.measure("turn", context_key) as info:
+            session = self.get_session()
+
+            try:
+                with self.measure("load_context", context_key):
+                    context = self.context_manager.get(session, context_key)
+                response_text, params, completion = self.execute_completion(session, context, text, **completion_params)
+                self.save_turn(session, context, text, response_text, params, completion)
+                self.memorize(context, text, response_text, completion)
+
+                if self.observers:
+                    info["prompt_size"] = self.get_prompt_size(params)
+                    info.update(self.get_completion_info(response_text, completion))
+                return response_text, params, completion
+
+            except Exception as ex:
+                raise ex
+
+            finally:
+                session.close()
+
+    def save_turn(self, session: Session, context: Context, text: str, response_text: str, params: dict, completion: dict, add_turn: bool = True):
+        # Write the log and the context of the turn in one transaction.
+        # add_turn=False when the turn is already added to context by add_turn_async()
+        committed = False
+        written_count = 0
+        try:
+            with self.measure("save_log", context.key):
+                written_count = self.save_log(session, response_text, params, completion, commit=False)
+            with self.measure("update_context", context.key):
+                try:
+                    if add_turn:
+                        self.add_turn(context, text, response_text, completion)
+                    self.write_context(session, context, response_text, completion, commit=False)
+                except CompletionException:
+                    # The context is reset for the error completion. Commit the reset with the log before raising
+                    session.commit()
+                    committed = True
+                    raise
+                session.commit()
+                committed = True
 
+        finally:
+            if committed:
+                self.prune_logs(session, written_count)
+            else:
+                # Nothing is written. Drop the context cached before commit
+                session.rollback()
+                self.context_manager.remove_cache(context.key)
+
+    async def save_turn_async(self, session: AsyncSession, context: Context, text: str, response_text: str, params: dict, completion: dict, add_turn: bool = True):
+        committed = False
+        written_count = 0
         try:
-            completion = Completion.create(**params)
-        except Exception as ex:
-            raise CompletionException(str(ex), completion_response=None)
+            with self.measure("save_log", context.key):
+                written_count = await self.save_log_async(session, response_text, params, completion, commit=False)
+            with self.measure("update_context", context.key):
+                try:
+                    if add_turn:
+                        await self.add_turn_async(context, text, response_text, completion)
+                    await self.write_context_async(session, context, response_text, completion, commit=False)
+                except CompletionException:
+                    await session.commit()
+                    committed = True
+                    raise
+                await session.commit()
+                committed = True
 
-        response_text = \
-            completion["choices"][0]["text"].strip() \
+        finally:
+            if committed:
+                await self.prune_logs_async(session, written_count)
+            else:
+                await session.rollback()
+                self.context_manager.remove_cache(context.key)
+
+    def make_log_record(self, response_text: str, params: dict, completion: dict) -> dict:
+        # None when the log is sampled out by log_policy
+        if self.log_policy is not None:
+            return self.log_policy.make_record(response_text, params, completion)
+
+        return {
+            "created_at": int(datetime.utcnow().timestamp()),
+            "prompt": params["prompt"] if "prompt" in params else json.dumps(params["messages"], ensure_ascii=False),
+            # Error completions have no text
+            "text": response_text or "",
+            "model": params.get("model"),
+            "parameters": json.dumps(params, ensure_ascii=False),
+            "completion": json.dumps(completion, ensure_ascii=False)
+        }
+
+    def save_log(self, session: Session, response_text: str, params: dict, completion: dict, commit: bool = True) -> int:
+        # Returns the count of logs written in the session. With commit=False, the caller commits and prunes
+        record = self.make_log_record(response_text, params, completion)
+        if record is None:
+            return 0
+
+        if self.log_writer is not None:
+            self.log_writer.put(record)
+            return 0
+
+        session.add(CompletionLog(**record))
+        if commit:
+            session.commit()
+            self.prune_logs(session, 1)
+        return 1
+
+    def save_logs(self, session: Session, records: list[dict], commit: bool = True) -> int:
+        if not records:
+            return 0
+
+        if self.log_writer is not None:
+            for record in records:
+                self.log_writer.put(record)
+            return 0
+
+        session.execute(insert(CompletionLog), records)
+        if commit:
+            session.commit()
+            self.prune_logs(session, len(records))
+        return len(records)
+
+    async def save_logs_async(self, session: AsyncSession, records: list[dict], commit: bool = True) -> int:
+        if not records:
+            return 0
+
+        if self.log_writer is not None:
+            for record in records:
+                await self.log_writer.put_async(record)
+            return 0
+
+        await session.execute(insert(CompletionLog), records)
+        if commit:
+            await session.commit()
+            await self.prune_logs_async(session, len(records))
+        return len(records)
+
+    async def save_log_async(self, session: AsyncSession, response_text: str, params: dict, completion: dict, commit: bool = True) -> int:
+        record = self.make_log_record(response_text, params, completion)
+        if record is None:
+            return 0
+
+        if self.log_writer is not None:
+            await self.log_writer.put_async(record)
+            return 0
+
+        session.add(CompletionLog(**record))
+        if commit:
+            await session.commit()
+            await self.prune_logs_async(session, 1)
+        return 1
+
+    def prune_logs(self, session: Session, written_count: int):
+        # Logs are already saved so pruning errors don't fail the turn
+        if self.log_policy is not None and self.log_policy.should_prune(written_count):
+            try:
+                self.log_policy.prune(session)
+            except Exception as ex:
+                logger.error(f"Failed to prune completion logs: {ex}")
+                session.rollback()
+
+    async def prune_logs_async(self, session: AsyncSession, written_count: int):
+        if self.log_policy is not None and self.log_policy.should_prune(written_count):
+            try:
+                await self.log_policy.prune_async(session)
+            except Exception as ex:
+                logger.error(f"Failed to prune completion logs: {ex}")
+                await session.rollback()
+
+
+class ContextualChat(ContextualChatBase):
+    DEFAULT_MODEL = "text-davinci-003"
+    COMPLETION_API = "Completion"
+
+    def make_prompt(self, context: Context, text: str) -> str:
+        request_part = f"{context.username}:{text}\n{context.agentname}:"
+        summary_part = f"[Summary of the earlier conversation]\n{context.summary}\n" if context.summary else ""
+        memory_part = f"[Related past conversation]\n{self.get_memories_text(context)}\n" if context.memories else ""
+
+        if self.token_budget:
+            fixed_tokens = self.token_counter.count(context.chat_description) + self.token_counter.count(request_part) + 2
+            if summary_part:
+                fixed_tokens += self.token_counter.count(summary_part)
+            if memory_part:
+                fixed_tokens += self.token_counter.count(memory_part)
+            histories = "\n".join(self.get_histories_within_budget(context, fixed_tokens, tokens_per_history=1))
+        else:
+            histories = context.get_histories()
+
+        return f"{context.chat_description}\n" + \
+               summary_part + \
+               memory_part + \
+               f"{histories}\n" + \
+               request_part
+
+    def make_request_params(self, context: Context, text: str, completion_params: dict) -> dict:
+        prompt = self.make_prompt(context, text)
+        return self.make_params(context, prompt=prompt, completion_params=completion_params)
+
+    def get_response_text(self, context: Context, completion: OpenAIObject) -> str:
+        return completion["choices"][0]["text"].strip() \
             if "choices" in completion else None
 
-        return response_text, params, completion
+    def get_stream_delta(self, chunk: OpenAIObject) -> str:
+        return chunk["choices"][0]["text"] if chunk.get("choices") else None
+
+    def make_stream_completion(self, chunk: OpenAIObject, response_text: str) -> dict:
+        chunk = chunk or {}
+        completion = {
+            "id": chunk.get("id"),
+            "object": "text_completion",
+            "created": chunk.get("created"),
+            "model": chunk.get("model")
+        }
+        if response_text:
+            completion["choices"] = [{
+                "text": response_text,
+                "index": 0,
+                "finish_reason": chunk["choices"][0].get("finish_reason") if chunk.get("choices") else None
+            }]
+        return completion
 
 
 class ContextualChatGPT(ContextualChatBase):
     DEFAULT_MODEL = "gpt-3.5-turbo"
+    COMPLETION_API = "ChatCompletion"
+    # Tokens used by the format of each message
+    TOKENS_PER_MESSAGE = 4
 
-    def make_messages(self, context: Context, text: str) -> list[dict[str, str]]:
-        messages = []
-        messages.append({
+    def get_system_message(self, context: Context) -> dict[str, str]:
+        key = ("system", context.username, context.agentname, context.chat_description)
+        message = self.get_template(key) or self.put_template(key, {
             "role": "system",
             "content": f"[Roles]\nuser: {context.username}\nassistant: {context.agentname}\n\n[Conditions]\n{context.chat_description}"
         })
-        histories = context.get_histories_as_list()
+
+        if not context.summary and not context.memories:
+            # Copy not to share the cached message with the returned params
+            return message.copy()
+
+        # Summary changes in each compaction and memories in each turn so they are not cached
+        content = message["content"]
+        if context.summary:
+            content += f"\n\n[Summary of the earlier conversation]\n{context.summary}"
+        if context.memories:
+            content += f"\n\n[Related past conversation]\n{self.get_memories_text(context)}"
+        return {"role": "system", "content": content}
+
+    def make_messages(self, context: Context, text: str) -> list[dict[str, str]]:
+        messages = []
+        messages.append(self.get_system_message(context))
+
+        if self.token_budget:
+            fixed_tokens = self.token_counter.count(messages[0]["content"]) + self.token_counter.count(text) + self.TOKENS_PER_MESSAGE * 2 + 3
+            histories = self.get_histories_within_budget(context, fixed_tokens, tokens_per_history=self.TOKENS_PER_MESSAGE)
+        else:
+            histories = context.get_histories_as_list()
         turn_user = len(histories) % 2 == 0
         for i in range(len(histories)):
             messages.append({"role": "user" if turn_user else "assistant", "content": histories[i]})
@@ -273,41 +1530,35 @@ class ContextualChatGPT(ContextualChatBase):
 
         return messages
 
-    async def execute_completion_async(self, session: Session, context: Context, text: str, **completion_params) -> tuple[str, dict, OpenAIObject]:
+    def make_request_params(self, context: Context, text: str, completion_params: dict) -> dict:
         messages = self.make_messages(context, text)
-        params = self.make_params(context, messages=messages, **(completion_params or {}))
-
-        if not params.get("api_key"):
-            raise CompletionException("api_key is missing", completion_response=None)
-
-        try:
-            completion = await ChatCompletion.acreate(**params)
-        except Exception as ex:
-            raise CompletionException(str(ex), completion_response=None)
+        return self.make_params(context, messages=messages, completion_params=completion_params)
 
+    def get_response_text(self, context: Context, completion: OpenAIObject) -> str:
         response_text = \
             completion["choices"][0]["message"]["content"].strip() \
             if "choices" in completion else None
 
-        return response_text, params, completion
-
-    def execute_completion(self, session: Session, context: Context, text: str, **completion_params) -> tuple[str, dict, OpenAIObject]:
-        messages = self.make_messages(context, text)
-        params = self.make_params(context, messages=messages, **(completion_params or {}))
-
-        if not params.get("api_key"):
-            raise CompletionException("api_key is missing", completion_response=None)
-
-        try:
-            completion = ChatCompletion.create(**params)
-        except Exception as ex:
-            raise CompletionException(str(ex), completion_response=None)
+        if response_text and response_text.startswith(f"{context.agentname}:"):
+            response_text = response_text[len(context.agentname) + 1:].strip()
 
-        response_text = \
-            completion["choices"][0]["message"]["content"].strip() \
-            if "choices" in completion else None
+        return response_text
 
-        if response_text.startswith(f"{context.agentname}:"):
-            response_text = response_text[len(context.agentname) + 1:].strip()
+    def get_stream_delta(self, chunk: OpenAIObject) -> str:
+        return chunk["choices"][0]["delta"].get("content") if chunk.get("choices") else None
 
-        return response_text, params, completion
+    def make_stream_completion(self, chunk: OpenAIObject, response_text: str) -> dict:
+        chunk = chunk or {}
+        completion = {
+            "id": chunk.get("id"),
+            "object": "chat.completion",
+            "created": chunk.get("created"),
+            "model": chunk.get("model")
+        }
+        if response_text:
+            completion["choices"] = [{
+                "index": 0,
+                "message": {"role": "assistant", "content": response_text},
+                "finish_reason": chunk["choices"][0].get("finish_reason") if chunk.get("choices") else None
+            }]
+        return completion
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+from .lock import KeyedLock
+
+logger = logging.getLogger(__name__)
+
+
+class EventDispatcher:
+    # Handle events concurrently up to concurrency. Events with the same key are handled one by one in the order
+    def __init__(
+        self,
+        handler: Callable[[Any], Awaitable],
+        get_key: Callable[[Any], str],
+        *,
+        concurrency: int = 10,
+        key_lock: KeyedLock = None
+    ) -> None:
+
+        self.handler = handler
+        # Key to keep the order (e.g. user_id). Events with None key are not ordered
+        self.get_key = get_key
+        self.concurrency = concurrency
+        self.semaphore = None
+        self.loop = None
+        self.key_lock = key_lock or KeyedLock()
+        self.tasks = set()
+        self.dispatched_count = 0
+        self.completed_count = 0
+        self.failed_count = 0
+        self.running_count = 0
+        self.running_max = 0
+
+    def get_semaphore(self) -> asyncio.Semaphore:
+        # Semaphore is bound to the event loop that uses it
+        loop = asyncio.get_running_loop()
+        if self.semaphore is None or self.loop is not loop:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+            self.loop = loop
+        return self.semaphore
+
+    async def handle(self, event: Any, key: str, semaphore: asyncio.Semaphore):
+        async with semaphore:
+            self.running_count += 1
+            self.running_max = max(self.running_max, self.running_count)
+            try:
+                result = await self.handler(event)
+                self.completed_count += 1
+                return result
+
+            except Exception as ex:
+                logger.error(f"Error in handling event of {key}: {ex}")
+                self.failed_count += 1
+                return ex
+
+            finally:
+                self.running_count -= 1
+
+    async def handle_in_order(self, event: Any, semaphore: asyncio.Semaphore):
+        key = self.get_key(event)
+        if key is None:
+            return await self.handle(event, key, semaphore)
+
+        # Take the key lock before the semaphore so that the waiting events don't hold the slots
+        async with self.key_lock.acquire(key):
+            return await self.handle(event, key, semaphore)
+
+    def dispatch_nowait(self, events: list) -> list[asyncio.Task]:
+        # Start handling events in background and return the tasks
+        semaphore = self.get_semaphore()
+        tasks = []
+        for event in events:
+            # Tasks start in the order of creation so the key lock is acquired in the order of events
+            task = asyncio.create_task(self.handle_in_order(event, semaphore))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            tasks.append(task)
+        self.dispatched_count += len(events)
+        return tasks
+
+    async def dispatch(self, events: list) -> list:
+        # Results or exceptions of the handler in the order of events
+        return await asyncio.gather(*self.dispatch_nowait(events))
+
+    async def join(self):
+        # Wait for all events dispatched in background
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks), return_exceptions=True)
+
+    def get_stats(self) -> dict:
+        return {
+            "dispatched": self.dispatched_count,
+            "completed": self.completed_count,
+            "failed": self.failed_count,
+            "running": self.running_count,
+            "running_max": self.running_max,
+            "pending": len(self.tasks) - self.running_count,
+            "key_lock": self.key_lock.get_stats()
+        }
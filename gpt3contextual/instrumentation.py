@@ -0,0 +1,140 @@
+import threading
+
+
+# Stages of a turn notified to the observers
+STAGES = ["lock_wait", "load_context", "recall", "build_prompt", "completion", "save_log", "update_context", "summarize", "turn"]
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+USAGE_KEYS = ["prompt_tokens", "completion_tokens", "total_tokens"]
+
+
+class ChatObserver:
+    def on_stage(self, stage: str, context_key: str, elapsed: float, info: dict, error: Exception = None):
+        # info: prompt_size, response_size and token usage if available at the stage
+        pass
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float] = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(sorted(buckets))
+        # The last one is for +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+
+    def get_cumulative_counts(self) -> list[int]:
+        cumulative = []
+        total = 0
+        for c in self.counts:
+            total += c
+            cumulative.append(total)
+        return cumulative
+
+    def get_quantile(self, q: float) -> float:
+        # Upper bound of the bucket that includes the quantile
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        for i, c in enumerate(self.get_cumulative_counts()):
+            if c >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+class MetricsAggregator(ChatObserver):
+    def __init__(self, buckets: tuple[float] = DEFAULT_BUCKETS, prefix: str = "gpt3contextual") -> None:
+        self.buckets = buckets
+        self.prefix = prefix
+        self.histograms = {}
+        self.errors = {}
+        self.tokens = {k: 0 for k in USAGE_KEYS}
+        self.prompt_size_total = 0
+        self.response_size_total = 0
+        self.lock = threading.Lock()
+
+    def on_stage(self, stage: str, context_key: str, elapsed: float, info: dict, error: Exception = None):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram(self.buckets)
+                self.errors[stage] = 0
+            histogram.observe(elapsed)
+            if error is not None:
+                self.errors[stage] += 1
+
+            # Count sizes and tokens once per turn
+            if stage == "turn":
+                self.prompt_size_total += info.get("prompt_size", 0)
+                self.response_size_total += info.get("response_size", 0)
+                for k in USAGE_KEYS:
+                    self.tokens[k] += info.get(k, 0)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "stages": {
+                    stage: {
+                        "count": h.count,
+                        "errors": self.errors[stage],
+                        "sum": h.sum,
+                        "mean": h.sum / h.count if h.count else 0.0,
+                        "p50": h.get_quantile(0.5),
+                        "p95": h.get_quantile(0.95),
+                        "p99": h.get_quantile(0.99)
+                    } for stage, h in self.histograms.items()
+                },
+                "tokens": dict(self.tokens),
+                "prompt_size_total": self.prompt_size_total,
+                "response_size_total": self.response_size_total
+            }
+
+    def render_prometheus(self) -> str:
+        # Text exposition format of Prometheus
+        name = f"{self.prefix}_stage_duration_seconds"
+        lines = [
+            f"# HELP {name} Duration of each stage of chat turn",
+            f"# TYPE {name} histogram"
+        ]
+
+        with self.lock:
+            for stage, h in self.histograms.items():
+                cumulative = h.get_cumulative_counts()
+                for b, c in zip(h.buckets, cumulative):
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{b}"}} {c}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {cumulative[-1]}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {h.sum}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {h.count}')
+
+            lines.append(f"# HELP {self.prefix}_stage_errors_total Errors raised in each stage of chat turn")
+            lines.append(f"# TYPE {self.prefix}_stage_errors_total counter")
+            for stage, c in self.errors.items():
+                lines.append(f'{self.prefix}_stage_errors_total{{stage="{stage}"}} {c}')
+
+            lines.append(f"# HELP {self.prefix}_tokens_total Tokens used by completions")
+            lines.append(f"# TYPE {self.prefix}_tokens_total counter")
+            for k in USAGE_KEYS:
+                lines.append(f'{self.prefix}_tokens_total{{type="{k[:-len("_tokens")]}"}} {self.tokens[k]}')
+
+            lines.append(f"# HELP {self.prefix}_text_size_total Characters of prompts and responses")
+            lines.append(f"# TYPE {self.prefix}_text_size_total counter")
+            lines.append(f'{self.prefix}_text_size_total{{type="prompt"}} {self.prompt_size_total}')
+            lines.append(f'{self.prefix}_text_size_total{{type="response"}} {self.response_size_total}')
+
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.errors.clear()
+            self.tokens = {k: 0 for k in USAGE_KEYS}
+            self.prompt_size_total = 0
+            self.response_size_total = 0
@@ -0,0 +1,75 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+
+class KeyLockEntry:
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        # Count of the holder and waiters. The entry is removed when it becomes 0
+        self.count = 0
+
+
+class KeyedLock:
+    def __init__(self) -> None:
+        self.entries: dict[str, KeyLockEntry] = {}
+        self.acquired_count = 0
+        self.waited_count = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.queue_depth_max = 0
+
+    @asynccontextmanager
+    async def acquire(self, key: str, timeout: float = None):
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = KeyLockEntry()
+            self.entries[key] = entry
+        entry.count += 1
+        # Waiters for this key excluding the current holder
+        self.queue_depth_max = max(self.queue_depth_max, entry.count - 1)
+
+        waiting = entry.lock.locked()
+        start_time = time.perf_counter()
+        try:
+            if timeout is None:
+                await entry.lock.acquire()
+            else:
+                await asyncio.wait_for(entry.lock.acquire(), timeout)
+        except BaseException:
+            self.release_entry(key, entry)
+            raise
+
+        wait_time = time.perf_counter() - start_time
+        self.acquired_count += 1
+        if waiting:
+            self.waited_count += 1
+        self.wait_time_total += wait_time
+        self.wait_time_max = max(self.wait_time_max, wait_time)
+
+        try:
+            yield
+        finally:
+            entry.lock.release()
+            self.release_entry(key, entry)
+
+    def release_entry(self, key: str, entry: KeyLockEntry):
+        entry.count -= 1
+        if entry.count == 0 and self.entries.get(key) is entry:
+            del self.entries[key]
+
+    def get_queue_depth(self, key: str) -> int:
+        entry = self.entries.get(key)
+        return entry.count - 1 if entry else 0
+
+    def get_stats(self) -> dict:
+        return {
+            "active_keys": len(self.entries),
+            "waiting": sum(e.count - 1 for e in self.entries.values()),
+            "queue_depth_max": self.queue_depth_max,
+            "acquired": self.acquired_count,
+            "waited": self.waited_count,
+            "wait_time_total": self.wait_time_total,
+            "wait_time_max": self.wait_time_max,
+            "wait_time_avg": self.wait_time_total / self.acquired_count if self.acquired_count else 0.0
+        }
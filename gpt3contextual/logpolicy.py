@@ -0,0 +1,213 @@
+from __future__ import annotations
+import base64
+import json
+import random
+import threading
+import zlib
+from datetime import datetime
+from sqlalchemy import select, delete
+from typing import TYPE_CHECKING
+from sqlalchemy.orm import Session
+from .models import CompletionLog
+
+if TYPE_CHECKING:
+    from sqlalchemy.ext.asyncio import AsyncSession
+
+# Key in parameters that tells which parameter is stored in prompt column instead
+PROMPT_REF_KEY = "$prompt"
+COMPRESSIONS = ("zlib", "zstd")
+
+
+def get_zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstandard is required for zstd compression: pip install zstandard")
+    return zstandard
+
+
+def encode_payload(value: str, compression: str = None, level: int = None, min_size: int = 0) -> str:
+    # Compressed payload is stored as "{compression}:{base64}". Short payload is stored as is
+    if compression is None or len(value) < min_size:
+        return value
+
+    data = value.encode("utf-8")
+    if compression == "zlib":
+        compressed = zlib.compress(data, -1 if level is None else level)
+    elif compression == "zstd":
+        compressed = get_zstd().ZstdCompressor(level=3 if level is None else level).compress(data)
+    else:
+        raise ValueError(f"compression must be one of {COMPRESSIONS}: {compression}")
+
+    return f"{compression}:" + base64.b64encode(compressed).decode("ascii")
+
+
+def decode_payload(value: str) -> str:
+    # Plain JSON written by older versions or without compression is returned as is
+    if not value or value[0] in "{[":
+        return value
+
+    compression, _, encoded = value.partition(":")
+    if compression == "zlib":
+        return zlib.decompress(base64.b64decode(encoded)).decode("utf-8")
+    elif compression == "zstd":
+        return get_zstd().ZstdDecompressor().decompress(base64.b64decode(encoded)).decode("utf-8")
+
+    return value
+
+
+def decode_log(log) -> dict:
+    # CompletionLog or record dict to dict with the decoded parameters and completion
+    record = log.copy() if isinstance(log, dict) else {c.name: getattr(log, c.name) for c in log.__table__.columns}
+    parameters = json.loads(decode_payload(record["parameters"]))
+    completion = json.loads(decode_payload(record["completion"]))
+
+    # Restore the prompt removed from parameters
+    prompt_ref = parameters.pop(PROMPT_REF_KEY, None)
+    if prompt_ref == "prompt":
+        parameters["prompt"] = record["prompt"]
+    elif prompt_ref == "messages":
+        parameters["messages"] = json.loads(record["prompt"])
+
+    record["parameters"] = parameters
+    record["completion"] = completion
+    return record
+
+
+class LogPolicy:
+    def __init__(
+        self,
+        *,
+        compression: str = "zlib",
+        compression_level: int = None,
+        min_compress_size: int = 256,
+        dedupe_prompt: bool = True,
+        success_rate: float = 1.0,
+        error_rate: float = 1.0,
+        max_rows: int = None,
+        max_age: int = None,
+        prune_interval: int = 1000,
+        seed: int = None
+    ) -> None:
+
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError(f"compression must be one of {COMPRESSIONS}: {compression}")
+        if compression == "zstd":
+            get_zstd()
+
+        # Compress parameters and completion. None to store plain JSON
+        self.compression = compression
+        self.compression_level = compression_level
+        self.min_compress_size = min_compress_size
+        # Store prompt (or messages) only in prompt column, not in parameters
+        self.dedupe_prompt = dedupe_prompt
+        # Ratio of logs to save for successful and error completions
+        self.success_rate = success_rate
+        self.error_rate = error_rate
+        # Keep the latest max_rows logs and logs created within max_age seconds
+        self.max_rows = max_rows
+        self.max_age = max_age
+        # Prune old logs every prune_interval saved logs
+        self.prune_interval = prune_interval
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.unpruned_count = 0
+        self.saved_count = 0
+        self.sampled_out_count = 0
+        self.pruned_count = 0
+
+    def should_save(self, response_text: str) -> bool:
+        rate = self.success_rate if response_text else self.error_rate
+        with self.lock:
+            save = rate >= 1.0 or (rate > 0.0 and self.random.random() < rate)
+            if save:
+                self.saved_count += 1
+            else:
+                self.sampled_out_count += 1
+        return save
+
+    def make_record(self, response_text: str, params: dict, completion: dict) -> dict:
+        if not self.should_save(response_text):
+            return None
+
+        if "prompt" in params:
+            prompt = params["prompt"]
+            prompt_ref = "prompt"
+        else:
+            prompt = json.dumps(params["messages"], ensure_ascii=False)
+            prompt_ref = "messages"
+
+        if self.dedupe_prompt:
+            params = {k: v for k, v in params.items() if k != prompt_ref}
+            params[PROMPT_REF_KEY] = prompt_ref
+
+        return {
+            "created_at": int(datetime.utcnow().timestamp()),
+            "prompt": prompt,
+            # Error completions have no text
+            "text": response_text or "",
+            "model": params.get("model"),
+            "parameters": self.encode(json.dumps(params, ensure_ascii=False)),
+            "completion": self.encode(json.dumps(completion, ensure_ascii=False))
+        }
+
+    def encode(self, value: str) -> str:
+        return encode_payload(value, self.compression, self.compression_level, self.min_compress_size)
+
+    def is_retention_set(self) -> bool:
+        return bool(self.max_rows or self.max_age)
+
+    def should_prune(self, written_count: int) -> bool:
+        # Count logs written to database and prune every prune_interval logs
+        if not self.is_retention_set():
+            return False
+        with self.lock:
+            self.unpruned_count += written_count
+            if self.unpruned_count < self.prune_interval:
+                return False
+            self.unpruned_count = 0
+            return True
+
+    def make_prune_stmts(self, min_id: int = None) -> list:
+        stmts = []
+        if self.max_age:
+            expired_at = int(datetime.utcnow().timestamp()) - self.max_age
+            stmts.append(delete(CompletionLog).where(CompletionLog.created_at < expired_at))
+        if min_id is not None:
+            stmts.append(delete(CompletionLog).where(CompletionLog.id < min_id))
+        return stmts
+
+    def make_min_id_stmt(self):
+        # ID of the oldest log to keep
+        return select(CompletionLog.id).order_by(CompletionLog.id.desc()).offset(self.max_rows - 1).limit(1)
+
+    def prune(self, session: Session) -> int:
+        min_id = session.execute(self.make_min_id_stmt()).scalar() if self.max_rows else None
+        count = 0
+        for stmt in self.make_prune_stmts(min_id):
+            count += session.execute(stmt).rowcount
+        session.commit()
+        self.count_pruned(count)
+        return count
+
+    async def prune_async(self, session: AsyncSession) -> int:
+        min_id = (await session.execute(self.make_min_id_stmt())).scalar() if self.max_rows else None
+        count = 0
+        for stmt in self.make_prune_stmts(min_id):
+            count += (await session.execute(stmt)).rowcount
+        await session.commit()
+        self.count_pruned(count)
+        return count
+
+    def count_pruned(self, count: int):
+        with self.lock:
+            self.pruned_count += count
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "saved": self.saved_count,
+                "sampled_out": self.sampled_out_count,
+                "pruned": self.pruned_count
+            }
@@ -0,0 +1,206 @@
+import asyncio
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+from sqlalchemy import insert
+from sqlalchemy.orm import sessionmaker
+from .models import CompletionLog
+
+logger = logging.getLogger(__name__)
+
+
+class CompletionLogWriter:
+    OVERFLOW_POLICIES = ("block", "drop", "spill")
+
+    def __init__(
+        self,
+        get_session: sessionmaker = None,
+        *,
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+        max_queue_size: int = 10000,
+        overflow: str = "block",
+        block_timeout: float = None,
+        spill_path: str = None,
+        log_policy=None
+    ) -> None:
+
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"overflow must be one of {self.OVERFLOW_POLICIES}: {overflow}")
+        if overflow == "spill" and not spill_path:
+            raise ValueError("spill_path is required when overflow is spill")
+
+        self.get_session = get_session
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.spill_path = spill_path
+        # LogPolicy to prune old logs after flush. ContextualChat sets its log_policy if None
+        self.log_policy = log_policy
+
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.counter_lock = threading.Lock()
+        self.spill_lock = threading.Lock()
+        self.queued_count = 0
+        self.flushed_count = 0
+        self.dropped_count = 0
+        self.spilled_count = 0
+        self.failed_count = 0
+
+    def start(self, get_session: sessionmaker = None):
+        if get_session:
+            self.get_session = get_session
+        if self.thread is not None:
+            return
+
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="CompletionLogWriter", daemon=True)
+        self.thread.start()
+        # Flush queued logs on interpreter shutdown
+        atexit.register(self.close)
+
+    def close(self, timeout: float = None):
+        if self.thread is None:
+            return
+
+        self.stop_event.set()
+        self.thread.join(timeout)
+        self.thread = None
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def count(self, name: str, value: int):
+        with self.counter_lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def put(self, record: dict) -> bool:
+        try:
+            if self.overflow == "block":
+                self.queue.put(record, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(record)
+
+        except queue.Full:
+            self.handle_overflow([record])
+            return False
+
+        self.count("queued_count", 1)
+        return True
+
+    async def put_async(self, record: dict) -> bool:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if self.overflow == "block":
+                # Wait for the space in another thread not to block event loop
+                return await asyncio.get_running_loop().run_in_executor(None, self.put, record)
+            self.handle_overflow([record])
+            return False
+
+        self.count("queued_count", 1)
+        return True
+
+    def handle_overflow(self, records: list[dict]):
+        if self.overflow == "spill":
+            self.spill(records)
+        else:
+            self.count("dropped_count", len(records))
+
+    def spill(self, records: list[dict]):
+        try:
+            with self.spill_lock:
+                with open(self.spill_path, "a", encoding="utf-8") as f:
+                    for r in records:
+                        f.write(json.dumps(r, ensure_ascii=False) + "\n")
+            self.count("spilled_count", len(records))
+
+        except Exception as ex:
+            logger.error(f"Failed to spill completion logs: {ex}")
+            self.count("dropped_count", len(records))
+
+    def take_batch(self) -> list[dict]:
+        try:
+            records = [self.queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.flush_interval
+        while len(records) < self.batch_size:
+            try:
+                if self.stop_event.is_set():
+                    records.append(self.queue.get_nowait())
+                else:
+                    records.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+
+        return records
+
+    def flush(self, records: list[dict]):
+        try:
+            with self.get_session() as session:
+                session.execute(insert(CompletionLog), records)
+                session.commit()
+            self.count("flushed_count", len(records))
+
+        except Exception as ex:
+            logger.error(f"Failed to write completion logs: {ex}")
+            self.count("failed_count", len(records))
+            if self.spill_path:
+                self.spill(records)
+
+    def prune(self):
+        try:
+            with self.get_session() as session:
+                self.log_policy.prune(session)
+        except Exception as ex:
+            logger.error(f"Failed to prune completion logs: {ex}")
+
+    def run(self):
+        while not (self.stop_event.is_set() and self.queue.empty()):
+            records = self.take_batch()
+            if records:
+                self.flush(records)
+                if self.log_policy is not None and self.log_policy.should_prune(len(records)):
+                    self.prune()
+
+    def flush_spilled(self) -> int:
+        # Write logs spilled to file into database
+        with self.spill_lock:
+            try:
+                with open(self.spill_path, "r", encoding="utf-8") as f:
+                    records = [json.loads(line) for line in f if line.strip()]
+            except FileNotFoundError:
+                return 0
+
+            for i in range(0, len(records), self.batch_size):
+                with self.get_session() as session:
+                    session.execute(insert(CompletionLog), records[i:i + self.batch_size])
+                    session.commit()
+
+            open(self.spill_path, "w").close()
+
+        return len(records)
+
+    def get_stats(self) -> dict:
+        with self.counter_lock:
+            return {
+                "queue_size": self.queue.qsize(),
+                "queued": self.queued_count,
+                "flushed": self.flushed_count,
+                "dropped": self.dropped_count,
+                "spilled": self.spilled_count,
+                "failed": self.failed_count
+            }
@@ -0,0 +1,236 @@
+from __future__ import annotations
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    import numpy
+
+logger = logging.getLogger(__name__)
+
+MEMORY_PATH_SUFFIX = ".memory"
+
+
+def get_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("numpy is required for LongTermMemory: pip install numpy")
+    return numpy
+
+
+def get_memory_path(connection_str: str) -> str:
+    # Directory next to the SQLite database file. None for the other databases and in-memory SQLite
+    from sqlalchemy.engine import make_url
+    url = make_url(connection_str)
+    if url.get_backend_name() != "sqlite" or not url.database or url.database == ":memory:":
+        return None
+    return url.database + MEMORY_PATH_SUFFIX
+
+
+class Embedder:
+    # Text to vector. Pass func(texts) -> vectors (list of list of float or ndarray) or override embed()
+    def __init__(self, func: Callable[[list[str]], list] = None, dim: int = None) -> None:
+        self.func = func
+        self.dim = dim
+
+    def embed(self, texts: list[str]) -> numpy.ndarray:
+        if self.func is None:
+            raise NotImplementedError("embed() is not implemented")
+        return get_numpy().asarray(self.func(texts), dtype="float32").reshape(len(texts), -1)
+
+
+class HashingEmbedder(Embedder):
+    # Deterministic embedding by feature hashing of words and character n-grams. Works offline without models
+    def __init__(self, dim: int = 512, ngram: int = 3) -> None:
+        super().__init__(dim=dim)
+        # Character n-grams match the languages without spaces (e.g. Japanese) and inflected words
+        self.ngram = ngram
+
+    def get_features(self, text: str) -> list[str]:
+        features = []
+        for word in re.findall(r"\w+", unicodedata.normalize("NFKC", text).lower()):
+            features.append(word)
+            if len(word) > self.ngram:
+                features.extend(f"#{word[i:i + self.ngram]}" for i in range(len(word) - self.ngram + 1))
+        return features
+
+    def embed(self, texts: list[str]) -> numpy.ndarray:
+        np = get_numpy()
+        vectors = np.zeros((len(texts), self.dim), dtype="float32")
+        for i, text in enumerate(texts):
+            # crc32 instead of hash() that changes in each process
+            hashes = np.array([zlib.crc32(f.encode("utf-8")) for f in self.get_features(text)], dtype="int64")
+            if len(hashes):
+                signs = np.where((hashes // self.dim) % 2 == 0, 1.0, -1.0).astype("float32")
+                np.add.at(vectors[i], hashes % self.dim, signs)
+        return vectors
+
+
+class LongTermMemory:
+    # Vectors of past turns for each context key, persisted as "{sha1 of key}.npz" in path
+    def __init__(
+        self,
+        embedder: Embedder = None,
+        path: str = None,
+        *,
+        top_k: int = 3,
+        min_score: float = 0.2,
+        max_entries: int = 1000,
+        max_keys: int = 1000,
+        timeout: float = 0.1
+    ) -> None:
+
+        # Embedder or function(texts) -> vectors
+        self.embedder = embedder if isinstance(embedder, Embedder) else \
+            HashingEmbedder() if embedder is None else Embedder(embedder)
+        # Set next to the SQLite database by ContextualChat when None. Not persisted for the other databases
+        self.path = path
+        self.top_k = top_k
+        # Minimum cosine similarity of the turns to recall
+        self.min_score = min_score
+        # Oldest turns are dropped over max_entries to bound the time of search
+        self.max_entries = max_entries
+        # Count of keys whose vectors are kept in memory
+        self.max_keys = max_keys
+        # Recall is skipped when it takes longer than timeout (sec) in search_async()
+        self.timeout = timeout
+
+        # key: (vectors, entries). entries are [text, histories] of each turn
+        self.indexes = OrderedDict()
+        self.lock = threading.Lock()
+        self.added_count = 0
+        self.search_count = 0
+        self.timeout_count = 0
+        self.search_time = 0.0
+
+    def get_file_path(self, key: str) -> str:
+        return os.path.join(self.path, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".npz")
+
+    def normalize(self, vectors: numpy.ndarray) -> numpy.ndarray:
+        np = get_numpy()
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1.0, norms)
+
+    def load(self, key: str) -> tuple:
+        np = get_numpy()
+        index = self.indexes.get(key)
+        if index is not None:
+            self.indexes.move_to_end(key)
+            return index
+
+        index = (np.zeros((0, self.embedder.dim or 0), dtype="float16"), [])
+        if self.path:
+            file_path = self.get_file_path(key)
+            if os.path.exists(file_path):
+                with np.load(file_path) as data:
+                    index = (data["vectors"], json.loads(data["entries"].tobytes().decode("utf-8")))
+
+        self.indexes[key] = index
+        while len(self.indexes) > self.max_keys:
+            self.indexes.popitem(last=False)
+        return index
+
+    def save(self, key: str, index: tuple):
+        if not self.path:
+            return
+
+        np = get_numpy()
+        os.makedirs(self.path, exist_ok=True)
+        file_path = self.get_file_path(key)
+        # Replace the file at once not to leave the broken one
+        temp_path = f"{file_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            np.savez(f, vectors=index[0], entries=np.frombuffer(json.dumps(index[1], ensure_ascii=False).encode("utf-8"), dtype="uint8"))
+        os.replace(temp_path, file_path)
+
+    def add(self, key: str, text: str, histories: list[str] = None):
+        # histories: lines of the turn in Context.histories not to recall the turns still in prompt
+        np = get_numpy()
+        vector = self.normalize(self.embedder.embed([text])).astype("float16")
+
+        with self.lock:
+            vectors, entries = self.load(key)
+            if len(vectors) and vectors.shape[1] != vector.shape[1]:
+                logger.warning(f"Dimension of embedding changed. Memory of {key} is cleared")
+                vectors, entries = vector[:0], []
+            vectors = np.concatenate([vectors.reshape(-1, vector.shape[1]), vector])[-self.max_entries:]
+            entries = (entries + [[text, histories or []]])[-self.max_entries:]
+            self.indexes[key] = (vectors, entries)
+            self.save(key, (vectors, entries))
+            self.added_count += 1
+
+    def search(self, key: str, text: str, exclude: list[str] = None, top_k: int = None) -> list[str]:
+        # Texts of the turns similar to text, in the order of the turns
+        np = get_numpy()
+        start_time = time.perf_counter()
+        top_k = top_k or self.top_k
+
+        with self.lock:
+            vectors, entries = self.load(key)
+        if not entries:
+            return []
+
+        query = self.normalize(self.embedder.embed([text]))[0]
+        if query.shape[0] != vectors.shape[1]:
+            return []
+        scores = vectors.astype("float32") @ query
+
+        exclude = set(exclude or [])
+        indices = []
+        for i in np.argsort(-scores):
+            if scores[i] < self.min_score or len(indices) >= top_k:
+                break
+            histories = entries[i][1]
+            if histories and all(h in exclude for h in histories):
+                continue
+            indices.append(i)
+
+        self.search_count += 1
+        self.search_time += time.perf_counter() - start_time
+        return [entries[i][0] for i in sorted(indices)]
+
+    async def add_async(self, key: str, text: str, histories: list[str] = None):
+        await asyncio.to_thread(self.add, key, text, histories)
+
+    async def search_async(self, key: str, text: str, exclude: list[str] = None, top_k: int = None) -> list[str]:
+        try:
+            return await asyncio.wait_for(asyncio.to_thread(self.search, key, text, exclude, top_k), self.timeout)
+        except asyncio.TimeoutError:
+            # Answer without memories rather than delaying the turn
+            logger.warning(f"Recall of {key} timed out")
+            self.timeout_count += 1
+            return []
+
+    def remove(self, key: str = None):
+        # Remove all when key is None
+        with self.lock:
+            if key is None:
+                self.indexes.clear()
+                if self.path and os.path.isdir(self.path):
+                    for name in os.listdir(self.path):
+                        if name.endswith(".npz"):
+                            os.remove(os.path.join(self.path, name))
+                return
+
+            self.indexes.pop(key, None)
+            if self.path and os.path.exists(self.get_file_path(key)):
+                os.remove(self.get_file_path(key))
+
+    def get_stats(self) -> dict:
+        return {
+            "loaded_keys": len(self.indexes),
+            "added": self.added_count,
+            "searches": self.search_count,
+            "timeouts": self.timeout_count,
+            "search_time_avg": self.search_time / self.search_count if self.search_count else 0.0
+        }
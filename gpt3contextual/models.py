@@ -1,51 +1,209 @@
+import asyncio
 import json
+import threading
+import weakref
 from sqlalchemy import (
-    Column, String, Integer
+    Column, String, Integer, Engine, Connection,
+    create_engine, make_url, select, delete, func, inspect, text
 )
+from sqlalchemy.schema import CreateColumn
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
 
+# Engines and the databases whose tables are ready, shared in the process
+_engines = {}
+_prepared_databases = set()
+_engines_lock = threading.Lock()
+_prepare_lock = threading.Lock()
+# Locks for each database in each event loop: {loop: {database key: asyncio.Lock}}
+_prepare_async_locks = weakref.WeakKeyDictionary()
+
+
+def get_engine(connection_str: str) -> Engine:
+    # Reuse the engine and its connection pool for the same connection_str
+    with _engines_lock:
+        engine = _engines.get(connection_str)
+        if engine is None:
+            engine = _engines[connection_str] = create_engine(connection_str)
+        return engine
+
+
+def is_async_url(connection_str: str) -> bool:
+    # Async drivers (e.g. sqlite+aiosqlite://, postgresql+asyncpg://). The driver itself is not imported
+    return make_url(connection_str).get_dialect().is_async
+
+
+def is_same_database(connection_str: str, other_connection_str: str) -> bool:
+    # Compare regardless of the driver (e.g. sqlite:// and sqlite+aiosqlite://)
+    urls = [make_url(connection_str), make_url(other_connection_str)]
+    return len({(u.get_backend_name(), u.username, u.host, u.port, u.database) for u in urls}) == 1
+
+
+def get_database_key(engine) -> str:
+    return engine.url.render_as_string(hide_password=False)
+
+
+def prepare_tables(engine: Engine, check_schema: bool = True):
+    # Create and migrate tables only once for each database
+    if not check_schema or get_database_key(engine) in _prepared_databases:
+        return
+    with _prepare_lock:
+        if get_database_key(engine) in _prepared_databases:
+            return
+        create_tables(engine)
+        _prepared_databases.add(get_database_key(engine))
+
+
+async def prepare_tables_async(engine, check_schema: bool = True):
+    database_key = get_database_key(engine)
+    if not check_schema or database_key in _prepared_databases:
+        return
+    # Concurrent first turns create tables only once
+    locks = _prepare_async_locks.setdefault(asyncio.get_running_loop(), {})
+    async with locks.setdefault(database_key, asyncio.Lock()):
+        if database_key in _prepared_databases:
+            return
+        await create_tables_async(engine)
+        _prepared_databases.add(database_key)
+
+
+def clear_prepared_tables():
+    # Check the schema again in the next preparation (e.g. after dropping tables)
+    _prepared_databases.clear()
+
 
 def create_tables(engine):
-    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        Base.metadata.create_all(bind=conn)
+        migrate_tables(conn)
+
+
+async def create_tables_async(engine):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(migrate_tables)
+
+
+def migrate_tables(bind):
+    if isinstance(bind, Engine):
+        with bind.begin() as conn:
+            return migrate_tables(conn)
+
+    # Create columns and indexes that don't exist in the tables created by older versions
+    inspector = inspect(bind)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing_columns = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            # Only nullable columns can be added to the existing rows
+            if column.name in existing_columns or not column.nullable:
+                continue
+            table_name = bind.dialect.identifier_preparer.format_table(table)
+            bind.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {CreateColumn(column).compile(dialect=bind.dialect)}"))
+
+        existing_indexes = {i["name"] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+            if table is Context.__table__ and index.unique:
+                remove_duplicated_contexts(bind)
+            index.create(bind)
+
+
+def remove_duplicated_contexts(conn: Connection) -> int:
+    # Keep the latest updated context for each key
+    stmt = select(Context.key).group_by(Context.key).having(func.count(Context.id) > 1)
+    removed_count = 0
+    for key in conn.execute(stmt).scalars().all():
+        ids = conn.execute(
+            select(Context.id).where(Context.key == key).order_by(Context.updated_at.desc(), Context.id.desc())
+        ).scalars().all()
+        conn.execute(delete(Context).where(Context.id.in_(ids[1:])))
+        removed_count += len(ids) - 1
+
+    return removed_count
 
 
 class Context(Base):
     __tablename__ = "contexts"
 
     id = Column("id", Integer, autoincrement=True, primary_key=True)
-    updated_at = Column("updated_at", Integer, default=0)
-    key = Column("key", String(255), nullable=False)
+    updated_at = Column("updated_at", Integer, default=0, index=True)
+    key = Column("key", String(255), nullable=False, unique=True, index=True)
     username = Column("username", String(255), nullable=False)
     agentname = Column("agentname", String(255), nullable=False)
     chat_description = Column("chat_description", String(2000), nullable=False)
     history_count = Column("history_count", Integer, nullable=False)
     histories = Column("histories", String, nullable=True)
+    # Rolling summary of the histories folded by summarizer
+    summary = Column("summary", String, nullable=True)
+    # Past turns recalled by LongTermMemory for the prompt of the current turn. Not stored
+    memories = None
+
+    def to_dict(self) -> dict:
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns}
+
+    def get_history_list(self) -> list[str]:
+        # Parse JSON only once and reuse the list until histories is replaced
+        if getattr(self, "_history_source", None) is not self.histories:
+            self._history_list = json.loads(self.histories) if self.histories else []
+            self._history_source = self.histories
+        return self._history_list
 
     def get_histories(self, join_with: str = "\n") -> str:
-        history_list = json.loads(self.histories)
-        return join_with.join(history_list[self.history_count * -1:])
+        return join_with.join(self.get_history_list()[self.history_count * -1:])
 
     def get_histories_as_list(self) -> list[str]:
-        history_list = json.loads(self.histories)
-        return history_list[self.history_count * -1:]
+        return self.get_history_list()[self.history_count * -1:]
+
+    def get_histories_within_tokens(self, max_tokens: int, count_tokens, tokens_per_history: int = 0) -> list[str]:
+        # Recent histories as many as fit in max_tokens
+        history_list = self.get_history_list()
+        total_tokens = 0
+        start = len(history_list)
+        while start > 0:
+            total_tokens += count_tokens(history_list[start - 1]) + tokens_per_history
+            if total_tokens > max_tokens:
+                break
+            start -= 1
+        return history_list[start:]
+
+    def add_history(self, text: str, retention: int = 0):
+        self.add_histories([text], retention)
+
+    def add_histories(self, texts: list[str], retention: int = 0):
+        history_list = self.get_history_list()
+        history_list.extend(texts)
+        # Drop old histories that will never be used
+        if retention and len(history_list) > retention:
+            del history_list[:len(history_list) - retention]
+        self.histories = json.dumps(history_list, ensure_ascii=False)
+        self._history_source = self.histories
 
-    def add_history(self, text: str):
-        history_list = json.loads(self.histories)
-        history_list.append(text)
-        self.histories = json.dumps(history_list)
+    def fold_histories(self, count: int, summary: str):
+        # Replace the oldest histories with the summary
+        history_list = self.get_history_list()
+        del history_list[:count]
+        self.histories = json.dumps(history_list, ensure_ascii=False)
+        self._history_source = self.histories
+        self.summary = summary
 
     def clear_history(self):
         self.histories = "[]"
+        self.summary = None
 
 
 class CompletionLog(Base):
     __tablename__ = "completionlogs"
 
     id = Column("id", Integer, autoincrement=True, primary_key=True)
-    created_at = Column("created_at", Integer, nullable=False)
+    created_at = Column("created_at", Integer, nullable=False, index=True)
     prompt = Column("prompt", String(2000), nullable=False)
     text = Column("text", String(2000), nullable=False)
     parameters = Column("parameters", String, nullable=False)
     completion = Column("completion", String, nullable=False)
+    # Model that served the turn
+    model = Column("model", String(255), nullable=True)
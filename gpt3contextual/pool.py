@@ -0,0 +1,88 @@
+from __future__ import annotations
+import asyncio
+import logging
+from typing import TYPE_CHECKING
+
+# aiohttp is imported on the first session
+if TYPE_CHECKING:
+    import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    # HTTP connections to OpenAI API kept alive and shared by the async requests
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_connections_per_host: int = 0,
+        keepalive_timeout: float = 30.0,
+        connect_timeout: float = None,
+        read_timeout: float = None,
+        warmup_connections: int = 0
+    ) -> None:
+
+        self.max_connections = max_connections
+        # 0 means no limit other than max_connections
+        self.max_connections_per_host = max_connections_per_host
+        # Idle connections are closed after keepalive_timeout
+        self.keepalive_timeout = keepalive_timeout
+        # Passed to OpenAI API as request_timeout. read_timeout is the total timeout for async requests
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # Connections opened by warmup()
+        self.warmup_connections = warmup_connections
+        self.session = None
+        self.loop = None
+        self.session_count = 0
+
+    def get_request_timeout(self):
+        if self.connect_timeout is None and self.read_timeout is None:
+            return None
+        return (self.connect_timeout, self.read_timeout)
+
+    def make_session(self) -> aiohttp.ClientSession:
+        import aiohttp
+        connector = aiohttp.TCPConnector(
+            limit=self.max_connections,
+            limit_per_host=self.max_connections_per_host,
+            keepalive_timeout=self.keepalive_timeout
+        )
+        return aiohttp.ClientSession(connector=connector)
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        # Session is bound to the event loop that created it
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session.closed or self.loop is not loop:
+            if self.session is not None and not self.session.closed and not self.loop.is_closed():
+                logger.warning("ConnectionPool is used in another event loop. Session is recreated")
+            self.session = self.make_session()
+            self.loop = loop
+            self.session_count += 1
+        return self.session
+
+    async def warmup(self, url: str, headers: dict = None, connections: int = None):
+        # Open connections in advance to skip TCP and TLS handshake in the first requests
+        session = await self.get_session()
+
+        async def request():
+            try:
+                async with session.get(url, headers=headers) as resp:
+                    await resp.read()
+            except Exception as ex:
+                logger.warning(f"Failed to warm up connection: {ex}")
+
+        await asyncio.gather(*[request() for _ in range(connections or self.warmup_connections)])
+
+    async def aclose(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+        self.loop = None
+
+    async def __aenter__(self):
+        await self.get_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
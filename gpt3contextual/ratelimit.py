@@ -0,0 +1,122 @@
+import asyncio
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, refill_per_second: float) -> None:
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def reserve(self, amount: float) -> float:
+        # Take tokens in advance and return the seconds to wait until they are refilled.
+        # Reservation keeps the order of callers and works for both threads and coroutines
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+        self.tokens -= min(amount, self.capacity)
+        return max(-self.tokens / self.refill_per_second, 0.0)
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute: int = None, tokens_per_minute: int = None) -> None:
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_bucket = TokenBucket(requests_per_minute, requests_per_minute / 60) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute, tokens_per_minute / 60) if tokens_per_minute else None
+        self.lock = threading.Lock()
+        self.acquired_count = 0
+        self.throttled_count = 0
+        self.wait_time_total = 0.0
+
+    def reserve(self, tokens: int = 0) -> float:
+        with self.lock:
+            wait_time = 0.0
+            if self.request_bucket:
+                wait_time = max(wait_time, self.request_bucket.reserve(1))
+            if self.token_bucket and tokens:
+                wait_time = max(wait_time, self.token_bucket.reserve(tokens))
+
+            self.acquired_count += 1
+            if wait_time > 0:
+                self.throttled_count += 1
+                self.wait_time_total += wait_time
+
+            return wait_time
+
+    async def acquire_async(self, tokens: int = 0):
+        wait_time = self.reserve(tokens)
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+
+    def acquire(self, tokens: int = 0):
+        wait_time = self.reserve(tokens)
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "acquired": self.acquired_count,
+                "throttled": self.throttled_count,
+                "wait_time_total": self.wait_time_total
+            }
+
+
+class RetryPolicy:
+    # Names of errors in openai.error. openai is imported on the first error
+    RETRYABLE_ERRORS = (
+        "RateLimitError",
+        "APIConnectionError",
+        "ServiceUnavailableError",
+        "Timeout",
+        "TryAgain"
+    )
+
+    def __init__(
+        self,
+        max_retries: int = 3,
+        base_delay: float = 1.0,
+        max_delay: float = 20.0,
+        deadline: float = 60.0,
+        jitter: bool = True
+    ) -> None:
+
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.jitter = jitter
+        self.retried_count = 0
+
+    def is_retryable(self, ex: Exception) -> bool:
+        from openai import error
+        if isinstance(ex, tuple(getattr(error, e) if isinstance(e, str) else e for e in self.RETRYABLE_ERRORS)):
+            return True
+        return isinstance(ex, error.APIError) and (ex.http_status or 0) >= 500
+
+    def get_retry_after(self, ex: Exception) -> float:
+        headers = getattr(ex, "headers", None) or {}
+        try:
+            return float(headers.get("retry-after", 0))
+        except (TypeError, ValueError):
+            return 0.0
+
+    def get_delay(self, ex: Exception, attempt: int, elapsed: float) -> float:
+        # Returns None when the request should not be retried
+        if attempt >= self.max_retries or not self.is_retryable(ex):
+            return None
+
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        delay = max(delay, self.get_retry_after(ex))
+
+        if self.deadline is not None and elapsed + delay > self.deadline:
+            return None
+
+        self.retried_count += 1
+        return delay
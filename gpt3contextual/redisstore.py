@@ -0,0 +1,403 @@
+import asyncio
+import json
+import socket
+import threading
+from datetime import datetime
+from urllib.parse import urlparse
+from .cache import ContextCache
+from .models import Context
+from .store import ContextStore
+
+
+class RedisError(Exception):
+    pass
+
+
+def encode_command(args: list) -> bytes:
+    # Request of RESP (REdis Serialization Protocol) is an array of bulk strings
+    parts = [b"*%d\r\n" % len(args)]
+    for a in args:
+        if isinstance(a, str):
+            a = a.encode("utf-8")
+        elif not isinstance(a, bytes):
+            a = str(a).encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(a), a))
+    return b"".join(parts)
+
+
+def parse_line(line: bytes):
+    # Returns (prefix, value) of the first line of reply
+    if not line:
+        raise ConnectionError("Connection closed by Redis server")
+    return line[:1], line[1:-2]
+
+
+def read_reply(file):
+    prefix, value = parse_line(file.readline())
+    if prefix == b"+":
+        return value.decode("utf-8")
+    elif prefix == b"-":
+        return RedisError(value.decode("utf-8"))
+    elif prefix == b":":
+        return int(value)
+    elif prefix == b"$":
+        length = int(value)
+        return None if length < 0 else file.read(length + 2)[:-2]
+    elif prefix == b"*":
+        length = int(value)
+        return None if length < 0 else [read_reply(file) for _ in range(length)]
+    raise RedisError(f"Unknown reply: {prefix + value}")
+
+
+async def read_reply_async(reader: asyncio.StreamReader):
+    prefix, value = parse_line(await reader.readline())
+    if prefix == b"+":
+        return value.decode("utf-8")
+    elif prefix == b"-":
+        return RedisError(value.decode("utf-8"))
+    elif prefix == b":":
+        return int(value)
+    elif prefix == b"$":
+        length = int(value)
+        return None if length < 0 else (await reader.readexactly(length + 2))[:-2]
+    elif prefix == b"*":
+        length = int(value)
+        return None if length < 0 else [await read_reply_async(reader) for _ in range(length)]
+    raise RedisError(f"Unknown reply: {prefix + value}")
+
+
+def raise_error(replies: list) -> list:
+    for r in replies:
+        if isinstance(r, RedisError):
+            raise r
+    return replies
+
+
+class RedisClient:
+    # Minimal client of Redis protocol that sends the commands in pipeline and pools the connections
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 6379,
+        *,
+        db: int = 0,
+        password: str = None,
+        timeout: float = 5.0,
+        max_idle_connections: int = 10
+    ) -> None:
+
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self.max_idle_connections = max_idle_connections
+        self.idle_connections = []
+        self.idle_async_connections = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs):
+        # redis://:password@host:port/db
+        parsed = urlparse(url)
+        return cls(
+            parsed.hostname or "127.0.0.1",
+            parsed.port or 6379,
+            db=int(parsed.path.lstrip("/") or 0),
+            password=parsed.password,
+            **kwargs
+        )
+
+    def get_init_commands(self) -> list[list]:
+        commands = []
+        if self.password:
+            commands.append(["AUTH", self.password])
+        if self.db:
+            commands.append(["SELECT", self.db])
+        return commands
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        file = sock.makefile("rb")
+        connection = (sock, file)
+
+        init_commands = self.get_init_commands()
+        if init_commands:
+            self.send(connection, init_commands)
+        return connection
+
+    def send(self, connection, commands: list[list]) -> list:
+        sock, file = connection
+        sock.sendall(b"".join(encode_command(c) for c in commands))
+        return raise_error([read_reply(file) for _ in commands])
+
+    def execute_many(self, commands: list[list]) -> list:
+        with self.lock:
+            connection = self.idle_connections.pop() if self.idle_connections else None
+        if connection is None:
+            connection = self.connect()
+
+        try:
+            replies = self.send(connection, commands)
+        except RedisError:
+            self.release(connection)
+            raise
+        except Exception:
+            connection[1].close()
+            connection[0].close()
+            raise
+
+        self.release(connection)
+        return replies
+
+    def execute(self, *args):
+        return self.execute_many([args])[0]
+
+    def release(self, connection):
+        with self.lock:
+            if len(self.idle_connections) < self.max_idle_connections:
+                self.idle_connections.append(connection)
+                return
+        connection[1].close()
+        connection[0].close()
+
+    async def connect_async(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        connection = (asyncio.get_running_loop(), reader, writer)
+
+        init_commands = self.get_init_commands()
+        if init_commands:
+            await self.send_async(connection, init_commands)
+        return connection
+
+    async def send_async(self, connection, commands: list[list]) -> list:
+        _, reader, writer = connection
+        writer.write(b"".join(encode_command(c) for c in commands))
+        await writer.drain()
+        return raise_error([await read_reply_async(reader) for _ in commands])
+
+    async def execute_many_async(self, commands: list[list]) -> list:
+        # Connections are bound to the event loop that opened them
+        loop = asyncio.get_running_loop()
+        connection = None
+        with self.lock:
+            self.idle_async_connections = [c for c in self.idle_async_connections if not c[0].is_closed()]
+            for i, c in enumerate(self.idle_async_connections):
+                if c[0] is loop:
+                    connection = self.idle_async_connections.pop(i)
+                    break
+        if connection is None:
+            connection = await self.connect_async()
+
+        try:
+            replies = await self.send_async(connection, commands)
+        except RedisError:
+            self.release_async(connection)
+            raise
+        except Exception:
+            connection[2].close()
+            raise
+
+        self.release_async(connection)
+        return replies
+
+    async def execute_async(self, *args):
+        return (await self.execute_many_async([args]))[0]
+
+    def release_async(self, connection):
+        with self.lock:
+            if len(self.idle_async_connections) < self.max_idle_connections:
+                self.idle_async_connections.append(connection)
+                return
+        connection[2].close()
+
+    def close(self):
+        with self.lock:
+            for sock, file in self.idle_connections:
+                file.close()
+                sock.close()
+            self.idle_connections.clear()
+            for _, _, writer in self.idle_async_connections:
+                try:
+                    writer.close()
+                except RuntimeError:
+                    # Event loop is already closed
+                    pass
+            self.idle_async_connections.clear()
+
+
+class RedisContextStore(ContextStore):
+    # Store contexts in Redis shared by the nodes. Persona and histories are stored as separated keys
+    # and histories expire by native TTL of Redis instead of comparing updated_at with timeout.
+    # Summary is stored with persona and ignored after histories expire
+    def __init__(
+        self,
+        client: RedisClient = None,
+        *,
+        url: str = "redis://127.0.0.1:6379/0",
+        prefix: str = "gpt3contextual:",
+        persona_ttl: int = None,
+        timeout=300,
+        username: str = "Human",
+        agentname: str = "AI",
+        chat_description: str = None,
+        history_count: int = 10,
+        cache: ContextCache = None,
+        history_retention: int = 100
+    ) -> None:
+
+        super().__init__(timeout, username, agentname, chat_description, history_count, cache, history_retention)
+        self.client = client or RedisClient.from_url(url)
+        self.prefix = prefix
+        # Persona (username, agentname, etc) lives forever by default like ContextManager
+        self.persona_ttl = persona_ttl
+
+    def make_keys(self, key: str) -> tuple[str, str]:
+        return f"{self.prefix}{key}:persona", f"{self.prefix}{key}:histories"
+
+    def make_get_command(self, key: str) -> list:
+        return ["MGET", *self.make_keys(key)]
+
+    def make_context_from_values(self, key: str, values: list) -> Context:
+        persona, histories = values
+        if persona is None:
+            return self.make_context(key)
+
+        context = Context(key=key, **json.loads(persona))
+        if histories is None:
+            # Summary expires with histories
+            context.clear_history()
+        else:
+            context.histories = histories.decode("utf-8")
+        return context
+
+    def make_set_commands(self, context: Context) -> list[list]:
+        persona_key, histories_key = self.make_keys(context.key)
+        persona = json.dumps({
+            "updated_at": context.updated_at,
+            "username": context.username,
+            "agentname": context.agentname,
+            "chat_description": context.chat_description,
+            "history_count": context.history_count,
+            "summary": context.summary
+        }, ensure_ascii=False)
+
+        persona_command = ["SET", persona_key, persona]
+        if self.persona_ttl:
+            persona_command.extend(["EX", self.persona_ttl])
+        histories_command = ["SET", histories_key, context.histories or "[]"]
+        if self.timeout:
+            histories_command.extend(["EX", self.timeout])
+
+        return [persona_command, histories_command]
+
+    def make_scan_command(self, cursor) -> list:
+        # Escape glob characters in prefix
+        pattern = "".join("\\" + c if c in "*?[]\\" else c for c in self.prefix) + "*"
+        return ["SCAN", cursor, "MATCH", pattern, "COUNT", 1000]
+
+    def make_get_many_command(self, keys: list[str]) -> list:
+        return ["MGET", *[k for key in keys for k in self.make_keys(key)]]
+
+    def make_contexts_from_values(self, keys: list[str], contexts: dict, values: list) -> dict[str, Context]:
+        for i, key in enumerate(keys):
+            contexts[key] = self.make_context_from_values(key, values[i * 2:i * 2 + 2])
+        return contexts
+
+    def get(self, session, key: str) -> Context:
+        context = self.get_cached(key)
+        if context:
+            return context
+
+        return self.make_context_from_values(key, self.client.execute(*self.make_get_command(key)))
+
+    def set(self, session, context: Context, commit: bool = True):
+        # Written immediately. commit is ignored as session
+        context.updated_at = int(datetime.utcnow().timestamp())
+        self.client.execute_many(self.make_set_commands(context))
+        self.put_cache(context)
+
+    def get_many(self, session, keys: list[str]) -> dict[str, Context]:
+        contexts = {k: c for k, c in ((k, self.get_cached(k)) for k in keys) if c}
+        missing_keys = [k for k in keys if k not in contexts]
+        if not missing_keys:
+            return contexts
+
+        return self.make_contexts_from_values(missing_keys, contexts, self.client.execute(*self.make_get_many_command(missing_keys)))
+
+    def set_many(self, session, contexts: list[Context], commit: bool = True):
+        if not contexts:
+            return
+
+        commands = []
+        for context in contexts:
+            context.updated_at = int(datetime.utcnow().timestamp())
+            commands.extend(self.make_set_commands(context))
+        self.client.execute_many(commands)
+        for context in contexts:
+            self.put_cache(context)
+
+    def remove(self, session, key: str):
+        self.client.execute("DEL", *self.make_keys(key))
+        self.remove_cache(key)
+        self.notify_remove(key)
+
+    def remove_all(self, session):
+        cursor = 0
+        while True:
+            cursor, keys = self.client.execute(*self.make_scan_command(cursor))
+            if keys:
+                self.client.execute("DEL", *keys)
+            if int(cursor) == 0:
+                break
+        self.remove_cache()
+        self.notify_remove()
+
+    async def get_async(self, session, key: str) -> Context:
+        context = self.get_cached(key)
+        if context:
+            return context
+
+        return self.make_context_from_values(key, await self.client.execute_async(*self.make_get_command(key)))
+
+    async def set_async(self, session, context: Context, commit: bool = True):
+        context.updated_at = int(datetime.utcnow().timestamp())
+        await self.client.execute_many_async(self.make_set_commands(context))
+        self.put_cache(context)
+
+    async def get_many_async(self, session, keys: list[str]) -> dict[str, Context]:
+        contexts = {k: c for k, c in ((k, self.get_cached(k)) for k in keys) if c}
+        missing_keys = [k for k in keys if k not in contexts]
+        if not missing_keys:
+            return contexts
+
+        return self.make_contexts_from_values(missing_keys, contexts, await self.client.execute_async(*self.make_get_many_command(missing_keys)))
+
+    async def set_many_async(self, session, contexts: list[Context], commit: bool = True):
+        if not contexts:
+            return
+
+        commands = []
+        for context in contexts:
+            context.updated_at = int(datetime.utcnow().timestamp())
+            commands.extend(self.make_set_commands(context))
+        await self.client.execute_many_async(commands)
+        for context in contexts:
+            self.put_cache(context)
+
+    async def remove_async(self, session, key: str):
+        await self.client.execute_async("DEL", *self.make_keys(key))
+        self.remove_cache(key)
+        self.notify_remove(key)
+
+    async def remove_all_async(self, session):
+        cursor = 0
+        while True:
+            cursor, keys = await self.client.execute_async(*self.make_scan_command(cursor))
+            if keys:
+                await self.client.execute_async("DEL", *keys)
+            if int(cursor) == 0:
+                break
+        self.remove_cache()
+        self.notify_remove()
@@ -0,0 +1,365 @@
+from __future__ import annotations
+import json
+import logging
+import threading
+import time
+from collections import deque
+from typing import TYPE_CHECKING, AsyncIterator
+from sqlalchemy.orm import Session
+from .chat import ContextualChatBase, ContextualChat, ContextualChatGPT, CompletionException
+from .models import Context
+
+if TYPE_CHECKING:
+    from openai.openai_object import OpenAIObject
+
+logger = logging.getLogger(__name__)
+
+# Histories of ChatCompletion are plain texts and those of Completion are prefixed with the speaker
+HISTORY_FORMATS = ("chat", "completion")
+
+
+def get_history_format(chat_class: type) -> str:
+    return "chat" if issubclass(chat_class, ContextualChatGPT) else "completion"
+
+
+def convert_histories(context: Context, from_format: str, to_format: str) -> list[str]:
+    histories = context.get_history_list()
+    if from_format == to_format:
+        return histories
+
+    if to_format == "chat":
+        converted = []
+        for h in histories:
+            for name in (context.username, context.agentname):
+                if h.startswith(f"{name}:"):
+                    h = h[len(name) + 1:]
+                    break
+            converted.append(h)
+        return converted
+
+    # The last history is the response of agent
+    return [
+        f"{context.agentname if (len(histories) - i) % 2 else context.username}:{h}"
+        for i, h in enumerate(histories)
+    ]
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        *,
+        failure_threshold: int = 5,
+        error_rate_threshold: float = 0.5,
+        min_requests: int = 20,
+        window_size: int = 100,
+        recovery_time: float = 30.0
+    ) -> None:
+
+        # Open on failure_threshold consecutive failures or error_rate_threshold in the recent window_size requests
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.min_requests = min_requests
+        # Let one trial request through recovery_time seconds after opened
+        self.recovery_time = recovery_time
+
+        self.state = self.CLOSED
+        # (latency, succeeded) of the recent requests
+        self.results = deque(maxlen=window_size)
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_started_at = None
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.failure_count = 0
+        self.opened_count = 0
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                if now - self.opened_at < self.recovery_time:
+                    return False
+                self.state = self.HALF_OPEN
+                self.trial_started_at = None
+
+            # Half open. Retry the trial if the previous one didn't finish (e.g. cancelled)
+            if self.trial_started_at is not None and now - self.trial_started_at < self.recovery_time:
+                return False
+            self.trial_started_at = now
+            return True
+
+    def record_success(self, latency: float):
+        with self.lock:
+            self.request_count += 1
+            self.consecutive_failures = 0
+            if self.state == self.HALF_OPEN:
+                # Start over not to open again by the failures before recovery
+                self.state = self.CLOSED
+                self.results.clear()
+            self.results.append((latency, True))
+
+    def record_failure(self, latency: float):
+        with self.lock:
+            self.request_count += 1
+            self.failure_count += 1
+            self.consecutive_failures += 1
+            self.results.append((latency, False))
+
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold or \
+                    (len(self.results) >= self.min_requests and self.get_error_rate() >= self.error_rate_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.trial_started_at = None
+                self.opened_count += 1
+
+    def get_error_rate(self) -> float:
+        if not self.results:
+            return 0.0
+        return sum(1 for _, succeeded in self.results if not succeeded) / len(self.results)
+
+    def get_latency(self, q: float = 0.95) -> float:
+        # Quantile of the latency of the recent successful requests
+        latencies = sorted(latency for latency, succeeded in self.results if succeeded)
+        if not latencies:
+            return 0.0
+        return latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "state": self.state,
+                "requests": self.request_count,
+                "failures": self.failure_count,
+                "opened": self.opened_count,
+                "error_rate": self.get_error_rate(),
+                "latency_p50": self.get_latency(0.5),
+                "latency_p95": self.get_latency(0.95)
+            }
+
+
+class ModelRoute:
+    def __init__(
+        self,
+        model: str,
+        chat_class: type = ContextualChatGPT,
+        *,
+        name: str = None,
+        circuit_breaker: CircuitBreaker = None,
+        **options
+    ) -> None:
+
+        self.model = model
+        # ContextualChat or ContextualChatGPT that builds the request and calls the API for the model
+        self.chat_class = chat_class
+        self.name = name or model
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        # Request settings of this route (e.g. api_key, temperature, rate_limiter) over those of ModelRouter
+        self.options = options
+        self.history_format = get_history_format(chat_class)
+        # Built by ModelRouter without storage
+        self.contextual_chat = None
+
+
+class ModelRouter(ContextualChatBase):
+    # Serve turns by the first available model in routes and fail over to the next one
+    def __init__(
+        self,
+        api_key: str,
+        routes: list,
+        connection_str: str = "sqlite:///gpt3contextual.db",
+        context_manager=None,
+        *,
+        slow_latency: float = None,
+        **kwargs
+    ) -> None:
+
+        if not routes:
+            raise ValueError("routes is required")
+        # ModelRoute or model name for ContextualChatGPT
+        for r in routes:
+            if isinstance(r, ContextualChatBase):
+                raise TypeError("Pass ModelRoute(model, chat_class) instead of the instance that has its own storage")
+        self.routes = [r if isinstance(r, ModelRoute) else ModelRoute(r) for r in routes]
+        # Routes whose p95 latency exceeds slow_latency (sec) are tried after the others
+        self.slow_latency = slow_latency
+        # Histories are stored in the format of the first route and converted for the others
+        self.history_format = self.routes[0].history_format
+
+        super().__init__(api_key, connection_str, context_manager, model=self.routes[0].model, **kwargs)
+        for route in self.routes:
+            route.contextual_chat = self.make_route_chat(route)
+
+    def make_route_chat(self, route: ModelRoute) -> ContextualChatBase:
+        # Request settings of router are forwarded to the routes. The turn (storage, lock, logs) is handled by router
+        options = {
+            "api_key": self.api_key,
+            "token_budget": self.token_budget,
+            "tokenizer": self.token_counter.tokenizer,
+            "context_tokens": self.context_tokens,
+            "response_cache": self.response_cache,
+            "rate_limiter": self.rate_limiter,
+            "retry_policy": self.retry_policy,
+            "connection_pool": self.connection_pool,
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens,
+            **self.completion_params,
+            **route.options
+        }
+        api_key = options.pop("api_key")
+        return route.chat_class(api_key, None, self.context_manager, model=route.model, **options)
+
+    def get_candidates(self) -> list[ModelRoute]:
+        if not self.slow_latency:
+            return self.routes
+
+        fast_routes = []
+        slow_routes = []
+        for r in self.routes:
+            if r.circuit_breaker.get_latency(0.95) > self.slow_latency:
+                slow_routes.append(r)
+            else:
+                fast_routes.append(r)
+        return fast_routes + slow_routes
+
+    def get_route_context(self, context: Context, route: ModelRoute) -> Context:
+        if route.history_format == self.history_format:
+            return context
+        route_context = Context(**context.to_dict())
+        route_context.histories = json.dumps(convert_histories(context, self.history_format, route.history_format), ensure_ascii=False)
+        route_context.memories = context.memories
+        return route_context
+
+    def format_turn_histories(self, context: Context, request_text: str, response_text: str, completion: dict) -> list[str]:
+        # Keep the format of histories regardless of the model that served the turn
+        if self.history_format == "chat":
+            return [request_text, response_text]
+        return [f"{context.username}:{request_text}", f"{context.agentname}:{response_text}"]
+
+    def record_result(self, route: ModelRoute, start_time: float, response_text: str = None, error: Exception = None) -> bool:
+        latency = time.monotonic() - start_time
+        if response_text:
+            route.circuit_breaker.record_success(latency)
+            return True
+
+        route.circuit_breaker.record_failure(latency)
+        logger.warning(f"Model {route.name} failed: {error or 'Completion returns an error'}")
+        return False
+
+    async def execute_completion_async(self, session: Session, context: Context, text: str, **completion_params) -> tuple[str, dict, OpenAIObject]:
+        await self.recall_async(context, text)
+        result = None
+        error = None
+
+        with self.measure("completion", context.key) as info:
+            for route in self.get_candidates():
+                if not route.circuit_breaker.allow():
+                    continue
+
+                start_time = time.monotonic()
+                try:
+                    result = await route.contextual_chat.execute_completion_async(
+                        session, self.get_route_context(context, route), text, **completion_params
+                    )
+                except CompletionException as ex:
+                    self.record_result(route, start_time, error=ex)
+                    error = ex
+                    continue
+
+                if self.record_result(route, start_time, result[0]):
+                    break
+
+            if self.observers and result:
+                info["model"] = result[1].get("model")
+                info.update(self.get_completion_info(result[0], result[2]))
+
+        # Error completion of the last route is handled as usual
+        if result is not None:
+            return result
+        raise error or CompletionException("No model is available", completion_response=None)
+
+    def execute_completion(self, session: Session, context: Context, text: str, **completion_params) -> tuple[str, dict, OpenAIObject]:
+        self.recall(context, text)
+        result = None
+        error = None
+
+        with self.measure("completion", context.key) as info:
+            for route in self.get_candidates():
+                if not route.circuit_breaker.allow():
+                    continue
+
+                start_time = time.monotonic()
+                try:
+                    result = route.contextual_chat.execute_completion(
+                        session, self.get_route_context(context, route), text, **completion_params
+                    )
+                except CompletionException as ex:
+                    self.record_result(route, start_time, error=ex)
+                    error = ex
+                    continue
+
+                if self.record_result(route, start_time, result[0]):
+                    break
+
+            if self.observers and result:
+                info["model"] = result[1].get("model")
+                info.update(self.get_completion_info(result[0], result[2]))
+
+        if result is not None:
+            return result
+        raise error or CompletionException("No model is available", completion_response=None)
+
+    async def execute_completion_stream(self, session: Session, context: Context, text: str, **completion_params) -> tuple[dict, AsyncIterator[OpenAIObject]]:
+        # Fail over only until the stream starts
+        await self.recall_async(context, text)
+        error = None
+        for route in self.get_candidates():
+            if not route.circuit_breaker.allow():
+                continue
+
+            start_time = time.monotonic()
+            try:
+                result = await route.contextual_chat.execute_completion_stream(
+                    session, self.get_route_context(context, route), text, **completion_params
+                )
+            except CompletionException as ex:
+                self.record_result(route, start_time, error=ex)
+                error = ex
+                continue
+
+            route.circuit_breaker.record_success(time.monotonic() - start_time)
+            return result
+
+        raise error or CompletionException("No model is available", completion_response=None)
+
+    def get_stream_class(self, chunk: OpenAIObject) -> type:
+        if chunk is None:
+            return ContextualChatGPT if self.history_format == "chat" else ContextualChat
+        return ContextualChatGPT if chunk.get("object") == "chat.completion.chunk" else ContextualChat
+
+    def get_stream_delta(self, chunk: OpenAIObject) -> str:
+        return self.get_stream_class(chunk).get_stream_delta(self, chunk)
+
+    def make_stream_completion(self, chunk: OpenAIObject, response_text: str) -> dict:
+        return self.get_stream_class(chunk).make_stream_completion(self, chunk, response_text)
+
+    async def warmup(self, connections: int = None):
+        await super().warmup(connections)
+        for r in self.routes:
+            if r.contextual_chat.connection_pool is not self.connection_pool:
+                await r.contextual_chat.warmup(connections)
+
+    async def aclose(self):
+        await super().aclose()
+        for r in self.routes:
+            if r.contextual_chat.connection_pool is not self.connection_pool:
+                await r.contextual_chat.aclose()
+
+    def get_stats(self) -> dict:
+        return {r.name: {"model": r.contextual_chat.model, **r.circuit_breaker.get_stats()} for r in self.routes}
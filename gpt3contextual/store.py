@@ -0,0 +1,175 @@
+import logging
+from typing import Callable
+from .cache import ContextCache
+from .models import Context
+
+logger = logging.getLogger(__name__)
+
+
+class ContextStore:
+    # Base of the storages of contexts. `session` is the SQLAlchemy session of the turn
+    # and the stores that don't use database (e.g. RedisContextStore) just ignore it
+    def __init__(
+        self,
+        timeout=300,
+        username: str = "Human",
+        agentname: str = "AI",
+        chat_description: str = None,
+        history_count: int = 10,
+        cache: ContextCache = None,
+        history_retention: int = 100
+    ) -> None:
+
+        self.timeout = timeout
+        self.username = username
+        self.agentname = agentname
+        self.chat_description = chat_description or ""
+        self.history_count = history_count
+        self.cache = cache
+        self.history_retention = history_retention
+        # Functions called with the key of the removed context (None for all), e.g. LongTermMemory.remove
+        self.remove_listeners = []
+
+    def get_retention(self, context: Context) -> int:
+        # Never drop histories used in prompt. 0 means unlimited
+        if not self.history_retention:
+            return 0
+        return max(self.history_retention, context.history_count)
+
+    def get_cached(self, key: str) -> Context:
+        if self.cache is None:
+            return None
+
+        data = self.cache.get(key, ttl=self.timeout)
+        if data is None:
+            return None
+
+        return Context(**data)
+
+    def put_cache(self, context: Context):
+        if self.cache is not None:
+            self.cache.set(context.key, context.to_dict())
+
+    def remove_cache(self, key: str = None):
+        # Remove all when key is None
+        if self.cache is None:
+            return
+        if key is None:
+            self.cache.clear()
+        else:
+            self.cache.remove(key)
+
+    def add_remove_listener(self, func: Callable[[str], None]):
+        if func not in self.remove_listeners:
+            self.remove_listeners.append(func)
+
+    def notify_remove(self, key: str = None):
+        # Notify all when key is None
+        for func in self.remove_listeners:
+            try:
+                func(key)
+            except Exception as ex:
+                logger.error(f"Failed to notify the removal of context: {ex}")
+
+    def make_context(self, key: str) -> Context:
+        return Context(
+            key=key,
+            username=self.username,
+            agentname=self.agentname,
+            chat_description=self.chat_description,
+            history_count=self.history_count,
+            histories="[]"
+        )
+
+    def apply_reset(
+        self,
+        context: Context,
+        username: str = None,
+        agentname: str = None,
+        chat_description: str = None,
+        history_count: int = None
+    ):
+        if username:
+            context.username = username
+        if agentname:
+            context.agentname = agentname
+        if chat_description:
+            context.chat_description = chat_description
+        if history_count:
+            context.history_count = history_count
+        context.clear_history()
+
+    def get(self, session, key: str) -> Context:
+        raise NotImplementedError("get() is not implemented")
+
+    def set(self, session, context: Context, commit: bool = True):
+        # commit=False leaves the commit to the caller that writes the turn in one transaction.
+        # The stores that don't use database write immediately regardless of it
+        raise NotImplementedError("set() is not implemented")
+
+    def reset(
+        self,
+        session,
+        key: str,
+        username: str = None,
+        agentname: str = None,
+        chat_description: str = None,
+        history_count: int = None,
+        commit: bool = True,
+        forget: bool = True
+    ):
+        # forget=False keeps the data related to the context (e.g. long-term memory) on the reset by error
+        context = self.get(session, key)
+        self.apply_reset(context, username, agentname, chat_description, history_count)
+        self.set(session, context, commit=commit)
+        if forget:
+            self.notify_remove(key)
+
+    def get_many(self, session, keys: list[str]) -> dict[str, Context]:
+        return {k: self.get(session, k) for k in keys}
+
+    def set_many(self, session, contexts: list[Context], commit: bool = True):
+        for context in contexts:
+            self.set(session, context, commit=commit)
+
+    def remove(self, session, key: str):
+        raise NotImplementedError("remove() is not implemented")
+
+    def remove_all(self, session):
+        raise NotImplementedError("remove_all() is not implemented")
+
+    async def get_async(self, session, key: str) -> Context:
+        raise NotImplementedError("get_async() is not implemented")
+
+    async def set_async(self, session, context: Context, commit: bool = True):
+        raise NotImplementedError("set_async() is not implemented")
+
+    async def reset_async(
+        self,
+        session,
+        key: str,
+        username: str = None,
+        agentname: str = None,
+        chat_description: str = None,
+        history_count: int = None,
+        commit: bool = True,
+        forget: bool = True
+    ):
+        context = await self.get_async(session, key)
+        self.apply_reset(context, username, agentname, chat_description, history_count)
+        await self.set_async(session, context, commit=commit)
+        if forget:
+            self.notify_remove(key)
+
+    async def get_many_async(self, session, keys: list[str]) -> dict[str, Context]:
+        return {k: await self.get_async(session, k) for k in keys}
+
+    async def set_many_async(self, session, contexts: list[Context], commit: bool = True):
+        for context in contexts:
+            await self.set_async(session, context, commit=commit)
+
+    async def remove_async(self, session, key: str):
+        raise NotImplementedError("remove_async() is not implemented")
+
+    async def remove_all_async(self, session):
+        raise NotImplementedError("remove_all_async() is not implemented")
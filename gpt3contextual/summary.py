@@ -0,0 +1,66 @@
+import asyncio
+from typing import Callable
+from .models import Context
+
+
+class Summarizer:
+    # Fold old histories into the summary. Pass func(summary, histories, context) -> str or override summarize()
+    def __init__(self, func: Callable[[str, list[str], Context], str] = None) -> None:
+        self.func = func
+
+    def summarize(self, summary: str, histories: list[str], context: Context) -> str:
+        if self.func is None:
+            raise NotImplementedError("summarize() is not implemented")
+        return self.func(summary, histories, context)
+
+    async def summarize_async(self, summary: str, histories: list[str], context: Context) -> str:
+        # Run the blocking summarize() in a thread not to stall the other turns
+        return await asyncio.to_thread(self.summarize, summary, histories, context)
+
+
+class CompletionSummarizer(Summarizer):
+    # Summarize by ChatCompletion API
+    DEFAULT_INSTRUCTION = "Update the summary of the conversation with the new lines. " \
+        "Keep the facts, names and promises that the speakers may refer to later. Answer only the summary."
+
+    def __init__(
+        self,
+        api_key: str,
+        model: str = "gpt-3.5-turbo",
+        instruction: str = None,
+        temperature: float = 0.0,
+        max_tokens: int = 500,
+        **completion_params
+    ) -> None:
+
+        super().__init__()
+        self.api_key = api_key
+        self.model = model
+        self.instruction = instruction or self.DEFAULT_INSTRUCTION
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.completion_params = completion_params
+
+    def make_params(self, summary: str, histories: list[str], context: Context) -> dict:
+        lines = "\n".join(histories)
+        return {
+            **self.completion_params,
+            "api_key": self.api_key,
+            "model": self.model,
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens,
+            "messages": [
+                {"role": "system", "content": self.instruction},
+                {"role": "user", "content": f"[Speakers]\n{context.username}, {context.agentname}\n\n[Summary]\n{summary or ''}\n\n[New lines]\n{lines}"}
+            ]
+        }
+
+    def summarize(self, summary: str, histories: list[str], context: Context) -> str:
+        from openai import ChatCompletion
+        completion = ChatCompletion.create(**self.make_params(summary, histories, context))
+        return completion["choices"][0]["message"]["content"].strip()
+
+    async def summarize_async(self, summary: str, histories: list[str], context: Context) -> str:
+        from openai import ChatCompletion
+        completion = await ChatCompletion.acreate(**self.make_params(summary, histories, context))
+        return completion["choices"][0]["message"]["content"].strip()
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Callable
+from sqlalchemy import select, delete, func
+from sqlalchemy.orm import sessionmaker
+from .chat import ContextManager
+from .models import Context
+
+logger = logging.getLogger(__name__)
+
+
+class ContextSweeper:
+    def __init__(
+        self,
+        context_manager: ContextManager,
+        get_session: sessionmaker,
+        *,
+        timeout: int = None,
+        max_rows: int = None,
+        batch_size: int = 500,
+        archive: Callable[[list[dict]], None] = None,
+        forget_evicted: bool = True
+    ) -> None:
+
+        self.context_manager = context_manager
+        self.get_session = get_session
+        # Contexts idle longer than timeout are removed. Default is ContextManager.timeout
+        self.timeout = timeout
+        # Least recently updated contexts are removed when the count exceeds max_rows
+        self.max_rows = max_rows
+        self.batch_size = batch_size
+        # Function to save the removed contexts (list of dict). Called in the transaction of removing them,
+        # so they are not removed when it raises
+        self.archive = archive
+        # Notify the remove listeners (e.g. LongTermMemory) of the contexts removed over max_rows.
+        # Idle contexts are not notified to recall them in the later sessions
+        self.forget_evicted = forget_evicted
+
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.sweep_count = 0
+        self.expired_total = 0
+        self.evicted_total = 0
+        self.last_result = None
+
+    def remove_batch(self, session, stmt, expired_at: int = None, forget: bool = False) -> int:
+        # stmt selects id and updated_at of the contexts to remove
+        candidates = session.execute(stmt).all()
+        if not candidates:
+            return 0
+
+        # Keep the contexts updated by the turns after they are selected
+        if expired_at is None:
+            expired_at = max(c.updated_at for c in candidates) + 1
+        table = Context.__table__
+        conditions = [table.c.id.in_([c.id for c in candidates]), table.c.updated_at < expired_at]
+        if session.get_bind().dialect.delete_returning:
+            rows = [dict(r) for r in session.execute(delete(table).where(*conditions).returning(*table.c)).mappings().all()]
+        else:
+            # Lock the rows not to be updated until they are removed (e.g. MySQL)
+            rows = [dict(r) for r in session.execute(select(table).where(*conditions).with_for_update()).mappings().all()]
+            if rows:
+                session.execute(delete(table).where(table.c.id.in_([r["id"] for r in rows]), conditions[1]))
+
+        # Archive only the removed contexts
+        rows.sort(key=lambda r: (r["updated_at"], r["id"]))
+        if rows and self.archive:
+            self.archive(rows)
+        session.commit()
+
+        for r in rows:
+            self.context_manager.remove_cache(r["key"])
+            if forget:
+                self.context_manager.notify_remove(r["key"])
+
+        return len(rows)
+
+    def sweep(self) -> dict:
+        start_time = time.perf_counter()
+        timeout = self.timeout or self.context_manager.timeout
+        expired_at = int(datetime.utcnow().timestamp()) - timeout
+        expired_count = 0
+        evicted_count = 0
+
+        with self.get_session() as session:
+            # Remove idle contexts
+            stmt = select(Context.id, Context.updated_at).where(Context.updated_at < expired_at) \
+                .order_by(Context.updated_at).limit(self.batch_size)
+            while True:
+                removed_count = self.remove_batch(session, stmt, expired_at)
+                expired_count += removed_count
+                if removed_count < self.batch_size:
+                    break
+
+            # Remove least recently updated contexts over capacity
+            if self.max_rows:
+                over_count = session.execute(select(func.count(Context.id))).scalar() - self.max_rows
+                while over_count > 0:
+                    stmt = select(Context.id, Context.updated_at).order_by(Context.updated_at) \
+                        .limit(min(self.batch_size, over_count))
+                    removed_count = self.remove_batch(session, stmt, forget=self.forget_evicted)
+                    if removed_count == 0:
+                        break
+                    evicted_count += removed_count
+                    over_count -= removed_count
+
+        self.sweep_count += 1
+        self.expired_total += expired_count
+        self.evicted_total += evicted_count
+        self.last_result = {
+            "expired": expired_count,
+            "evicted": evicted_count,
+            "duration": time.perf_counter() - start_time
+        }
+        return self.last_result
+
+    def sweep_safely(self):
+        try:
+            self.sweep()
+        except Exception as ex:
+            logger.error(f"Failed to sweep contexts: {ex}")
+
+    async def run_async(self, interval: float = 60):
+        # Run as asyncio task: asyncio.create_task(sweeper.run_async())
+        loop = asyncio.get_running_loop()
+        while True:
+            await loop.run_in_executor(None, self.sweep_safely)
+            await asyncio.sleep(interval)
+
+    def start(self, interval: float = 60):
+        # Run in background thread
+        if self.thread is not None:
+            return
+
+        self.stop_event.clear()
+
+        def run():
+            while True:
+                self.sweep_safely()
+                if self.stop_event.wait(interval):
+                    break
+
+        self.thread = threading.Thread(target=run, name="ContextSweeper", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout: float = None):
+        if self.thread is None:
+            return
+
+        self.stop_event.set()
+        self.thread.join(timeout)
+        self.thread = None
+
+    def get_stats(self) -> dict:
+        return {
+            "sweeps": self.sweep_count,
+            "expired_total": self.expired_total,
+            "evicted_total": self.evicted_total,
+            "last_result": self.last_result
+        }
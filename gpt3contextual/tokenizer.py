@@ -0,0 +1,57 @@
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+# Max tokens of prompt and completion for each model
+MODEL_CONTEXT_TOKENS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-0301": 4096,
+    "gpt-4": 8192,
+    "gpt-4-0314": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-32k-0314": 32768,
+    "text-davinci-003": 4097,
+    "text-davinci-002": 4097,
+    "text-curie-001": 2049,
+    "text-babbage-001": 2049,
+    "text-ada-001": 2049
+}
+DEFAULT_CONTEXT_TOKENS = 4096
+
+
+def get_context_tokens(model: str) -> int:
+    return MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS)
+
+
+def approximate_token_count(text: str) -> int:
+    # About 4 ASCII characters or 1 non-ASCII character (e.g. Japanese) per token.
+    # Count non-ASCII characters by the length of UTF-8 bytes not to loop in Python
+    char_count = len(text)
+    non_ascii_count = (len(text.encode("utf-8")) - char_count) // 2
+    ascii_count = char_count - non_ascii_count
+    return (ascii_count + 3) // 4 + non_ascii_count
+
+
+class TokenCounter:
+    def __init__(self, tokenizer: Callable[[str], int] = None, cache_size: int = 10000) -> None:
+        # tokenizer is a function that returns the count of tokens in text (e.g. using tiktoken)
+        self.tokenizer = tokenizer or approximate_token_count
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def count(self, text: str) -> int:
+        with self.lock:
+            token_count = self.cache.get(text)
+            if token_count is not None:
+                self.cache.move_to_end(text)
+                return token_count
+
+        token_count = self.tokenizer(text)
+
+        with self.lock:
+            self.cache[text] = token_count
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return token_count
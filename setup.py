@@ -11,7 +11,7 @@ setup(
     description="Contextual chat with ChatGPT / GPT-3 of OpenAI API.",
     long_description=open("README.md").read(),
     long_description_content_type="text/markdown",
-    packages=find_packages(exclude=["examples*", "tests*"]),
+    packages=find_packages(exclude=["examples*", "tests*", "benchmarks*"]),
     install_requires=["openai==0.27.0", "SQLAlchemy==2.0.4"],
     license="MIT",
     classifiers=[
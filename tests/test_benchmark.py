@@ -0,0 +1,64 @@
+import asyncio
+import openai
+from uuid import uuid4
+from gpt3contextual import ContextualChat, ContextualChatGPT
+from benchmarks.bench_chat import run_benchmark, percentile
+from benchmarks import bench_params, bench_import
+from benchmarks.stub_server import StubOpenAIServer
+
+
+class TestBenchmark:
+    def test_percentile(self):
+        values = [i / 100 for i in range(1, 101)]
+        assert percentile(values, 50) == 0.5
+        assert percentile(values, 95) == 0.95
+        assert percentile(values, 99) == 0.99
+        assert percentile([], 50) == 0.0
+
+    def test_run_benchmark(self):
+        result = run_benchmark(requests=10, concurrency=2, history_depth=4, latency=0.0, response_size=50)
+        assert len(result["results"]) == 4
+        for r in result["results"]:
+            assert r["requests"] == 10
+            assert r["errors"] == 0
+            assert r["throughput_rps"] > 0
+            assert r["latency_ms"]["p50"] <= r["latency_ms"]["p99"]
+
+    def test_bench_params(self):
+        result = bench_params.run_benchmark(iterations=100, history_depth=4, logit_bias_size=10)
+        assert [r["api"] for r in result["results"]] == ["chat", "completion"]
+        for r in result["results"]:
+            assert r["legacy_us"] > 0
+            assert r["compiled_us"] > 0
+
+    def test_bench_import(self):
+        result = bench_import.run_benchmark(runs=1)["result"]
+        # Heavy dependencies are not imported until they are used
+        assert result["loaded_modules"] == []
+        # Schema is checked only by the first instance
+        assert result["second_instance_ms"] < result["first_instance_ms"]
+
+    def test_legacy_params(self, tmp_path):
+        # Legacy implementation in benchmark builds the same params
+        for chat_class in [ContextualChatGPT, ContextualChat]:
+            cc = chat_class("sk-stub", f"sqlite:///{tmp_path}/test_params.db", logit_bias={"1": -1})
+            context = cc.context_manager.make_context(str(uuid4()))
+            context.add_histories(["hello", "hi"])
+            assert bench_params.legacy_make_request_params(cc, context, "hey") == cc.make_request_params(context, "hey", None)
+
+    def test_stub_stream(self, tmp_path):
+        server = StubOpenAIServer(latency=0.0, response_size=30).start()
+        original_api_base = openai.api_base
+        openai.api_base = server.api_base
+
+        try:
+            cc = ContextualChatGPT("sk-stub", f"sqlite:///{tmp_path}/test_stub.db")
+
+            async def run():
+                return [d async for d in cc.chat_stream(str(uuid4()), "hello")]
+
+            assert "".join(asyncio.run(run())) == ("lorem ipsum " * 3)[:30]
+
+        finally:
+            openai.api_base = original_api_base
+            server.stop()
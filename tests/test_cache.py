@@ -0,0 +1,93 @@
+import time
+from gpt3contextual.cache import ContextCache, ResponseCache, SQLiteResponseCache
+
+
+class TestContextCache:
+    def test_get_set(self):
+        cache = ContextCache(max_size=10)
+        assert cache.get("key1") is None
+        cache.set("key1", {"key": "key1"})
+        assert cache.get("key1") == {"key": "key1"}
+        assert cache.hits == 1
+        assert cache.misses == 1
+        assert cache.get_stats()["hit_rate"] == 0.5
+
+    def test_lru(self):
+        cache = ContextCache(max_size=2)
+        cache.set("key1", {"key": "key1"})
+        cache.set("key2", {"key": "key2"})
+        cache.get("key1")   # key2 becomes least recently used
+        cache.set("key3", {"key": "key3"})
+        assert cache.get("key2") is None
+        assert cache.get("key1") == {"key": "key1"}
+        assert cache.get("key3") == {"key": "key3"}
+        assert cache.evictions == 1
+
+    def test_ttl(self):
+        cache = ContextCache()
+        cache.set("key1", {"key": "key1"})
+        assert cache.get("key1", ttl=1) == {"key": "key1"}
+        time.sleep(1.5)
+        assert cache.get("key1", ttl=1) is None
+
+        # ttl of cache itself has priority
+        cache = ContextCache(ttl=100)
+        cache.set("key1", {"key": "key1"})
+        time.sleep(1.5)
+        assert cache.get("key1", ttl=1) == {"key": "key1"}
+
+    def test_remove_clear(self):
+        cache = ContextCache()
+        cache.set("key1", {"key": "key1"})
+        cache.set("key2", {"key": "key2"})
+        cache.remove("key1")
+        assert cache.get("key1") is None
+        assert cache.get("key2") == {"key": "key2"}
+        cache.clear()
+        assert cache.get("key2") is None
+
+
+class TestResponseCache:
+    def test_make_key(self):
+        cache = ResponseCache()
+        key = cache.make_key({"api_key": "key1", "model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": "hi"}]})
+        # Stable for order of keys and api_key
+        assert key == cache.make_key({"messages": [{"role": "user", "content": "hi"}], "model": "gpt-3.5-turbo", "api_key": "key2"})
+        assert key != cache.make_key({"model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": "hello"}]})
+
+    def test_get_set(self):
+        cache = ResponseCache(max_size=1)
+        params = {"api_key": "key1", "model": "gpt-3.5-turbo", "temperature": 0}
+        assert cache.get_completion(params) is None
+        cache.set_completion(params, {"choices": [{"text": "hi"}]})
+        assert cache.get_completion(params) == {"choices": [{"text": "hi"}]}
+        cache.set_completion({"model": "gpt-4"}, {"choices": [{"text": "hello"}]})
+        assert cache.get_completion(params) is None
+        assert cache.get_stats()["hit_rate"] == 1 / 3
+
+
+class TestSQLiteResponseCache:
+    def test_get_set(self, tmp_path):
+        path = str(tmp_path / "response_cache.db")
+        cache = SQLiteResponseCache(path, max_size=2, ttl=1)
+        params = {"model": "gpt-3.5-turbo", "temperature": 0}
+        assert cache.get_completion(params) is None
+        cache.set_completion(params, {"choices": [{"text": "こんにちは"}]})
+        cache.close()
+
+        # Persisted
+        cache = SQLiteResponseCache(path, max_size=2, ttl=1)
+        assert cache.get_completion(params) == {"choices": [{"text": "こんにちは"}]}
+
+        # Evict least recently used
+        cache.set_completion({"model": "a"}, {"choices": []})
+        cache.get_completion(params)
+        cache.set_completion({"model": "b"}, {"choices": []})
+        assert cache.get_completion({"model": "a"}) is None
+        assert cache.get_stats()["size"] == 2
+        assert cache.evictions == 1
+
+        # Expired
+        time.sleep(1.5)
+        assert cache.get_completion(params) is None
+        cache.close()
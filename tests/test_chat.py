@@ -1,5 +1,7 @@
 import pytest
+import asyncio
 import json
+import time
 from uuid import uuid4
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
@@ -7,11 +9,16 @@ from gpt3contextual.chat import (
     ContextualChat,
     ContextualChatGPT,
     ContextManager,
-    CompletionException
+    CompletionException,
+    CompletionTimeoutException
 )
 from gpt3contextual.models import Context, create_tables
+from gpt3contextual.lock import KeyedLock
+from gpt3contextual.cache import ResponseCache
+from gpt3contextual.ratelimit import RateLimiter, RetryPolicy
 
 connection_str = "sqlite:///test_chat.db"
+async_connection_str = "sqlite+aiosqlite:///test_chat.db"
 openai_apikey = "SET_YOUR_OPENAI_API_KEY"
 
 
@@ -294,3 +301,650 @@ class TestContextualChatGPT:
             assert context.chat_description == "Just echo the text from A"
             assert context.history_count == 4
             assert context.get_histories() == "line04\nline04\nhello\nhello"
+
+
+class TestAsyncStorage:
+    def test_chat(self, get_session, monkeypatch):
+        pytest.importorskip("aiosqlite")
+
+        async def acreate(**params):
+            return {
+                "object": "chat.completion",
+                "choices": [{"message": {"role": "assistant", "content": params["messages"][-1]["content"]}}]
+            }
+        monkeypatch.setattr("openai.ChatCompletion.acreate", acreate)
+
+        key = str(uuid4())
+        cm = ContextManager()
+        cc = ContextualChatGPT(openai_apikey, connection_str, cm, async_connection_str=async_connection_str)
+
+        with get_session() as session:
+            cm.set(session, Context(
+                key=key,
+                username="A",
+                agentname="B",
+                chat_description="Just echo the text from A",
+                history_count=4,
+                histories=json.dumps(["line01", "line01", "line02", "line02"])
+            ))
+
+        resp, params, _ = asyncio.run(cc.chat(key, "hello"))
+
+        assert resp == "hello"
+        with get_session() as session:
+            context = cm.get(session, key)
+            assert context.get_histories() == "line02\nline02\nhello\nhello"
+
+    def test_async_only(self, get_session, monkeypatch):
+        pytest.importorskip("aiosqlite")
+
+        async def acreate(**params):
+            return {
+                "object": "chat.completion",
+                "choices": [{"message": {"role": "assistant", "content": params["messages"][-1]["content"]}}]
+            }
+        monkeypatch.setattr("openai.ChatCompletion.acreate", acreate)
+
+        key = str(uuid4())
+        cm = ContextManager()
+        # Sync engine is not created for async driver
+        cc = ContextualChatGPT(openai_apikey, async_connection_str, cm)
+        assert cc.engine is None
+        assert cc.get_session is None
+        assert cc.async_connection_str == async_connection_str
+
+        resp, _, _ = asyncio.run(cc.chat(key, "hello"))
+        assert resp == "hello"
+        with get_session() as session:
+            assert cm.get(session, key).get_histories() == "hello\nhello"
+
+        with pytest.raises(ValueError):
+            cc.chat_sync(key, "hello")
+
+    def test_concurrent_first_turns(self, tmp_path, monkeypatch):
+        pytest.importorskip("aiosqlite")
+
+        async def acreate(**params):
+            return {
+                "object": "chat.completion",
+                "choices": [{"message": {"role": "assistant", "content": params["messages"][-1]["content"]}}]
+            }
+        monkeypatch.setattr("openai.ChatCompletion.acreate", acreate)
+
+        # Tables are created by the first turns on the new database
+        cc = ContextualChatGPT(openai_apikey, f"sqlite+aiosqlite:///{tmp_path}/test_first_turns.db", ContextManager())
+
+        async def run():
+            return await asyncio.gather(*[cc.chat(str(uuid4()), f"hello{i}") for i in range(30)])
+        results = asyncio.run(run())
+        assert [r[0] for r in results] == [f"hello{i}" for i in range(30)]
+
+    def test_different_database(self):
+        pytest.importorskip("aiosqlite")
+
+        with pytest.raises(ValueError):
+            ContextualChatGPT(openai_apikey, connection_str, ContextManager(), async_connection_str="sqlite+aiosqlite:///other.db")
+        with pytest.raises(ValueError):
+            ContextualChatGPT(openai_apikey, None, ContextManager(), async_connection_str=async_connection_str)
+
+
+class TestKeyLock:
+    def test_chat_same_key(self, get_session, monkeypatch):
+        async def acreate(**params):
+            await asyncio.sleep(0.1)
+            return {
+                "object": "chat.completion",
+                "choices": [{"message": {"role": "assistant", "content": params["messages"][-1]["content"]}}]
+            }
+        monkeypatch.setattr("openai.ChatCompletion.acreate", acreate)
+
+        key = str(uuid4())
+        cm = ContextManager(history_count=10)
+        cc = ContextualChatGPT(openai_apikey, connection_str, cm, key_lock=KeyedLock())
+
+        async def run():
+            return await asyncio.gather(cc.chat(key, "hello"), cc.chat(key, "hello again"))
+
+        asyncio.run(run())
+
+        with get_session() as session:
+            # Both turns are stored without lost update
+            assert cm.get(session, key).get_histories() == "hello\nhello\nhello again\nhello again"
+
+
+class TestChatStream:
+    def test_chat_stream(self, get_session, monkeypatch):
+        async def acreate(**params):
+            assert params["stream"] is True
+
+            async def stream():
+                for t in ["Hel", "lo", "!"]:
+                    yield {"id": "chatcmpl-1", "object": "chat.completion.chunk", "model": "gpt-3.5-turbo", "choices": [{"index": 0, "delta": {"content": t}, "finish_reason": None}]}
+                yield {"id": "chatcmpl-1", "object": "chat.completion.chunk", "model": "gpt-3.5-turbo", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            return stream()
+        monkeypatch.setattr("openai.ChatCompletion.acreate", acreate)
+
+        key = str(uuid4())
+        cm = ContextManager()
+        cc = ContextualChatGPT(openai_apikey, connection_str, cm)
+
+        async def run():
+            return [d async for d in cc.chat_stream(key, "hello")]
+
+        assert asyncio.run(run()) == ["Hel", "lo", "!"]
+
+        with get_session() as session:
+            assert cm.get(session, key).get_histories() == "hello\nHello!"
+
+    def test_chat_stream_completion(self, get_session, monkeypatch):
+        async def acreate(**params):
+            async def stream():
+                for t in [" Hi", " there"]:
+                    yield {"id": "cmpl-1", "object": "text_completion", "model": "text-davinci-003", "choices": [{"index": 0, "text": t, "finish_reason": None}]}
+            return stream()
+        monkeypatch.setattr("openai.Completion.acreate", acreate)
+
+        key = str(uuid4())
+        cm = ContextManager(username="A", agentname="B")
+        cc = ContextualChat(openai_apikey, connection_str, cm)
+
+        async def run():
+            return [d async for d in cc.chat_stream(key, "hello", temperature=0.0)]
+
+        assert "".join(asyncio.run(run())) == " Hi there"
+
+        with get_session() as session:
+            assert cm.get(session, key).get_histories() == "A:hello\nB:Hi there"
+
+
+
+class TestDeadline:
+    def test_timeout(self, get_session, monkeypatch):
+        cancelled = []
+
+        async def acreate(**params):
+            try:
+                await asyncio.sleep(1.0 if params["messages"][-1]["content"] == "slow" else 0)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+            return {
+                "object": "chat.completion",
+                "choices": [{"message": {"role": "assistant", "content": params["messages"][-1]["content"]}}]
+            }
+        monkeypatch.setattr("openai.ChatCompletion.acreate", acreate)
+
+        key = str(uuid4())
+        cm = ContextManager()
+        cc = ContextualChatGPT(openai_apikey, connection_str, cm)
+        asyncio.run(cc.chat(key, "hello", timeout=1.0))
+
+        # In-flight request is cancelled and context is not updated
+        with pytest.raises(CompletionTimeoutException):
+            asyncio.run(cc.chat(key, "slow", timeout=0.05))
+        assert cancelled == [True]
+
+        # Deadline in the past raises without requesting
+        with pytest.raises(CompletionTimeoutException):
+            asyncio.run(cc.chat(key, "hello again", deadline=time.time() - 1))
+
+        with get_session() as session:
+            assert cm.get(session, key).get_histories() == "hello\nhello"
+
+    def test_lock_wait(self, monkeypatch):
+        async def acreate(**params):
+            await asyncio.sleep(0.2)
+            return {
+                "object": "chat.completion",
+                "choices": [{"message": {"role": "assistant", "content": params["messages"][-1]["content"]}}]
+            }
+        monkeypatch.setattr("openai.ChatCompletion.acreate", acreate)
+
+        key = str(uuid4())
+        cc = ContextualChatGPT(openai_apikey, connection_str, ContextManager(), key_lock=KeyedLock())
+
+        async def run():
+            return await asyncio.gather(cc.chat(key, "hello"), cc.chat(key, "hello again", timeout=0.05), return_exceptions=True)
+
+        first, second = asyncio.run(run())
+        assert first[0] == "hello"
+        assert isinstance(second, CompletionTimeoutException)
+        assert cc.key_lock.get_stats()["active_keys"] == 0
+
+    def test_timeout_in_turn(self, monkeypatch):
+        async def acreate(**params):
+            # Timeout not caused by the deadline (e.g. socket.timeout of the store)
+            raise TimeoutError("socket timeout")
+        monkeypatch.setattr("openai.ChatCompletion.acreate", acreate)
+
+        cc = ContextualChatGPT(openai_apikey, connection_str, ContextManager(), key_lock=KeyedLock())
+        with pytest.raises(CompletionException) as ex_info:
+            asyncio.run(cc.chat(str(uuid4()), "hello", timeout=1.0))
+        assert not isinstance(ex_info.value, CompletionTimeoutException)
+
+        def get(session, key):
+            raise TimeoutError("socket timeout")
+        monkeypatch.setattr(cc.context_manager, "get", get)
+        with pytest.raises(TimeoutError):
+            asyncio.run(cc.chat(str(uuid4()), "hello", timeout=1.0))
+
+    def test_chat_stream(self, get_session, monkeypatch):
+        async def acreate(**params):
+            async def stream():
+                for t in ["Hel", "lo", "!"]:
+                    if t == "!":
+                        await asyncio.sleep(1.0)
+                    yield {"id": "chatcmpl-1", "object": "chat.completion.chunk", "model": "gpt-3.5-turbo", "choices": [{"index": 0, "delta": {"content": t}, "finish_reason": None}]}
+            return stream()
+        monkeypatch.setattr("openai.ChatCompletion.acreate", acreate)
+
+        key = str(uuid4())
+        cm = ContextManager()
+        cc = ContextualChatGPT(openai_apikey, connection_str, cm)
+        deltas = []
+
+        async def run():
+            async for d in cc.chat_stream(key, "hello", timeout=0.1):
+                deltas.append(d)
+
+        with pytest.raises(CompletionTimeoutException):
+            asyncio.run(run())
+        assert deltas == ["Hel", "lo"]
+
+        with get_session() as session:
+            assert cm.get(session, key).get_histories() == ""
+
+    def test_finish_persisting(self):
+        cc = ContextualChatGPT(openai_apikey, connection_str)
+        saved = []
+
+        async def save():
+            await asyncio.sleep(0.1)
+            saved.append(True)
+
+        async def run():
+            task = asyncio.create_task(cc.finish_persisting(save()))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        # Cancelled caller waits for the writing
+        asyncio.run(run())
+        assert saved == [True]
+
+
+class TestUnitOfWork:
+    def get_log_count(self, session, marker: str, response_text: str = None) -> int:
+        from sqlalchemy import select, func
+        from gpt3contextual.models import CompletionLog
+        stmt = select(func.count(CompletionLog.id)).where(CompletionLog.prompt.like(f"%{marker}%"))
+        if response_text is not None:
+            stmt = stmt.where(CompletionLog.text == response_text)
+        return session.execute(stmt).scalar()
+
+    def test_single_commit(self, get_session, monkeypatch):
+        from sqlalchemy import event
+
+        async def acreate(**params):
+            content = params["messages"][-1]["content"]
+            if content.startswith("error"):
+                return {"error": {"message": "error"}}
+            return {
+                "object": "chat.completion",
+                "choices": [{"message": {"role": "assistant", "content": content}}]
+            }
+        monkeypatch.setattr("openai.ChatCompletion.acreate", acreate)
+
+        key = str(uuid4())
+        cm = ContextManager()
+        for cc, engine in [
+            (ContextualChatGPT(openai_apikey, connection_str, cm), None),
+            (ContextualChatGPT(openai_apikey, connection_str, cm, async_connection_str=async_connection_str), "async")
+        ]:
+            engine = cc.async_engine.sync_engine if engine else cc.engine
+            # Tables are prepared on the first turn
+            asyncio.run(cc.chat(key, "hello"))
+            commits = []
+
+            def on_commit(conn):
+                commits.append(True)
+            event.listen(engine, "commit", on_commit)
+
+            try:
+                asyncio.run(cc.chat(key, f"hello {key}"))
+                # Log and context are written by one commit
+                assert len(commits) == 1
+
+                # Error completion resets context and writes the log in one commit
+                with pytest.raises(CompletionException):
+                    asyncio.run(cc.chat(key, f"error {key}"))
+                assert len(commits) == 2
+
+            finally:
+                event.remove(engine, "commit", on_commit)
+
+            with get_session() as session:
+                assert cm.get(session, key).get_histories() == ""
+
+        with get_session() as session:
+            assert self.get_log_count(session, f"hello {key}", f"hello {key}") == 2
+            assert self.get_log_count(session, f"error {key}", "") == 2
+
+    def test_rollback(self, get_session, monkeypatch):
+        async def acreate(**params):
+            return {
+                "object": "chat.completion",
+                "choices": [{"message": {"role": "assistant", "content": params["messages"][-1]["content"]}}]
+            }
+        monkeypatch.setattr("openai.ChatCompletion.acreate", acreate)
+
+        key = str(uuid4())
+        cm = ContextManager()
+        cc = ContextualChatGPT(openai_apikey, connection_str, cm)
+        asyncio.run(cc.chat(key, "hello"))
+
+        def set(session, context, commit=True):
+            raise RuntimeError("Failed to write context")
+        monkeypatch.setattr(cm, "set", set)
+
+        # Log is not written without the context
+        with pytest.raises(RuntimeError):
+            asyncio.run(cc.chat(key, f"hello again {key}"))
+
+        with get_session() as session:
+            assert self.get_log_count(session, f"hello again {key}") == 0
+            assert cm.get(session, key).get_histories() == "hello\nhello"
+
+class TestTokenBudget:
+    def test_make_prompt(self):
+        cc = ContextualChat(openai_apikey, connection_str, token_budget=True, tokenizer=lambda t: len(t.split()), context_tokens=30, max_tokens=10)
+
+        context = Context(
+            key=str(uuid4()),
+            username="A",
+            agentname="B",
+            chat_description="conversation",
+            history_count=2,
+            histories=json.dumps(["A:one two three", "B:four five", "A:six", "B:seven eight"])
+        )
+
+        # 30 - 10 - (1 + 3 + 2) = 14 tokens for histories with newline (1 token) each
+        prompt = cc.make_prompt(context, "hello there")
+        assert prompt == "conversation\nA:one two three\nB:four five\nA:six\nB:seven eight\nA:hello there\nB:"
+
+        cc.max_tokens = 18
+        prompt = cc.make_prompt(context, "hello there")
+        assert prompt == "conversation\nA:six\nB:seven eight\nA:hello there\nB:"
+
+    def test_make_messages(self):
+        cc = ContextualChatGPT(openai_apikey, connection_str, token_budget=True, tokenizer=lambda t: len(t.split()), context_tokens=40, max_tokens=10)
+
+        context = Context(
+            key=str(uuid4()),
+            username="A",
+            agentname="B",
+            chat_description="conversation",
+            history_count=2,
+            histories=json.dumps(["one", "two", "three", "four"])
+        )
+
+        # 40 - 10 - (7 + 1 + 8 + 3) = 11 tokens for histories with 4 tokens per message
+        messages = cc.make_messages(context, "hello")
+        assert [m["content"] for m in messages[1:]] == ["three", "four", "hello"]
+        assert messages[1]["role"] == "user"
+
+
+class TestResponseCache:
+    def test_chat(self, get_session, monkeypatch):
+        calls = []
+
+        async def acreate(**params):
+            calls.append(params)
+            return {
+                "object": "chat.completion",
+                "choices": [{"message": {"role": "assistant", "content": "Welcome!"}}]
+            }
+        monkeypatch.setattr("openai.ChatCompletion.acreate", acreate)
+
+        cm = ContextManager()
+        cc = ContextualChatGPT(openai_apikey, connection_str, cm, response_cache=ResponseCache(), temperature=0)
+
+        key1 = str(uuid4())
+        key2 = str(uuid4())
+        resp1, _, _ = asyncio.run(cc.chat(key1, "hello"))
+        resp2, _, _ = asyncio.run(cc.chat(key2, "hello"))
+        assert resp1 == resp2 == "Welcome!"
+        assert len(calls) == 1
+        assert cc.response_cache.hits == 1
+
+        # Context is updated with cached response
+        with get_session() as session:
+            assert cm.get(session, key2).get_histories() == "hello\nWelcome!"
+
+
+class TestRetry:
+    def test_chat(self, monkeypatch):
+        from openai import error
+        calls = []
+
+        async def acreate(**params):
+            calls.append(params)
+            if len(calls) < 3:
+                raise error.RateLimitError("rate limited")
+            return {
+                "object": "chat.completion",
+                "choices": [{"message": {"role": "assistant", "content": "hi"}}]
+            }
+        monkeypatch.setattr("openai.ChatCompletion.acreate", acreate)
+
+        cc = ContextualChatGPT(
+            openai_apikey, connection_str,
+            rate_limiter=RateLimiter(requests_per_minute=60, tokens_per_minute=100000),
+            retry_policy=RetryPolicy(base_delay=0.01)
+        )
+        resp, _, _ = asyncio.run(cc.chat(str(uuid4()), "hello"))
+        assert resp == "hi"
+        assert len(calls) == 3
+        assert cc.rate_limiter.get_stats()["acquired"] == 3
+
+        # Give up after max_retries
+        calls.clear()
+        cc.retry_policy = RetryPolicy(max_retries=1, base_delay=0.01)
+        with pytest.raises(CompletionException):
+            asyncio.run(cc.chat(str(uuid4()), "hello"))
+        assert len(calls) == 2
+
+
+class TestChatMany:
+    def make_acreate(self, marker, running, max_running):
+        async def acreate(**params):
+            running.append(1)
+            max_running.append(len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+            text = params["messages"][-1]["content"]
+            if text == "error":
+                raise Exception("API error")
+            if text == "empty":
+                return {"object": "chat.completion", "error": "empty"}
+            return {
+                "object": "chat.completion",
+                "choices": [{"message": {"role": "assistant", "content": f"{marker}:{text}"}}]
+            }
+        return acreate
+
+    def test_chat_many(self, get_session, monkeypatch):
+        from sqlalchemy import event, select, func
+        from gpt3contextual.models import CompletionLog
+
+        marker = str(uuid4())
+        running = []
+        max_running = []
+        monkeypatch.setattr("openai.ChatCompletion.acreate", self.make_acreate(marker, running, max_running))
+
+        cm = ContextManager()
+        cc = ContextualChatGPT(openai_apikey, connection_str, cm)
+        key1, key2, key3 = str(uuid4()), str(uuid4()), str(uuid4())
+        with get_session() as session:
+            context = cm.get(session, key3)
+            context.add_histories(["old", "history"])
+            cm.set(session, context)
+
+        selects = []
+        event.listen(cc.engine, "before_cursor_execute", lambda conn, cursor, statement, *args: selects.append(statement) if statement.startswith("SELECT") else None)
+
+        items = [(key1, "hello"), (key2, "error"), (key1, "again", {"temperature": 0}), (key3, "empty")] + \
+            [(str(uuid4()), f"item{i}") for i in range(6)]
+
+        async def run():
+            return [r async for r in cc.chat_many(items, concurrency=3, batch_size=4)]
+        results = asyncio.run(run())
+
+        assert sorted(r.index for r in results) == list(range(len(items)))
+        assert max(max_running) <= 3
+        # Contexts are loaded by one query
+        assert len([s for s in selects if "FROM contexts" in s]) == 1
+
+        results = {r.index: r for r in results}
+        assert results[0].response_text == f"{marker}:hello"
+        assert results[0].error is None
+        assert results[2].params["temperature"] == 0
+        assert isinstance(results[1].error, CompletionException)
+        assert isinstance(results[3].error, CompletionException)
+        assert results[3].error.completion_response == {"object": "chat.completion", "error": "empty"}
+
+        with get_session() as session:
+            # Turns for the same key are processed in order
+            assert cm.get(session, key1).get_histories_as_list() == ["hello", f"{marker}:hello", "again", f"{marker}:again"]
+            assert cm.get(session, key2).get_histories_as_list() == []
+            assert cm.get(session, key3).get_histories_as_list() == []
+            assert cm.get(session, items[4][0]).get_histories_as_list() == ["item0", f"{marker}:item0"]
+            log_count = session.execute(select(func.count(CompletionLog.id)).where(CompletionLog.text.like(f"{marker}:%"))).scalar()
+            assert log_count == 8
+
+    def test_chat_many_async_session(self, get_session, monkeypatch):
+        marker = str(uuid4())
+        monkeypatch.setattr("openai.ChatCompletion.acreate", self.make_acreate(marker, [], []))
+
+        cm = ContextManager()
+        cc = ContextualChatGPT(openai_apikey, connection_str, cm, async_connection_str=async_connection_str)
+        key = str(uuid4())
+
+        async def run():
+            return [r async for r in cc.chat_many([(key, "hello"), (key, "again")])]
+        results = asyncio.run(run())
+        assert [r.response_text for r in results] == [f"{marker}:hello", f"{marker}:again"]
+
+        with get_session() as session:
+            assert cm.get(session, key).get_histories_as_list() == ["hello", f"{marker}:hello", "again", f"{marker}:again"]
+
+    def test_chat_many_committed(self, get_session, monkeypatch):
+        marker = str(uuid4())
+        monkeypatch.setattr("openai.ChatCompletion.acreate", self.make_acreate(marker, [], []))
+
+        cm = ContextManager()
+        cc = ContextualChatGPT(openai_apikey, connection_str, cm)
+        items = [(str(uuid4()), f"item{i}") for i in range(5)]
+
+        async def run():
+            async for result in cc.chat_many(items, batch_size=2):
+                # Turn is committed when the result is yielded
+                with get_session() as session:
+                    assert cm.get(session, result.context_key).get_histories_as_list() == [result.text, f"{marker}:{result.text}"]
+        asyncio.run(run())
+
+    def test_chat_many_write_error(self, monkeypatch):
+        marker = str(uuid4())
+        monkeypatch.setattr("openai.ChatCompletion.acreate", self.make_acreate(marker, [], []))
+
+        cm = ContextManager()
+        cc = ContextualChatGPT(openai_apikey, connection_str, cm)
+
+        def set_many(*args, **kwargs):
+            raise Exception("DB error")
+        monkeypatch.setattr(cm, "set_many", set_many)
+
+        async def run():
+            return [r async for r in cc.chat_many([(str(uuid4()), "hello"), (str(uuid4()), "error")])]
+        results = {r.text: r for r in asyncio.run(run())}
+        # Error of writing is set to the results of the batch
+        assert str(results["hello"].error) == "DB error"
+        assert str(results["error"].error) == "API error"
+
+    def test_chat_many_key_lock(self, get_session, monkeypatch):
+        marker = str(uuid4())
+        monkeypatch.setattr("openai.ChatCompletion.acreate", self.make_acreate(marker, [], []))
+
+        cm = ContextManager(history_count=10)
+        key_lock = KeyedLock()
+        cc = ContextualChatGPT(openai_apikey, connection_str, cm, key_lock=key_lock)
+        key = str(uuid4())
+
+        async def run_many():
+            return [r async for r in cc.chat_many([(key, "many1"), (key, "many2")])]
+
+        async def run():
+            await asyncio.gather(run_many(), cc.chat(key, "single"))
+        asyncio.run(run())
+
+        # Turns are not overwritten by each other
+        with get_session() as session:
+            histories = cm.get(session, key).get_histories_as_list()
+        assert sorted(histories[::2]) == ["many1", "many2", "single"]
+        assert len(key_lock.entries) == 0
+
+
+class TestTemplates:
+    def test_base_params(self):
+        cc = ContextualChatGPT(openai_apikey, connection_str, logit_bias={"1": -1})
+        context = cc.context_manager.make_context(str(uuid4()))
+
+        params1 = cc.make_request_params(context, "hello", None)
+        params2 = cc.make_request_params(context, "hi", None)
+        assert params1 is not params2
+        assert params1["logit_bias"] == {"1": -1}
+        # Static parts are built once
+        assert params1["messages"][0]["content"] is params2["messages"][0]["content"]
+        assert cc.get_base_params() is cc.get_base_params()
+
+        # Modifying the returned params doesn't affect the next request
+        params1["logit_bias"]["2"] = 1
+        params1["messages"][0]["content"] = "modified"
+        params = cc.make_request_params(context, "hello", None)
+        assert params["logit_bias"] == {"1": -1}
+        assert params["messages"][0]["content"] != "modified"
+
+        # Changing settings invalidates base params
+        cc.model = "gpt-4"
+        cc.temperature = 0.1
+        cc.completion_params = {"presence_penalty": 0.5}
+        params = cc.make_request_params(context, "hello", None)
+        assert params["model"] == "gpt-4"
+        assert params["temperature"] == 0.1
+        assert params["presence_penalty"] == 0.5
+        assert "logit_bias" not in params
+
+    def test_persona(self):
+        cc = ContextualChat(openai_apikey, connection_str)
+        context = cc.context_manager.make_context(str(uuid4()))
+        params = cc.make_request_params(context, "hello", None)
+        assert params["stop"] == ["Human:", "AI:"]
+        params["stop"].append("modified")
+        assert cc.make_request_params(context, "hello", None)["stop"] == ["Human:", "AI:"]
+
+        context.username = "兄"
+        context.agentname = "妹"
+        assert cc.make_request_params(context, "hello", None)["stop"] == ["兄:", "妹:"]
+
+        cc = ContextualChatGPT(openai_apikey, connection_str)
+        context.chat_description = "仲良し"
+        assert cc.make_messages(context, "hello")[0]["content"].endswith("[Conditions]\n仲良し")
+        context.chat_description = "喧嘩中"
+        assert cc.make_messages(context, "hello")[0]["content"].endswith("[Conditions]\n喧嘩中")
+
+        cc.TEMPLATE_CACHE_SIZE = 2
+        for i in range(5):
+            context.username = f"user{i}"
+            assert cc.make_messages(context, "hello")[0]["content"].startswith(f"[Roles]\nuser: user{i}\n")
+        assert len(cc.templates) <= 2
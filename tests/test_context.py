@@ -1,13 +1,17 @@
 import pytest
+import asyncio
 import json
 import time
 from uuid import uuid4
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, select, func
 from sqlalchemy.orm import sessionmaker
-from gpt3contextual.models import Context, create_tables
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from gpt3contextual.models import Context, create_tables, create_tables_async
 from gpt3contextual.chat import ContextManager
+from gpt3contextual.cache import ContextCache
 
 connection_str = "sqlite:///test_context.db"
+async_connection_str = "sqlite+aiosqlite:///test_context.db"
 
 
 @pytest.fixture
@@ -95,6 +99,18 @@ class TestContextManager:
         manager.set(session, context)
         assert manager.get(session, key).histories == context.histories
 
+        # Setting new context object with the same key updates existing row
+        manager.set(session, Context(
+            key=key,
+            username="Alice",
+            agentname="Bob",
+            chat_description="A conversation between Alice and Bob",
+            history_count=6,
+            histories=json.dumps(["hi"])
+        ))
+        assert session.execute(select(func.count(Context.id)).where(Context.key == key)).scalar() == 1
+        assert manager.get(session, key).histories == json.dumps(["hi"])
+
         session.close()
 
     def test_reset(self, get_session):
@@ -127,6 +143,36 @@ class TestContextManager:
 
         session.close()
 
+    def test_compact_histories(self, get_session):
+        key1 = str(uuid4())
+        key2 = str(uuid4())
+
+        manager = ContextManager(history_retention=0)
+        session = get_session()
+        manager.set(session, Context(
+            key=key1,
+            username="Alice",
+            agentname="Bob",
+            chat_description="",
+            history_count=2,
+            histories=json.dumps([f"line{i:02}" for i in range(20)])
+        ))
+        manager.set(session, Context(
+            key=key2,
+            username="Alice",
+            agentname="Bob",
+            chat_description="",
+            history_count=8,
+            histories=json.dumps([f"line{i:02}" for i in range(20)])
+        ))
+
+        assert manager.compact_histories(session, retention=4) >= 2
+        assert json.loads(manager.get(session, key1).histories) == ["line16", "line17", "line18", "line19"]
+        # history_count is larger than retention
+        assert len(json.loads(manager.get(session, key2).histories)) == 8
+
+        session.close()
+
     def test_remove(self, get_session):
         key = str(uuid4())
 
@@ -163,3 +209,140 @@ class TestContextManager:
         assert context.history_count == 6
 
         session.close()
+
+
+class TestContextManagerAsync:
+    async def get_async_session(self):
+        engine = create_async_engine(async_connection_str)
+        await create_tables_async(engine)
+        return async_sessionmaker(autoflush=False, expire_on_commit=False, bind=engine)
+
+    def test_get_set(self):
+        pytest.importorskip("aiosqlite")
+
+        async def run():
+            key1 = str(uuid4())
+            key2 = str(uuid4())
+
+            manager = ContextManager(
+                timeout=300,
+                username="Alice",
+                agentname="Bob",
+                chat_description="A conversation between Alice and Bob",
+                history_count=6,
+            )
+
+            get_async_session = await self.get_async_session()
+            async with get_async_session() as session:
+                context = await manager.get_async(session, key1)
+                assert context.username == "Alice"
+                assert context.agentname == "Bob"
+                assert context.history_count == 6
+
+                await manager.set_async(session, Context(
+                    key=key2,
+                    username="A",
+                    agentname="B",
+                    chat_description="A and B",
+                    history_count=10,
+                    histories=json.dumps(["line01", "line02"])
+                ))
+
+            async with get_async_session() as session:
+                context = await manager.get_async(session, key2)
+                assert context.username == "A"
+                assert context.get_histories() == "line01\nline02"
+
+        asyncio.run(run())
+
+    def test_reset_remove(self):
+        pytest.importorskip("aiosqlite")
+
+        async def run():
+            key = str(uuid4())
+
+            manager = ContextManager(
+                timeout=300,
+                username="Alice",
+                agentname="Bob",
+                chat_description="A conversation between Alice and Bob",
+                history_count=6,
+            )
+
+            get_async_session = await self.get_async_session()
+            async with get_async_session() as session:
+                await manager.set_async(session, Context(
+                    key=key,
+                    username="Alice",
+                    agentname="Bob",
+                    chat_description="A conversation between Alice and Bob",
+                    history_count=6,
+                    histories=json.dumps(["hi", "hello"])
+                ))
+                await manager.reset_async(session, key, username="Chris", agentname="Dave")
+                context = await manager.get_async(session, key)
+                assert context.username == "Chris"
+                assert context.agentname == "Dave"
+                assert context.histories == json.dumps([])
+
+                await manager.remove_async(session, key)
+
+            async with get_async_session() as session:
+                context = await manager.get_async(session, key)
+                assert context.username == "Alice"
+                assert context.agentname == "Bob"
+
+        asyncio.run(run())
+
+
+class TestContextManagerWithCache:
+    def test_get_set(self, get_session):
+        key = str(uuid4())
+        cache = ContextCache()
+        manager = ContextManager(timeout=300, username="Alice", agentname="Bob", history_count=6, cache=cache)
+
+        session = get_session()
+        context = manager.get(session, key)
+        assert context.username == "Alice"
+        assert cache.misses == 1
+
+        context.add_history("hi")
+        manager.set(session, context)
+        session.close()
+
+        session = get_session()
+        context = manager.get(session, key)
+        assert context.get_histories() == "hi"
+        assert cache.hits == 1
+
+        # Update via cached context works
+        context.add_history("hello")
+        manager.set(session, context)
+        session.close()
+
+        cache.clear()
+        session = get_session()
+        assert manager.get(session, key).get_histories() == "hi\nhello"
+        session.close()
+
+    def test_invalidation(self, get_session):
+        key = str(uuid4())
+        cache = ContextCache()
+        manager = ContextManager(timeout=300, username="Alice", agentname="Bob", history_count=6, cache=cache)
+
+        session = get_session()
+        context = manager.get(session, key)
+        context.add_history("hi")
+        manager.set(session, context)
+
+        manager.reset(session, key, username="Chris")
+        assert Context(**cache.get(key)).username == "Chris"
+        assert manager.get(session, key).get_histories() == ""
+
+        manager.remove(session, key)
+        assert cache.get(key) is None
+
+        manager.get(session, key)
+        manager.remove_all(session)
+        assert cache.get_stats()["size"] == 0
+        session.close()
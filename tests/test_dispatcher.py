@@ -0,0 +1,60 @@
+import asyncio
+from gpt3contextual.dispatcher import EventDispatcher
+
+
+class TestEventDispatcher:
+    def test_dispatch(self):
+        handled = []
+        running = []
+        max_running = []
+
+        async def handler(event):
+            key, i = event
+            running.append(event)
+            max_running.append(len(running))
+            await asyncio.sleep(0.05 if i == 0 else 0.01)
+            running.remove(event)
+            if i < 0:
+                raise ValueError("error")
+            handled.append(event)
+            return f"{key}:{i}"
+
+        dispatcher = EventDispatcher(handler, lambda ev: ev[0], concurrency=3)
+        events = [(f"user{u}", i) for i in range(3) for u in range(5)] + [("user0", -1)]
+        results = asyncio.run(dispatcher.dispatch(events))
+
+        assert results[:15] == [f"{k}:{i}" for k, i in events[:15]]
+        assert isinstance(results[15], ValueError)
+        assert max(max_running) == 3
+        # Events of the same user are handled in the order of events
+        for u in range(5):
+            assert [i for k, i in handled if k == f"user{u}"] == [0, 1, 2]
+
+        stats = dispatcher.get_stats()
+        assert stats["dispatched"] == 16
+        assert stats["completed"] == 15
+        assert stats["failed"] == 1
+        assert stats["running"] == 0
+        assert stats["running_max"] == 3
+        assert stats["key_lock"]["active_keys"] == 0
+
+    def test_dispatch_nowait(self):
+        handled = []
+
+        async def handler(event):
+            await asyncio.sleep(0.01)
+            handled.append(event)
+
+        dispatcher = EventDispatcher(handler, lambda ev: None, concurrency=10)
+
+        async def run():
+            dispatcher.dispatch_nowait([1, 2])
+            dispatcher.dispatch_nowait([3])
+            await dispatcher.join()
+
+        asyncio.run(run())
+        assert sorted(handled) == [1, 2, 3]
+        assert dispatcher.get_stats()["pending"] == 0
+        # Semaphore is recreated for another event loop
+        asyncio.run(dispatcher.dispatch([4]))
+        assert handled[-1] == 4
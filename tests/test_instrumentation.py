@@ -0,0 +1,128 @@
+import pytest
+import asyncio
+from uuid import uuid4
+from gpt3contextual.chat import ContextualChatGPT, CompletionException
+from gpt3contextual.instrumentation import ChatObserver, Histogram, MetricsAggregator
+
+connection_str = "sqlite:///test_chat.db"
+openai_apikey = "SET_YOUR_OPENAI_API_KEY"
+
+
+class RecordingObserver(ChatObserver):
+    def __init__(self) -> None:
+        self.events = []
+
+    def on_stage(self, stage, context_key, elapsed, info, error=None):
+        self.events.append((stage, context_key, elapsed, info, error))
+
+
+def mock_completion(monkeypatch, content="Welcome!"):
+    async def acreate(**params):
+        return {
+            "object": "chat.completion",
+            "choices": [{"message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": 20, "completion_tokens": 5, "total_tokens": 25}
+        }
+    monkeypatch.setattr("openai.ChatCompletion.acreate", acreate)
+
+
+class TestHistogram:
+    def test_observe(self):
+        h = Histogram(buckets=(0.1, 1.0))
+        for v in [0.05, 0.5, 0.7, 5.0]:
+            h.observe(v)
+        assert h.counts == [1, 2, 1]
+        assert h.get_cumulative_counts() == [1, 3, 4]
+        assert h.count == 4
+        assert h.sum == pytest.approx(6.25)
+        assert h.get_quantile(0.5) == 1.0
+        assert h.get_quantile(0.99) == float("inf")
+
+
+class TestMetricsAggregator:
+    def test_on_stage(self):
+        metrics = MetricsAggregator()
+        metrics.on_stage("completion", "key", 0.2, {})
+        metrics.on_stage("completion", "key", 0.3, {}, Exception("error"))
+        metrics.on_stage("turn", "key", 0.5, {"prompt_size": 100, "response_size": 10, "prompt_tokens": 20, "completion_tokens": 5, "total_tokens": 25})
+
+        stats = metrics.get_stats()
+        assert stats["stages"]["completion"]["count"] == 2
+        assert stats["stages"]["completion"]["errors"] == 1
+        assert stats["stages"]["completion"]["mean"] == pytest.approx(0.25)
+        assert stats["stages"]["turn"]["count"] == 1
+        assert stats["tokens"] == {"prompt_tokens": 20, "completion_tokens": 5, "total_tokens": 25}
+        assert stats["prompt_size_total"] == 100
+        assert stats["response_size_total"] == 10
+
+        text = metrics.render_prometheus()
+        assert 'gpt3contextual_stage_duration_seconds_bucket{stage="completion",le="0.25"} 1' in text
+        assert 'gpt3contextual_stage_duration_seconds_bucket{stage="completion",le="+Inf"} 2' in text
+        assert 'gpt3contextual_stage_duration_seconds_count{stage="turn"} 1' in text
+        assert 'gpt3contextual_stage_errors_total{stage="completion"} 1' in text
+        assert 'gpt3contextual_tokens_total{type="prompt"} 20' in text
+
+        metrics.reset()
+        assert metrics.get_stats()["stages"] == {}
+
+
+class TestObserver:
+    def test_chat(self, monkeypatch):
+        mock_completion(monkeypatch)
+        observer = RecordingObserver()
+        cc = ContextualChatGPT(openai_apikey, connection_str, observers=[observer])
+
+        key = str(uuid4())
+        asyncio.run(cc.chat(key, "hello"))
+        stages = [e[0] for e in observer.events]
+        assert stages == ["load_context", "build_prompt", "completion", "save_log", "update_context", "turn"]
+        assert all(e[1] == key and e[2] >= 0 and e[4] is None for e in observer.events)
+
+        turn_info = observer.events[-1][3]
+        assert turn_info["prompt_size"] > len("hello")
+        assert turn_info["response_size"] == len("Welcome!")
+        assert turn_info["total_tokens"] == 25
+
+    def test_chat_stream(self, monkeypatch):
+        async def acreate(**params):
+            async def stream():
+                for t in ["Wel", "come!"]:
+                    yield {"choices": [{"delta": {"content": t}, "finish_reason": None}]}
+            return stream()
+        monkeypatch.setattr("openai.ChatCompletion.acreate", acreate)
+
+        metrics = MetricsAggregator()
+        cc = ContextualChatGPT(openai_apikey, connection_str, observers=[metrics])
+
+        async def consume():
+            return [d async for d in cc.chat_stream(str(uuid4()), "hello")]
+        assert asyncio.run(consume()) == ["Wel", "come!"]
+
+        stats = metrics.get_stats()
+        assert set(stats["stages"]) == {"load_context", "build_prompt", "completion", "save_log", "update_context", "turn"}
+        assert stats["response_size_total"] == len("Welcome!")
+
+    def test_chat_sync_error(self, monkeypatch):
+        def create(**params):
+            raise Exception("API error")
+        monkeypatch.setattr("openai.ChatCompletion.create", create)
+
+        observer = RecordingObserver()
+        cc = ContextualChatGPT(openai_apikey, connection_str, observers=[observer])
+        with pytest.raises(CompletionException):
+            cc.chat_sync(str(uuid4()), "hello")
+
+        stages = [e[0] for e in observer.events]
+        assert stages == ["load_context", "build_prompt", "completion", "turn"]
+        assert isinstance(observer.events[2][4], CompletionException)
+        assert isinstance(observer.events[3][4], CompletionException)
+
+    def test_broken_observer(self, monkeypatch):
+        class BrokenObserver(ChatObserver):
+            def on_stage(self, stage, context_key, elapsed, info, error=None):
+                raise Exception("broken")
+
+        mock_completion(monkeypatch)
+        cc = ContextualChatGPT(openai_apikey, connection_str, observers=[BrokenObserver()])
+        resp, _, _ = asyncio.run(cc.chat(str(uuid4()), "hello"))
+        assert resp == "Welcome!"
@@ -0,0 +1,50 @@
+import asyncio
+from gpt3contextual.lock import KeyedLock
+
+
+class TestKeyedLock:
+    def test_same_key_in_order(self):
+        lock = KeyedLock()
+        events = []
+
+        async def work(key: str, name: str, wait: float):
+            async with lock.acquire(key):
+                events.append(f"start:{name}")
+                await asyncio.sleep(wait)
+                events.append(f"end:{name}")
+
+        async def run():
+            await asyncio.gather(
+                work("key1", "a", 0.1),
+                work("key1", "b", 0.0),
+                work("key2", "c", 0.05),
+            )
+
+        asyncio.run(run())
+
+        # Same key doesn't overlap and keeps order
+        assert events.index("end:a") < events.index("start:b")
+        # Other key runs in parallel
+        assert events.index("start:c") < events.index("end:a")
+
+        stats = lock.get_stats()
+        assert stats["active_keys"] == 0
+        assert stats["acquired"] == 3
+        assert stats["waited"] == 1
+        assert stats["queue_depth_max"] == 1
+        assert stats["wait_time_max"] >= 0.09
+
+    def test_release_on_cancel(self):
+        lock = KeyedLock()
+
+        async def run():
+            async with lock.acquire("key1"):
+                waiter = asyncio.create_task(lock.acquire("key1").__aenter__())
+                await asyncio.sleep(0.01)
+                assert lock.get_queue_depth("key1") == 1
+                waiter.cancel()
+                await asyncio.sleep(0.01)
+                assert lock.get_queue_depth("key1") == 0
+
+        asyncio.run(run())
+        assert lock.entries == {}
@@ -0,0 +1,126 @@
+import pytest
+import asyncio
+import json
+from uuid import uuid4
+from sqlalchemy import select, func
+from gpt3contextual.chat import ContextualChatGPT
+from gpt3contextual.logpolicy import LogPolicy, encode_payload, decode_payload, decode_log
+from gpt3contextual.logwriter import CompletionLogWriter
+from gpt3contextual.models import CompletionLog
+
+openai_apikey = "SET_YOUR_OPENAI_API_KEY"
+
+
+def mock_completion(monkeypatch):
+    async def acreate(**params):
+        text = params["messages"][-1]["content"]
+        if text.startswith("error"):
+            return {"object": "chat.completion", "error": {"message": "error"}}
+        return {
+            "object": "chat.completion",
+            "choices": [{"message": {"role": "assistant", "content": f"re:{text}"}}]
+        }
+    monkeypatch.setattr("openai.ChatCompletion.acreate", acreate)
+
+
+def get_logs(cc) -> list[CompletionLog]:
+    with cc.get_session() as session:
+        return session.execute(select(CompletionLog).order_by(CompletionLog.id)).scalars().all()
+
+
+class TestPayload:
+    def test_encode_decode(self):
+        value = json.dumps({"text": "こんにちは" * 100}, ensure_ascii=False)
+        encoded = encode_payload(value, "zlib")
+        assert encoded.startswith("zlib:")
+        assert len(encoded) < len(value.encode("utf-8"))
+        assert decode_payload(encoded) == value
+
+        # Short or plain payloads are stored as is
+        assert encode_payload("{}", "zlib", min_size=256) == "{}"
+        assert encode_payload(value, None) == value
+        assert decode_payload(value) == value
+
+        with pytest.raises(ValueError):
+            LogPolicy(compression="lz4")
+
+    def test_make_record(self):
+        params = {"model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": "hello " * 100}]}
+        completion = {"choices": [{"message": {"role": "assistant", "content": "hi"}}]}
+        record = LogPolicy().make_record("hi", params, completion)
+
+        assert record["prompt"] == json.dumps(params["messages"], ensure_ascii=False)
+        # Prompt is not stored twice and short parameters are not compressed
+        assert record["parameters"] == '{"model": "gpt-3.5-turbo", "$prompt": "messages"}'
+        assert LogPolicy(min_compress_size=0).make_record("hi", params, completion)["parameters"].startswith("zlib:")
+
+        decoded = decode_log(record)
+        assert decoded["parameters"] == params
+        assert decoded["completion"] == completion
+
+        # Logs of legacy format are decoded as well
+        legacy = {"prompt": "p", "text": "t", "parameters": json.dumps({"prompt": "p"}), "completion": "{}"}
+        assert decode_log(legacy)["parameters"] == {"prompt": "p"}
+
+    def test_sampling(self):
+        policy = LogPolicy(success_rate=0.1, error_rate=1.0, seed=1)
+        saved = sum(1 for _ in range(1000) if policy.should_save("hi"))
+        assert 50 < saved < 150
+        assert all(policy.should_save(None) for _ in range(100))
+        stats = policy.get_stats()
+        assert stats["saved"] == saved + 100
+        assert stats["sampled_out"] == 1000 - saved
+
+        assert LogPolicy(success_rate=0.0).make_record("hi", {"prompt": "p"}, {}) is None
+
+
+class TestLogPolicy:
+    def test_chat(self, tmp_path, monkeypatch):
+        mock_completion(monkeypatch)
+        policy = LogPolicy(success_rate=0.0, max_rows=3, prune_interval=2)
+        cc = ContextualChatGPT(openai_apikey, f"sqlite:///{tmp_path}/test_logpolicy.db", log_policy=policy)
+        key = str(uuid4())
+
+        # Successful completions are sampled out and all errors are saved
+        asyncio.run(cc.chat(key, "hello"))
+        for i in range(6):
+            with pytest.raises(Exception):
+                asyncio.run(cc.chat(key, f"error{i}"))
+
+        logs = get_logs(cc)
+        # Pruned to max_rows every 2 logs
+        assert len(logs) == 3
+        decoded = decode_log(logs[-1])
+        assert decoded["parameters"]["messages"][-1]["content"] == "error5"
+        assert decoded["completion"]["error"] == {"message": "error"}
+        assert policy.get_stats() == {"saved": 6, "sampled_out": 1, "pruned": 3}
+
+    def test_max_age(self, tmp_path):
+        cc = ContextualChatGPT(openai_apikey, f"sqlite:///{tmp_path}/test_logpolicy.db")
+        with cc.get_session() as session:
+            session.add(CompletionLog(created_at=0, prompt="old", text="", parameters="{}", completion="{}"))
+            session.commit()
+            policy = LogPolicy(max_age=3600)
+            record = policy.make_record("hi", {"prompt": "new"}, {})
+            session.add(CompletionLog(**record))
+            session.commit()
+            assert policy.prune(session) == 1
+
+        assert [log.prompt for log in get_logs(cc)] == ["new"]
+
+    def test_log_writer(self, tmp_path, monkeypatch):
+        mock_completion(monkeypatch)
+        policy = LogPolicy(max_rows=2, prune_interval=1)
+        log_writer = CompletionLogWriter(batch_size=1, flush_interval=0.1)
+        cc = ContextualChatGPT(openai_apikey, f"sqlite:///{tmp_path}/test_logpolicy.db", log_writer=log_writer, log_policy=policy)
+        assert log_writer.log_policy is policy
+
+        key = str(uuid4())
+        for i in range(4):
+            asyncio.run(cc.chat(key, f"hello{i}"))
+        log_writer.close()
+
+        logs = get_logs(cc)
+        assert [decode_log(log)["text"] for log in logs] == ["re:hello2", "re:hello3"]
+        with cc.get_session() as session:
+            assert session.execute(select(func.count(CompletionLog.id))).scalar() == 2
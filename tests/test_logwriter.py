@@ -0,0 +1,70 @@
+import json
+from sqlalchemy import create_engine, select, func
+from sqlalchemy.orm import sessionmaker
+from gpt3contextual.models import CompletionLog, create_tables
+from gpt3contextual.logwriter import CompletionLogWriter
+
+
+def make_record(i: int) -> dict:
+    return {
+        "created_at": i,
+        "prompt": f"prompt{i}",
+        "text": f"text{i}",
+        "parameters": "{}",
+        "completion": "{}"
+    }
+
+
+def get_sessionmaker(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/test_logwriter.db")
+    create_tables(engine)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def count_logs(get_session) -> int:
+    with get_session() as session:
+        return session.execute(select(func.count(CompletionLog.id))).scalar()
+
+
+class TestCompletionLogWriter:
+    def test_flush(self, tmp_path):
+        get_session = get_sessionmaker(tmp_path)
+        writer = CompletionLogWriter(get_session, batch_size=10, flush_interval=0.1)
+
+        with writer:
+            for i in range(25):
+                assert writer.put(make_record(i)) is True
+
+        assert count_logs(get_session) == 25
+        stats = writer.get_stats()
+        assert stats["queued"] == 25
+        assert stats["flushed"] == 25
+        assert stats["queue_size"] == 0
+
+    def test_overflow_drop(self, tmp_path):
+        get_session = get_sessionmaker(tmp_path)
+        writer = CompletionLogWriter(get_session, max_queue_size=2, overflow="drop")
+
+        # Not started yet so the queue is never consumed
+        assert writer.put(make_record(1)) is True
+        assert writer.put(make_record(2)) is True
+        assert writer.put(make_record(3)) is False
+        assert writer.get_stats()["dropped"] == 1
+
+        writer.start()
+        writer.close()
+        assert count_logs(get_session) == 2
+
+    def test_overflow_spill(self, tmp_path):
+        get_session = get_sessionmaker(tmp_path)
+        spill_path = str(tmp_path / "spill.jsonl")
+        writer = CompletionLogWriter(get_session, max_queue_size=1, overflow="spill", spill_path=spill_path)
+
+        writer.put(make_record(1))
+        writer.put(make_record(2))
+        assert writer.get_stats()["spilled"] == 1
+        with open(spill_path) as f:
+            assert json.loads(f.readline())["prompt"] == "prompt2"
+
+        assert writer.flush_spilled() == 1
+        assert count_logs(get_session) == 1
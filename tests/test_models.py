@@ -1,5 +1,6 @@
 import json
-from gpt3contextual.models import Context, CompletionLog
+from sqlalchemy import create_engine, inspect, text
+from gpt3contextual.models import Context, CompletionLog, create_tables, get_engine, prepare_tables, clear_prepared_tables
 
 
 class TestContext:
@@ -34,6 +35,51 @@ class TestContext:
         context.add_history("line09")
         assert context.get_histories() == "line04\nline05\nline06\nline07\nline08\nline09"
 
+    def test_add_histories_with_retention(self):
+        context = Context(
+            key="1234",
+            username="Alice",
+            agentname="Bob",
+            chat_description="A conversation between Alice and Bob",
+            history_count=4,
+            histories=json.dumps(["line01", "line02", "line03", "line04", "line05", "line06"])
+        )
+        context.add_histories(["line07", "line08"], retention=5)
+        assert json.loads(context.histories) == ["line04", "line05", "line06", "line07", "line08"]
+        assert context.get_histories() == "line05\nline06\nline07\nline08"
+
+        context.add_histories(["line09"])
+        assert len(json.loads(context.histories)) == 6
+
+    def test_history_list_cache(self):
+        context = Context(
+            key="1234",
+            username="Alice",
+            agentname="Bob",
+            chat_description="A conversation between Alice and Bob",
+            history_count=4,
+            histories=json.dumps(["line01", "line02"])
+        )
+        assert context.get_history_list() is context.get_history_list()
+
+        # Parsed again when histories is replaced
+        context.histories = json.dumps(["line03"])
+        assert context.get_histories() == "line03"
+
+    def test_get_histories_within_tokens(self):
+        context = Context(
+            key="1234",
+            username="Alice",
+            agentname="Bob",
+            chat_description="A conversation between Alice and Bob",
+            history_count=2,
+            histories=json.dumps(["a", "bb", "ccc", "dddd"])
+        )
+        assert context.get_histories_within_tokens(7, len) == ["ccc", "dddd"]
+        assert context.get_histories_within_tokens(9, len) == ["bb", "ccc", "dddd"]
+        assert context.get_histories_within_tokens(9, len, tokens_per_history=1) == ["ccc", "dddd"]
+        assert context.get_histories_within_tokens(3, len) == []
+
     def test_clear_history(self):
         context = Context(
             key="1234",
@@ -43,10 +89,88 @@ class TestContext:
             history_count=6,
             histories=json.dumps(["line01", "line02", "line03", "line04", "line05", "line06", "line07", "line08"])
         )
+        context.summary = "summary"
         context.clear_history()
         assert context.get_histories() == ""
+        assert context.summary is None
+
+    def test_fold_histories(self):
+        context = Context(
+            key="1234",
+            username="Alice",
+            agentname="Bob",
+            chat_description="A conversation between Alice and Bob",
+            history_count=2,
+            histories=json.dumps(["line01", "line02", "line03", "line04"])
+        )
+        context.fold_histories(2, "summary of line01 and line02")
+        assert context.get_history_list() == ["line03", "line04"]
+        assert json.loads(context.histories) == ["line03", "line04"]
+        assert context.summary == "summary of line01 and line02"
 
 
 class TestCompletionLog:
     def test_init(self):
         CompletionLog()
+
+
+class TestMigration:
+    def test_create_tables_with_old_schema(self, tmp_path):
+        engine = create_engine(f"sqlite:///{tmp_path}/test_migration.db")
+        with engine.begin() as conn:
+            # Schema of older version without unique index on key
+            conn.execute(text(
+                "CREATE TABLE contexts (id INTEGER PRIMARY KEY AUTOINCREMENT, updated_at INTEGER, key VARCHAR(255) NOT NULL, "
+                "username VARCHAR(255) NOT NULL, agentname VARCHAR(255) NOT NULL, chat_description VARCHAR(2000) NOT NULL, "
+                "history_count INTEGER NOT NULL, histories VARCHAR)"
+            ))
+            for updated_at, histories in [(1, "[\"old\"]"), (3, "[\"latest\"]"), (2, "[\"older\"]")]:
+                conn.execute(text(
+                    "INSERT INTO contexts (updated_at, key, username, agentname, chat_description, history_count, histories) "
+                    f"VALUES ({updated_at}, 'dup', 'A', 'B', '', 10, '{histories}')"
+                ))
+            conn.execute(text(
+                "CREATE TABLE completionlogs (id INTEGER PRIMARY KEY AUTOINCREMENT, created_at INTEGER NOT NULL, "
+                "prompt VARCHAR(2000) NOT NULL, text VARCHAR(2000) NOT NULL, parameters VARCHAR NOT NULL, completion VARCHAR NOT NULL)"
+            ))
+
+        create_tables(engine)
+
+        indexes = {i["name"]: i for i in inspect(engine).get_indexes("contexts")}
+        assert indexes["ix_contexts_key"]["unique"]
+        # Columns added in newer versions
+        assert "summary" in {c["name"] for c in inspect(engine).get_columns("contexts")}
+        assert "model" in {c["name"] for c in inspect(engine).get_columns("completionlogs")}
+        assert "ix_completionlogs_created_at" in {i["name"] for i in inspect(engine).get_indexes("completionlogs")}
+        with engine.connect() as conn:
+            rows = conn.execute(text("SELECT histories FROM contexts WHERE key = 'dup'")).all()
+            assert len(rows) == 1
+            assert rows[0][0] == "[\"latest\"]"
+
+
+class TestEngine:
+    def test_get_engine(self, tmp_path):
+        connection_str = f"sqlite:///{tmp_path}/test_engine.db"
+        engine = get_engine(connection_str)
+        assert get_engine(connection_str) is engine
+        assert get_engine(f"sqlite:///{tmp_path}/test_engine2.db") is not engine
+
+    def test_prepare_tables(self, tmp_path):
+        engine = get_engine(f"sqlite:///{tmp_path}/test_prepare.db")
+
+        # Skip schema check
+        prepare_tables(engine, check_schema=False)
+        assert not inspect(engine).has_table("contexts")
+
+        prepare_tables(engine)
+        assert inspect(engine).has_table("contexts")
+
+        # Tables are created only once for each database
+        with engine.begin() as conn:
+            conn.execute(text("DROP TABLE contexts"))
+        prepare_tables(engine)
+        assert not inspect(engine).has_table("contexts")
+
+        clear_prepared_tables()
+        prepare_tables(engine)
+        assert inspect(engine).has_table("contexts")
@@ -0,0 +1,67 @@
+import asyncio
+import openai
+from uuid import uuid4
+from gpt3contextual import ContextualChatGPT, ConnectionPool
+from benchmarks.stub_server import StubOpenAIServer
+
+
+class TestConnectionPool:
+    def setup_method(self, method):
+        self.server = StubOpenAIServer(latency=0.0, response_size=20).start()
+        self.original_api_base = openai.api_base
+        openai.api_base = self.server.api_base
+
+    def teardown_method(self, method):
+        openai.api_base = self.original_api_base
+        self.server.stop()
+
+    def test_reuse_connection(self, tmp_path):
+        async def run(cc):
+            async with cc:
+                for _ in range(5):
+                    await cc.chat(str(uuid4()), "hello")
+
+        # New connection for each request without pool
+        asyncio.run(run(ContextualChatGPT("sk-stub", f"sqlite:///{tmp_path}/test_pool.db")))
+        assert self.server.connection_count == 5
+
+        self.server.connection_count = 0
+        pool = ConnectionPool(max_connections=10)
+        cc = ContextualChatGPT("sk-stub", f"sqlite:///{tmp_path}/test_pool.db", connection_pool=pool)
+        asyncio.run(run(cc))
+        assert self.server.connection_count == 1
+        assert self.server.request_count == 10
+        # Closed on exit
+        assert pool.session is None
+
+    def test_warmup(self, tmp_path):
+        pool = ConnectionPool(max_connections=10, warmup_connections=3)
+        cc = ContextualChatGPT("sk-stub", f"sqlite:///{tmp_path}/test_pool.db", connection_pool=pool)
+
+        async def run():
+            async with cc:
+                assert self.server.connection_count == 3
+                await asyncio.gather(*[cc.chat(str(uuid4()), "hello") for _ in range(3)])
+
+        asyncio.run(run())
+        assert self.server.connection_count == 3
+
+    def test_stream(self, tmp_path):
+        pool = ConnectionPool()
+        cc = ContextualChatGPT("sk-stub", f"sqlite:///{tmp_path}/test_pool.db", connection_pool=pool)
+
+        async def run():
+            async with pool:
+                return [d async for d in cc.chat_stream(str(uuid4()), "hello")]
+
+        assert "".join(asyncio.run(run())) == ("lorem ipsum " * 2)[:20]
+
+    def test_request_timeout(self, tmp_path):
+        cc = ContextualChatGPT("sk-stub", f"sqlite:///{tmp_path}/test_pool.db", connection_pool=ConnectionPool())
+        assert "request_timeout" not in cc.make_request_kwargs({"model": "gpt-3.5-turbo"})
+
+        cc.connection_pool.connect_timeout = 3.0
+        cc.connection_pool.read_timeout = 30.0
+        assert cc.make_request_kwargs({"model": "gpt-3.5-turbo"})["request_timeout"] == (3.0, 30.0)
+        # Parameter from user is respected
+        assert cc.make_request_kwargs({"request_timeout": 10})["request_timeout"] == 10
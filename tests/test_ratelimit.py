@@ -0,0 +1,53 @@
+import asyncio
+import time
+from openai import error
+from gpt3contextual.ratelimit import TokenBucket, RateLimiter, RetryPolicy
+
+
+class TestTokenBucket:
+    def test_reserve(self):
+        bucket = TokenBucket(2, 10)
+        assert bucket.reserve(1) == 0
+        assert bucket.reserve(1) == 0
+        # 1 token is refilled in 0.1 sec
+        assert 0.09 < bucket.reserve(1) <= 0.1
+        assert 0.19 < bucket.reserve(1) <= 0.2
+
+
+class TestRateLimiter:
+    def test_acquire(self):
+        limiter = RateLimiter(requests_per_minute=600, tokens_per_minute=600)
+
+        async def run():
+            for _ in range(10):
+                await limiter.acquire_async(60)
+
+        start_time = time.monotonic()
+        asyncio.run(run())
+        # Burst up to capacity without waiting
+        assert time.monotonic() - start_time < 0.1
+
+        # 600 tokens are used. 10 tokens are refilled in 1 sec
+        assert 0.9 < limiter.reserve(10) <= 1.0
+        assert limiter.get_stats()["throttled"] == 1
+
+
+class TestRetryPolicy:
+    def test_get_delay(self):
+        policy = RetryPolicy(max_retries=2, base_delay=1.0, max_delay=1.5, deadline=10, jitter=False)
+        ex = error.RateLimitError("rate limited")
+        assert policy.get_delay(ex, 0, 0) == 1.0
+        assert policy.get_delay(ex, 1, 0) == 1.5
+        assert policy.get_delay(ex, 2, 0) is None
+        # Exceeds deadline
+        assert policy.get_delay(ex, 1, 9) is None
+        # Not retryable
+        assert policy.get_delay(error.InvalidRequestError("invalid", None), 0, 0) is None
+        assert policy.get_delay(error.APIError("server error", http_status=502), 0, 0) == 1.0
+        # Retry-After header
+        assert policy.get_delay(error.RateLimitError("rate limited", headers={"retry-after": "3"}), 0, 0) == 3.0
+
+    def test_jitter(self):
+        policy = RetryPolicy(base_delay=1.0, jitter=True)
+        for _ in range(10):
+            assert 0 <= policy.get_delay(error.APIConnectionError("error"), 0, 0) <= 1.0
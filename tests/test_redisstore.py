@@ -0,0 +1,244 @@
+import pytest
+import asyncio
+import json
+import socketserver
+import threading
+import time
+from fnmatch import fnmatchcase
+from uuid import uuid4
+from gpt3contextual.chat import ContextualChatGPT
+from gpt3contextual.redisstore import RedisClient, RedisContextStore, RedisError, encode_command
+
+connection_str = "sqlite:///test_chat.db"
+openai_apikey = "SET_YOUR_OPENAI_API_KEY"
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    def read_command(self) -> list[bytes]:
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def write_bulk(self, value: bytes):
+        if value is None:
+            self.wfile.write(b"$-1\r\n")
+        else:
+            self.wfile.write(b"$%d\r\n%s\r\n" % (len(value), value))
+
+    def handle(self):
+        store = self.server.store
+        while True:
+            args = self.read_command()
+            if args is None:
+                break
+            command = args[0].upper()
+            self.server.commands.append(command)
+
+            if command == b"SET":
+                ttl = int(args[4]) if len(args) > 4 and args[3].upper() == b"EX" else None
+                store[args[1]] = (args[2], self.server.now() + ttl if ttl else None)
+                self.wfile.write(b"+OK\r\n")
+            elif command in (b"GET", b"MGET"):
+                values = [self.server.get_value(k) for k in args[1:]]
+                if command == b"GET":
+                    self.write_bulk(values[0])
+                else:
+                    self.wfile.write(b"*%d\r\n" % len(values))
+                    for v in values:
+                        self.write_bulk(v)
+            elif command == b"DEL":
+                count = sum(1 for k in args[1:] if store.pop(k, None) is not None)
+                self.wfile.write(b":%d\r\n" % count)
+            elif command == b"SCAN":
+                # Return all matched keys at once
+                pattern = args[3].decode("utf-8").replace("\\", "")
+                keys = [k for k in list(store) if fnmatchcase(k.decode("utf-8"), pattern)]
+                self.wfile.write(b"*2\r\n")
+                self.write_bulk(b"0")
+                self.wfile.write(b"*%d\r\n" % len(keys))
+                for k in keys:
+                    self.write_bulk(k)
+            elif command in (b"PING", b"SELECT", b"AUTH"):
+                self.wfile.write(b"+OK\r\n" if command != b"PING" else b"+PONG\r\n")
+            else:
+                self.wfile.write(b"-ERR unknown command '%s'\r\n" % args[0])
+            self.wfile.flush()
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), FakeRedisHandler)
+        self.store = {}
+        self.commands = []
+        self.time_offset = 0
+
+    def now(self) -> float:
+        return time.monotonic() + self.time_offset
+
+    def get_value(self, key: bytes) -> bytes:
+        item = self.store.get(key)
+        if item is None:
+            return None
+        value, expire_at = item
+        if expire_at is not None and expire_at <= self.now():
+            del self.store[key]
+            return None
+        return value
+
+
+@pytest.fixture
+def redis_server():
+    server = FakeRedisServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def store(redis_server):
+    client = RedisClient(*redis_server.server_address)
+    yield RedisContextStore(client, timeout=300)
+    client.close()
+
+
+class TestRedisClient:
+    def test_encode_command(self):
+        assert encode_command(["SET", "key", "値", "EX", 10]) == \
+            b"*5\r\n$3\r\nSET\r\n$3\r\nkey\r\n$3\r\n\xe5\x80\xa4\r\n$2\r\nEX\r\n$2\r\n10\r\n"
+
+    def test_execute(self, redis_server):
+        client = RedisClient(*redis_server.server_address)
+        assert client.execute("SET", "k1", "v1") == "OK"
+        assert client.execute_many([["GET", "k1"], ["MGET", "k1", "k2"]]) == [b"v1", [b"v1", None]]
+        assert client.execute("DEL", "k1", "k2") == 1
+        with pytest.raises(RedisError):
+            client.execute("UNKNOWN")
+        # Connection is reused after error reply
+        assert len(client.idle_connections) == 1
+        assert client.execute("PING") == "PONG"
+        client.close()
+
+    def test_execute_async(self, redis_server):
+        client = RedisClient(*redis_server.server_address)
+
+        async def run():
+            await client.execute_async("SET", "k1", "v1")
+            return await asyncio.gather(*[client.execute_async("GET", "k1") for _ in range(5)])
+        assert asyncio.run(run()) == [b"v1"] * 5
+        # Connections of the closed loop are not reused
+        assert asyncio.run(client.execute_async("GET", "k1")) == b"v1"
+        assert len(client.idle_async_connections) <= 5
+        client.close()
+
+    def test_from_url(self):
+        client = RedisClient.from_url("redis://:pass@redis.local:6380/2")
+        assert (client.host, client.port, client.db, client.password) == ("redis.local", 6380, 2, "pass")
+        assert client.get_init_commands() == [["AUTH", "pass"], ["SELECT", 2]]
+
+
+class TestRedisContextStore:
+    def test_get_set(self, store, redis_server):
+        key = str(uuid4())
+        context = store.get(None, key)
+        assert context.key == key
+        assert context.username == "Human"
+        assert context.get_histories_as_list() == []
+
+        context.username = "兄"
+        context.add_histories(["hello", "hi"])
+        store.set(None, context)
+
+        context = store.get(None, key)
+        assert context.username == "兄"
+        assert context.get_histories_as_list() == ["hello", "hi"]
+        assert context.updated_at > 0
+
+        # Histories expire by TTL but persona remains
+        redis_server.time_offset = 301
+        context = store.get(None, key)
+        assert context.username == "兄"
+        assert context.get_histories_as_list() == []
+
+    def test_reset_remove(self, store):
+        key1 = str(uuid4())
+        key2 = str(uuid4())
+        for key in [key1, key2]:
+            context = store.get(None, key)
+            context.add_histories(["hello", "hi"])
+            store.set(None, context)
+
+        store.reset(None, key1, agentname="妹")
+        context = store.get(None, key1)
+        assert context.agentname == "妹"
+        assert context.get_histories_as_list() == []
+
+        store.remove(None, key1)
+        assert store.get(None, key1).agentname == "AI"
+        assert store.get(None, key2).get_histories_as_list() == ["hello", "hi"]
+
+        store.remove_all(None)
+        assert store.get(None, key2).get_histories_as_list() == []
+
+    def test_get_set_many(self, store, redis_server):
+        keys = [str(uuid4()) for _ in range(3)]
+        contexts = store.get_many(None, keys)
+        assert list(contexts) == keys
+        for i, c in enumerate(contexts.values()):
+            c.add_histories([f"hello{i}", f"hi{i}"])
+        redis_server.commands.clear()
+        store.set_many(None, list(contexts.values()))
+        contexts = store.get_many(None, keys)
+        assert [c.get_histories_as_list() for c in contexts.values()] == [[f"hello{i}", f"hi{i}"] for i in range(3)]
+        assert redis_server.commands == [b"SET"] * 6 + [b"MGET"]
+
+    def test_async(self, store):
+        key = str(uuid4())
+
+        async def run():
+            context = await store.get_async(None, key)
+            context.add_histories(["hello", "hi"])
+            await store.set_async(None, context)
+            await store.reset_async(None, key, username="兄")
+            context = await store.get_async(None, key)
+            assert context.username == "兄"
+            assert context.get_histories_as_list() == []
+            await store.remove_all_async(None)
+            return await store.get_async(None, key)
+
+        assert asyncio.run(run()).username == "Human"
+
+    def test_set_commands(self, store):
+        store.persona_ttl = 86400
+        context = store.get(None, "key")
+        commands = store.make_set_commands(context)
+        assert commands[0][:2] == ["SET", "gpt3contextual:key:persona"]
+        assert commands[0][3:] == ["EX", 86400]
+        assert json.loads(commands[0][2])["history_count"] == 10
+        assert commands[1] == ["SET", "gpt3contextual:key:histories", "[]", "EX", 300]
+
+    def test_chat(self, store, redis_server, monkeypatch):
+        async def acreate(**params):
+            return {
+                "object": "chat.completion",
+                "choices": [{"message": {"role": "assistant", "content": "Welcome!"}}]
+            }
+        monkeypatch.setattr("openai.ChatCompletion.acreate", acreate)
+
+        cc = ContextualChatGPT(openai_apikey, connection_str, store)
+        key = str(uuid4())
+        asyncio.run(cc.chat(key, "hello"))
+        asyncio.run(cc.chat(key, "hello again"))
+        assert store.get(None, key).get_histories_as_list() == ["hello", "Welcome!", "hello again", "Welcome!"]
+        # A turn reads and writes context in one round trip each
+        assert redis_server.commands.count(b"MGET") == 3
+        assert redis_server.commands.count(b"SET") == 4
@@ -0,0 +1,187 @@
+import pytest
+import asyncio
+import json
+import os
+import time
+from uuid import uuid4
+from sqlalchemy import select
+from gpt3contextual.chat import ContextualChat, ContextualChatGPT, ContextManager, CompletionException
+from gpt3contextual.models import Context, CompletionLog
+from gpt3contextual.router import ModelRouter, ModelRoute, CircuitBreaker, convert_histories
+
+openai_apikey = "SET_YOUR_OPENAI_API_KEY"
+
+
+def mock_completion(monkeypatch, calls, failing_models):
+    async def chat_acreate(**params):
+        calls.append(params["model"])
+        if params["model"] in failing_models:
+            raise Exception("Service unavailable")
+        return {
+            "object": "chat.completion",
+            "model": params["model"],
+            "choices": [{"message": {"role": "assistant", "content": f"{params['model']}:{params['messages'][-1]['content']}"}}]
+        }
+
+    async def acreate(**params):
+        calls.append(params["model"])
+        return {
+            "object": "text_completion",
+            "model": params["model"],
+            "choices": [{"text": " fine"}]
+        }
+
+    monkeypatch.setattr("openai.ChatCompletion.acreate", chat_acreate)
+    monkeypatch.setattr("openai.Completion.acreate", acreate)
+
+
+def make_router(tmp_path, routes, **kwargs) -> ModelRouter:
+    return ModelRouter(openai_apikey, routes, f"sqlite:///{tmp_path}/test_router.db", ContextManager(username="A", agentname="B"), **kwargs)
+
+
+class TestCircuitBreaker:
+    def test_open_close(self):
+        breaker = CircuitBreaker(failure_threshold=2, recovery_time=0.05)
+        breaker.record_failure(0.1)
+        assert breaker.allow() is True
+        breaker.record_failure(0.1)
+        assert breaker.state == CircuitBreaker.OPEN
+        assert breaker.allow() is False
+
+        # One trial after recovery_time
+        time.sleep(0.06)
+        assert breaker.allow() is True
+        assert breaker.allow() is False
+        breaker.record_failure(0.1)
+        assert breaker.state == CircuitBreaker.OPEN
+
+        time.sleep(0.06)
+        assert breaker.allow() is True
+        breaker.record_success(0.2)
+        assert breaker.state == CircuitBreaker.CLOSED
+        stats = breaker.get_stats()
+        assert stats["requests"] == 4
+        assert stats["failures"] == 3
+        assert stats["opened"] == 2
+        assert stats["error_rate"] == 0.0
+        assert stats["latency_p95"] == 0.2
+
+    def test_error_rate(self):
+        breaker = CircuitBreaker(failure_threshold=100, error_rate_threshold=0.5, min_requests=10)
+        for i in range(9):
+            breaker.record_success(0.1) if i % 2 else breaker.record_failure(0.1)
+        assert breaker.state == CircuitBreaker.CLOSED
+        breaker.record_failure(0.1)
+        assert breaker.state == CircuitBreaker.OPEN
+
+
+class TestModelRouter:
+    def test_failover(self, tmp_path, monkeypatch):
+        calls = []
+        mock_completion(monkeypatch, calls, {"gpt-4"})
+        router = make_router(tmp_path, [
+            ModelRoute("gpt-4", circuit_breaker=CircuitBreaker(failure_threshold=2)),
+            "gpt-3.5-turbo"
+        ])
+        key = str(uuid4())
+
+        for text in ["hello", "hi", "bye"]:
+            resp, params, _ = asyncio.run(router.chat(key, text))
+            assert resp == f"gpt-3.5-turbo:{text}"
+        # Circuit of gpt-4 is opened after 2 failures
+        assert calls == ["gpt-4", "gpt-3.5-turbo", "gpt-4", "gpt-3.5-turbo", "gpt-3.5-turbo"]
+
+        stats = router.get_stats()
+        assert stats["gpt-4"]["state"] == CircuitBreaker.OPEN
+        assert stats["gpt-3.5-turbo"]["requests"] == 3
+
+        # Model that served each turn is logged
+        with router.get_session() as session:
+            logs = session.execute(select(CompletionLog).order_by(CompletionLog.id)).scalars().all()
+            assert [log.model for log in logs] == ["gpt-3.5-turbo"] * 3
+
+    def test_all_failed(self, tmp_path, monkeypatch):
+        calls = []
+        mock_completion(monkeypatch, calls, {"gpt-4", "gpt-3.5-turbo"})
+        router = make_router(tmp_path, ["gpt-4", "gpt-3.5-turbo"])
+
+        with pytest.raises(CompletionException):
+            asyncio.run(router.chat(str(uuid4()), "hello"))
+        assert calls == ["gpt-4", "gpt-3.5-turbo"]
+
+    def test_history_format(self, tmp_path, monkeypatch):
+        calls = []
+        mock_completion(monkeypatch, calls, {"gpt-3.5-turbo"})
+        router = make_router(tmp_path, ["gpt-3.5-turbo", ModelRoute("text-davinci-003", ContextualChat)])
+        key = str(uuid4())
+        with router.get_session() as session:
+            context = router.context_manager.get(session, key)
+            context.histories = json.dumps(["hello", "hi"])
+            router.context_manager.set(session, context)
+
+        resp, params, _ = asyncio.run(router.chat(key, "how are you?"))
+        assert params["model"] == "text-davinci-003"
+        assert params["prompt"].endswith("A:hello\nB:hi\nA:how are you?\nB:")
+        # Histories are kept in the format of the first route
+        with router.get_session() as session:
+            assert router.context_manager.get(session, key).get_history_list() == ["hello", "hi", "how are you?", "fine"]
+
+    def test_convert_histories(self):
+        context = Context(username="A", agentname="B", histories=json.dumps(["B:hi", "A:hello", "B:A:B"]))
+        assert convert_histories(context, "completion", "chat") == ["hi", "hello", "A:B"]
+        context.histories = json.dumps(["hello", "hi"])
+        assert convert_histories(context, "chat", "completion") == ["A:hello", "B:hi"]
+        assert convert_histories(context, "chat", "chat") == ["hello", "hi"]
+
+    def test_slow_latency(self, tmp_path):
+        slow = ModelRoute("gpt-4")
+        fast = ModelRoute("gpt-3.5-turbo")
+        router = make_router(tmp_path, [slow, fast], slow_latency=1.0)
+        assert router.get_candidates() == [slow, fast]
+        slow.circuit_breaker.record_success(5.0)
+        assert router.get_candidates() == [fast, slow]
+
+    def test_chat_stream(self, tmp_path, monkeypatch):
+        async def acreate(**params):
+            if params["model"] == "gpt-4":
+                raise Exception("Service unavailable")
+
+            async def stream():
+                for t in ["Hel", "lo"]:
+                    yield {"object": "chat.completion.chunk", "model": params["model"], "choices": [{"index": 0, "delta": {"content": t}, "finish_reason": None}]}
+            return stream()
+        monkeypatch.setattr("openai.ChatCompletion.acreate", acreate)
+
+        router = make_router(tmp_path, ["gpt-4", "gpt-3.5-turbo"])
+        key = str(uuid4())
+
+        async def run():
+            return [d async for d in router.chat_stream(key, "hello")]
+
+        assert asyncio.run(run()) == ["Hel", "lo"]
+        with router.get_session() as session:
+            assert router.context_manager.get(session, key).get_history_list() == ["hello", "Hello"]
+
+    def test_route_options(self, tmp_path, monkeypatch):
+        calls = []
+
+        async def acreate(**params):
+            calls.append(params)
+            return {"object": "chat.completion", "model": params["model"], "choices": [{"message": {"role": "assistant", "content": "hi"}}]}
+        monkeypatch.setattr("openai.ChatCompletion.acreate", acreate)
+
+        # Routes don't create the default database
+        monkeypatch.chdir(tmp_path)
+        router = make_router(tmp_path, ["gpt-4", ModelRoute("gpt-3.5-turbo", temperature=0.0)], temperature=0.7, top_p=0.9)
+        assert not os.path.exists("gpt3contextual.db")
+        assert router.routes[0].contextual_chat.engine is None
+
+        # Request settings of router are forwarded and overwritten by the route
+        assert router.routes[0].contextual_chat.temperature == 0.7
+        assert router.routes[1].contextual_chat.temperature == 0.0
+        asyncio.run(router.chat(str(uuid4()), "hello"))
+        assert calls[0]["temperature"] == 0.7
+        assert calls[0]["top_p"] == 0.9
+
+        with pytest.raises(TypeError):
+            make_router(tmp_path, [ContextualChatGPT(openai_apikey, f"sqlite:///{tmp_path}/test_router.db")])
@@ -0,0 +1,154 @@
+import pytest
+import asyncio
+import threading
+import time
+from uuid import uuid4
+from gpt3contextual.chat import ContextualChat, ContextualChatGPT, ContextManager, CompletionTimeoutException
+from gpt3contextual.instrumentation import MetricsAggregator
+from gpt3contextual.summary import Summarizer, CompletionSummarizer
+
+connection_str = "sqlite:///test_chat.db"
+openai_apikey = "SET_YOUR_OPENAI_API_KEY"
+
+
+def stub_summarizer(summary, histories, context):
+    # Keep all folded lines to check what is summarized
+    return " / ".join(([summary] if summary else []) + histories)
+
+
+def mock_completion(monkeypatch, calls):
+    async def acreate(**params):
+        calls.append(params)
+        return {
+            "object": "chat.completion",
+            "choices": [{"message": {"role": "assistant", "content": f"re:{params['messages'][-1]['content']}"}}]
+        }
+    monkeypatch.setattr("openai.ChatCompletion.acreate", acreate)
+
+
+class TestSummary:
+    def test_chat(self, monkeypatch):
+        calls = []
+        mock_completion(monkeypatch, calls)
+
+        cm = ContextManager(history_count=4)
+        cc = ContextualChatGPT(openai_apikey, connection_str, cm, summarizer=stub_summarizer, summary_threshold=6)
+        key = str(uuid4())
+
+        for i in range(3):
+            asyncio.run(cc.chat(key, f"q{i}"))
+        with cc.get_session() as session:
+            context = cm.get(session, key)
+        assert context.summary is None
+        assert len(context.get_history_list()) == 6
+
+        # Histories older than history_count are folded when they exceed threshold
+        asyncio.run(cc.chat(key, "q3"))
+        with cc.get_session() as session:
+            context = cm.get(session, key)
+        assert context.summary == "q0 / re:q0 / q1 / re:q1"
+        assert context.get_history_list() == ["q2", "re:q2", "q3", "re:q3"]
+
+        # Summary is included in system message with recent turns
+        asyncio.run(cc.chat(key, "q4"))
+        messages = calls[-1]["messages"]
+        assert messages[0]["content"].endswith("[Summary of the earlier conversation]\nq0 / re:q0 / q1 / re:q1")
+        assert [m["content"] for m in messages[1:]] == ["q2", "re:q2", "q3", "re:q3", "q4"]
+
+        # Rolling summary
+        for i in range(5, 7):
+            asyncio.run(cc.chat(key, f"q{i}"))
+        with cc.get_session() as session:
+            context = cm.get(session, key)
+        assert context.summary == "q0 / re:q0 / q1 / re:q1 / q2 / re:q2 / q3 / re:q3"
+        assert context.get_history_list() == ["q4", "re:q4", "q5", "re:q5", "q6", "re:q6"]
+
+    def test_retention(self):
+        cm = ContextManager(history_count=2, history_retention=4)
+        cc = ContextualChatGPT(openai_apikey, connection_str, cm, summarizer=stub_summarizer, summary_threshold=8)
+        context = cm.make_context(str(uuid4()))
+        for i in range(4):
+            cc.add_turn_histories(context, f"q{i}", f"a{i}", {"object": "chat.completion"})
+        # Histories are kept until summarized
+        assert len(context.get_history_list()) == 8
+
+        cc.add_turn_histories(context, "q4", "a4", {"object": "chat.completion"})
+        cc.summarize_context(context)
+        assert context.get_history_list() == ["q4", "a4"]
+        assert context.summary.startswith("q0 / a0")
+
+    def test_make_prompt(self):
+        cc = ContextualChat(openai_apikey, connection_str)
+        context = cc.context_manager.make_context(str(uuid4()))
+        context.chat_description = "Chat"
+        context.add_histories(["Human:hi", "AI:hello"])
+        assert cc.make_prompt(context, "yo") == "Chat\nHuman:hi\nAI:hello\nHuman:yo\nAI:"
+
+        context.summary = "They talked about cats"
+        assert cc.make_prompt(context, "yo") == \
+            "Chat\n[Summary of the earlier conversation]\nThey talked about cats\nHuman:hi\nAI:hello\nHuman:yo\nAI:"
+
+    def test_summarizer_error(self, monkeypatch):
+        mock_completion(monkeypatch, [])
+
+        def broken_summarizer(summary, histories, context):
+            raise Exception("summarizer error")
+
+        metrics = MetricsAggregator()
+        cm = ContextManager(history_count=2)
+        cc = ContextualChatGPT(openai_apikey, connection_str, cm, summarizer=broken_summarizer, summary_threshold=2, observers=[metrics])
+        key = str(uuid4())
+        asyncio.run(cc.chat(key, "q0"))
+        resp, _, _ = asyncio.run(cc.chat(key, "q1"))
+        assert resp == "re:q1"
+        with cc.get_session() as session:
+            assert len(cm.get(session, key).get_history_list()) == 4
+        assert metrics.get_stats()["stages"]["summarize"]["errors"] == 1
+
+    def test_summarize_off_loop(self, monkeypatch):
+        mock_completion(monkeypatch, [])
+        threads = []
+
+        def slow_summarizer(summary, histories, context):
+            threads.append(threading.get_ident())
+            time.sleep(0.3)
+            return "summary"
+
+        cm = ContextManager(history_count=2)
+        for async_connection_str in [None, "sqlite+aiosqlite:///test_chat.db"]:
+            cc = ContextualChatGPT(openai_apikey, connection_str, cm, summarizer=slow_summarizer, summary_threshold=2, async_connection_str=async_connection_str)
+            key = str(uuid4())
+            asyncio.run(cc.chat(key, "q0"))
+
+            # Summarizer runs in a thread and deadline cancels the turn without writing
+            with pytest.raises(CompletionTimeoutException):
+                asyncio.run(cc.chat(key, "q1", timeout=0.1))
+            assert threads[-1] != threading.get_ident()
+            with cc.get_session() as session:
+                context = cm.get(session, key)
+            assert context.summary is None
+            assert context.get_history_list() == ["q0", "re:q0"]
+
+    def test_summarizer_class(self):
+        with pytest.raises(NotImplementedError):
+            Summarizer().summarize(None, [], None)
+
+        class UpperSummarizer(Summarizer):
+            def summarize(self, summary, histories, context):
+                return " ".join(histories).upper()
+        assert asyncio.run(UpperSummarizer().summarize_async(None, ["a", "b"], None)) == "A B"
+
+    def test_completion_summarizer(self, monkeypatch):
+        calls = []
+
+        async def acreate(**params):
+            calls.append(params)
+            return {"choices": [{"message": {"role": "assistant", "content": " new summary "}}]}
+        monkeypatch.setattr("openai.ChatCompletion.acreate", acreate)
+
+        summarizer = CompletionSummarizer(openai_apikey, model="gpt-3.5-turbo", max_tokens=100)
+        context = ContextManager(username="兄", agentname="妹").make_context("key")
+        summary = asyncio.run(summarizer.summarize_async("old summary", ["q0", "a0"], context))
+        assert summary == "new summary"
+        assert calls[0]["max_tokens"] == 100
+        assert calls[0]["messages"][1]["content"] == "[Speakers]\n兄, 妹\n\n[Summary]\nold summary\n\n[New lines]\nq0\na0"
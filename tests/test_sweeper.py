@@ -0,0 +1,113 @@
+import json
+from datetime import datetime
+from sqlalchemy import create_engine, event, select, update, func
+from sqlalchemy.orm import sessionmaker
+from gpt3contextual.models import Context, create_tables
+from gpt3contextual.chat import ContextManager
+from gpt3contextual.cache import ContextCache
+from gpt3contextual.sweeper import ContextSweeper
+
+
+def make_context(key: str) -> Context:
+    return Context(
+        key=key,
+        username="Alice",
+        agentname="Bob",
+        chat_description="",
+        history_count=6,
+        histories=json.dumps(["hi", "hello"])
+    )
+
+
+def prepare(tmp_path, manager: ContextManager, ages: dict):
+    engine = create_engine(f"sqlite:///{tmp_path}/test_sweeper.db")
+    create_tables(engine)
+    get_session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    now = int(datetime.utcnow().timestamp())
+    with get_session() as session:
+        for key, age in ages.items():
+            manager.set(session, make_context(key))
+            session.execute(update(Context).where(Context.key == key).values(updated_at=now - age))
+        session.commit()
+
+    return get_session
+
+
+def get_keys(get_session) -> list[str]:
+    with get_session() as session:
+        return session.execute(select(Context.key).order_by(Context.key)).scalars().all()
+
+
+class TestContextSweeper:
+    def test_sweep_expired(self, tmp_path):
+        manager = ContextManager(timeout=300, cache=ContextCache())
+        get_session = prepare(tmp_path, manager, {"key1": 1000, "key2": 500, "key3": 10, "key4": 0})
+
+        archived = []
+        sweeper = ContextSweeper(manager, get_session, batch_size=1, archive=archived.extend)
+        result = sweeper.sweep()
+
+        assert result["expired"] == 2
+        assert result["evicted"] == 0
+        assert result["duration"] > 0
+        assert get_keys(get_session) == ["key3", "key4"]
+        assert [r["key"] for r in archived] == ["key1", "key2"]
+        assert manager.cache.get("key1") is None
+        assert manager.cache.get("key3") is not None
+
+    def test_sweep_max_rows(self, tmp_path):
+        manager = ContextManager(timeout=300)
+        get_session = prepare(tmp_path, manager, {"key1": 30, "key2": 20, "key3": 10, "key4": 0})
+
+        sweeper = ContextSweeper(manager, get_session, max_rows=2, batch_size=1)
+        result = sweeper.sweep()
+
+        assert result["expired"] == 0
+        assert result["evicted"] == 2
+        assert get_keys(get_session) == ["key3", "key4"]
+        assert sweeper.get_stats()["evicted_total"] == 2
+
+    def test_sweep_updated(self, tmp_path):
+        manager = ContextManager(timeout=300)
+        get_session = prepare(tmp_path, manager, {"key1": 1000, "key2": 1000, "key3": 30, "key4": 20, "key5": 10})
+
+        # Turn updates the context after the sweeper selects it
+        def update_context(conn, cursor, statement, *args):
+            if statement.startswith("DELETE") and targets:
+                with get_session() as session:
+                    context = manager.get(session, targets.pop())
+                    context.username = "Carol"
+                    context.add_histories(["new", "turn"])
+                    manager.set(session, context)
+        event.listen(get_session.kw["bind"], "before_cursor_execute", update_context)
+
+        targets = ["key1"]
+        archived = []
+        sweeper = ContextSweeper(manager, get_session, archive=archived.extend)
+        assert sweeper.sweep()["expired"] == 1
+        assert [r["key"] for r in archived] == ["key2"]
+
+        targets = ["key3"]
+        archived.clear()
+        sweeper = ContextSweeper(manager, get_session, max_rows=2, archive=archived.extend)
+        assert sweeper.sweep()["evicted"] == 2
+        assert [r["key"] for r in archived] == ["key4", "key5"]
+        assert get_keys(get_session) == ["key1", "key3"]
+
+        with get_session() as session:
+            for key in ["key1", "key3"]:
+                context = manager.get(session, key)
+                assert context.username == "Carol"
+                assert context.get_histories_as_list()[-2:] == ["new", "turn"]
+
+    def test_start_stop(self, tmp_path):
+        manager = ContextManager(timeout=300)
+        get_session = prepare(tmp_path, manager, {"key1": 1000})
+
+        sweeper = ContextSweeper(manager, get_session)
+        sweeper.start(interval=10)
+        sweeper.stop()
+
+        with get_session() as session:
+            assert session.execute(select(func.count(Context.id))).scalar() == 0
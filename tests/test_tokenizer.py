@@ -0,0 +1,34 @@
+from gpt3contextual.tokenizer import TokenCounter, approximate_token_count, get_context_tokens
+
+
+class TestTokenizer:
+    def test_approximate_token_count(self):
+        assert approximate_token_count("") == 0
+        assert approximate_token_count("abcd") == 1
+        assert approximate_token_count("hello world") == 3
+        assert approximate_token_count("こんにちは") == 5
+        assert approximate_token_count("hi こんにちは") == 6
+
+    def test_get_context_tokens(self):
+        assert get_context_tokens("gpt-4") == 8192
+        assert get_context_tokens("unknown-model") == 4096
+
+
+class TestTokenCounter:
+    def test_count(self):
+        calls = []
+
+        def tokenizer(text: str) -> int:
+            calls.append(text)
+            return len(text.split())
+
+        counter = TokenCounter(tokenizer, cache_size=2)
+        assert counter.count("a b c") == 3
+        assert counter.count("a b c") == 3
+        assert calls == ["a b c"]
+
+        counter.count("d")
+        counter.count("e f")
+        # "a b c" is evicted
+        assert counter.count("a b c") == 3
+        assert calls == ["a b c", "d", "e f", "a b c"]